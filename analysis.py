@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+from dataclasses import dataclass, field
+from functools import lru_cache
+from fractran import Fraction
+import engines
+import cache
+import sys
+
+@dataclass(frozen=True)
+class Transition:
+    """
+    What one fraction does to the control of the program: the state it needs (None for a stateless fraction),
+    the state holding the token once it fired (None when no state does anymore, when the program halts),
+    the registers its guard tests besides the state and how it moves the registers.
+    A fraction coming after a fraction needing nothing but its state can never fire in that state: it is dead.
+    """
+    fraction: int
+    source: int | None
+    target: int | None
+    reads: tuple[tuple[int, int], ...]
+    writes: tuple[tuple[int, int], ...]
+    dead: bool = False
+
+@dataclass
+class Analysis:
+    """
+    The control structure of a program, by primes: the states (the registers holding a single token,
+    like the states of circuits.py, see engines.control_states), the data registers,
+    the transitions and the strongly connected components of the graph of the states,
+    in topological order (the components only entered from the earlier ones).
+    """
+    basis: list[int]
+    states: list[int]
+    registers: list[int]
+    transitions: list[Transition]
+    components: list[list[int]] = field(default_factory=list)
+
+    def successors(self, state: int | None) -> set[int | None]:
+        return {t.target for t in self.transitions if t.source == state and not t.dead}
+
+    def entries(self) -> list[int]:
+        """
+        Where the program may start: the states of the components no other component moves to
+        (the first state of the circuits is often on the main loop, any state of such a loop could be it)
+        """
+        entered = set()
+        for component in self.components:
+            inside = set(component)
+            if any(t.target in inside for t in self.transitions if not t.dead and t.source not in inside):
+                entered |= inside
+        return [s for s in self.states if s not in entered]
+
+    def loops(self) -> list[list[int]]:
+        """The components a run may go around, a state looping on itself (like a drain) being one"""
+        return [c for c in self.components if len(c) > 1 or c[0] in self.successors(c[0])]
+
+    def headers(self, component: list[int]) -> list[int]:
+        """The states of component entered from outside of it (or where the program starts)"""
+        inside = set(component)
+        entered = {t.target for t in self.transitions if not t.dead and t.source not in inside}
+        return [s for s in component if s in entered] or list(component)
+
+    def touched(self, component: list[int]) -> set[int]:
+        """The registers tested or moved by the transitions of component"""
+        inside = set(component)
+        return {
+            p for t in self.transitions if t.source in inside and not t.dead
+            for p, _ in t.reads + t.writes if p not in self.states
+        }
+
+def components(states: list[int], edges: dict[int, list[int]]) -> list[list[int]]:
+    """The strongly connected components (Tarjan's, without recursion), sources first"""
+    index, low = {}, {}
+    stack, on_stack = [], set()
+    found = []
+
+    for root in states:
+        if root in index:
+            continue
+        work = [(root, iter(edges[root]))]
+        index[root] = low[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = low[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(edges[successor])))
+                    break
+                if successor in on_stack:
+                    low[node] = min(low[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    low[work[-1][0]] = min(low[work[-1][0]], low[node])
+                if low[node] == index[node]:
+                    component = []
+                    while True:
+                        state = stack.pop()
+                        on_stack.discard(state)
+                        component.append(state)
+                        if state == node:
+                            break
+                    found.append(sorted(component))
+
+    return found[::-1]
+
+def analyze(program: list[Fraction], compiled: engines.Compiled | None = None) -> Analysis:
+    """
+    Builds the Analysis of program, from its compiled form when it is given (see cache.load).
+    This is linear in the size of the program (apart from finding the states, see engines.control_states).
+    """
+    if compiled is None:
+        compiled = engines.compile_program(program)
+    basis = compiled.basis
+    states = engines.control_states(compiled)
+
+    transitions = []
+    closed = set()
+    for j, (guard, delta) in enumerate(compiled.fractions):
+        source = next((i for i, _ in guard if i in states), None)
+        target = next((i for i, d in delta if d > 0 and i in states), None)
+        if target is None and source is not None and all(i != source for i, _ in delta):
+            target = source
+
+        transitions.append(Transition(
+            j,
+            None if source is None else basis[source],
+            None if target is None else basis[target],
+            tuple((basis[i], a) for i, a in guard if i != source),
+            tuple((basis[i], d) for i, d in delta if i not in states),
+            source in closed,
+        ))
+        if source is not None and guard == ((source, 1),):
+            closed.add(source)
+
+    ordered = sorted(basis[s] for s in states)
+    analysis = Analysis(list(basis), ordered, sorted(p for p in basis if p not in ordered), transitions)
+    edges = {s: sorted(t for t in analysis.successors(s) if t is not None) for s in ordered}
+    analysis.components = components(ordered, edges)
+    return analysis
+
+@lru_cache(maxsize=64)
+def analysis_of(program: tuple[Fraction, ...]) -> Analysis:
+    """The Analysis of a program, computed once (engines may ask for it every time they load a program)"""
+    return analyze(list(program))
+
+def to_dot(analysis: Analysis, names: dict[int, str] = {}) -> str:
+    """
+    The graph of the states in the DOT language of graphviz (./analysis.py <file> -d out.dot, then dot -Tsvg out.dot):
+    one node per state, the starting ones doubled, the loops boxed, every transition labelled with its fraction,
+    what it tests and how it moves the registers. The stateless fractions are left out.
+    """
+    def name(p: int | None) -> str:
+        return "halt" if p is None else names.get(p, f"v{p}")
+
+    def label(t: Transition) -> str:
+        tests = [f"{name(p)}>={a}" for p, a in t.reads]
+        moves = [f"{name(p)}{d:+}" for p, d in t.writes]
+        return f"#{t.fraction}" + (" " + " ".join(tests) if tests else "") + (" : " + " ".join(moves) if moves else "")
+
+    lines = ["digraph fractran {", "    rankdir=LR;", '    "halt" [shape=box];']
+    for s in analysis.entries():
+        lines.append(f'    "{name(s)}" [shape=doublecircle];')
+
+    for k, loop in enumerate(analysis.loops()):
+        lines.append(f"    subgraph cluster_{k} {{")
+        lines += [f'        "{name(s)}";' for s in loop]
+        lines.append("    }")
+
+    for t in analysis.transitions:
+        if t.source is not None and not t.dead:
+            lines.append(f'    "{name(t.source)}" -> "{name(t.target)}" [label="{label(t)}"];')
+
+    lines.append("}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./analysis.py <filename> [-d out.dot] [a=2 b=3 ...]
+
+    prints the states, the registers and the loops of the program (the primes may be named as in ./fractran.py -D),
+    and writes the graph of its states in the DOT language with -d.
+    """
+
+    if len(sys.argv) >= 2:
+        names = {int(b): a for a, b in (argument.split("=") for argument in sys.argv[2:] if "=" in argument)}
+        program, compiled = cache.load(sys.argv[1])
+        analysis = analyze(program, compiled)
+
+        def show(ps) -> str:
+            return " ".join(names.get(p, f"v{p}") for p in ps)
+
+        print(f"{len(program)} fractions, {len(analysis.states)} states, {len(analysis.registers)} registers")
+        print(f"states: {show(analysis.states)}")
+        print(f"registers: {show(analysis.registers)}")
+        print(f"starts at: {show(analysis.entries())}")
+        for loop in analysis.loops():
+            print(f"loop {show(loop)} (entered at {show(analysis.headers(loop))}, touching {show(sorted(analysis.touched(loop)))})")
+
+        if "-d" in sys.argv:
+            with open(sys.argv[sys.argv.index("-d")+1], "w", encoding="utf-8") as file:
+                file.write(to_dot(analysis, names) + "\n")
+    else:
+        print("Retry with the filename of the program as an argument.")
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+
+from typing import Callable, Iterable, Iterator
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from itertools import islice
+from time import monotonic
+from fractran import Fraction
+import engines
+import cache
+import pretty
+import os
+import sys
+
+@dataclass
+class Result:
+    """
+    Outcome of one input of a batch.
+    When the run was stopped (by the step cap or the timeout) halted is False
+    and output is the integer reached at that point.
+    Inputs given by their exponents ({prime: exponent}, compiled engines only) get their output the same way.
+    """
+    index: int
+    output: int | engines.Factors
+    steps: int
+    halted: bool
+
+class Interrupted(Exception):
+    def __init__(self, n: int, steps: int):
+        self.n = n
+        self.steps = steps
+
+type Prepared = Callable[[int, int | None, float | None], tuple[int, int, bool]]
+
+def prepare(program: list[Fraction],
+            engine: str,
+            compiled: engines.Compiled | None = None) -> Prepared:
+    """
+    Does the per-program work of an engine once (compiling it unless compiled is given, building its caches)
+    and returns a function evaluating an input, given a step cap and a timeout in seconds.
+    """
+    if engine in engines.RUNNERS:
+        if compiled is None:
+            compiled = engines.compile_program(program)
+        runner = engines.RUNNERS[engine](compiled)
+
+        def evaluate(n, max_steps, timeout):
+            deadline = None if timeout is None else monotonic() + timeout
+            if isinstance(n, dict):
+                registers, cofactor = engines.factors_to_registers(compiled, n)
+                steps = runner(registers, max_steps=max_steps, deadline=deadline)
+                done = engines.halted(compiled, registers)
+                return engines.registers_to_factors(compiled, registers, cofactor), steps, done
+
+            registers, cofactor = engines.to_registers(compiled, n)
+            steps = runner(registers, max_steps=max_steps, deadline=deadline)
+            done = engines.halted(compiled, registers)
+            return engines.from_registers(compiled, registers, cofactor), steps, done
+
+        return evaluate
+
+    interpreter = engines.ENGINES[engine]
+
+    def evaluate_factors(n, max_steps, timeout):
+        output, steps, done = evaluate(pretty.factors_to_int(n), max_steps, timeout)
+        return pretty.int_to_factors(output), steps, done
+
+    def evaluate(n, max_steps, timeout):
+        if isinstance(n, dict):
+            return evaluate_factors(n, max_steps, timeout)
+        # the step by step interpreters are stopped from their action callback
+        deadline = None if timeout is None else monotonic() + timeout
+        calls = 0
+
+        def action(current):
+            nonlocal calls
+            calls += 1
+            if calls - 1 == max_steps or (deadline is not None and calls % 1024 == 0 and monotonic() >= deadline):
+                if isinstance(current, int):
+                    raise Interrupted(current, calls - 1)
+                output = 1
+                for p, e in current.items():
+                    output *= p**e
+                raise Interrupted(output, calls - 1)
+
+        try:
+            output = interpreter(program, n, action)
+        except Interrupted as interrupted:
+            done = all((num * interrupted.n) % den != 0 for num, den in program)
+            return interrupted.n, interrupted.steps, done
+        return output, calls - 1, True
+
+    return evaluate
+
+PREPARED: Prepared | None = None
+
+def initialize(program: list[Fraction], engine: str, compiled: engines.Compiled | None):
+    global PREPARED
+    PREPARED = prepare(program, engine, compiled)
+
+def evaluate_chunk(chunk: list[tuple[int, int]],
+                   max_steps: int | None,
+                   timeout: float | None) -> list[Result]:
+    return [Result(i, *PREPARED(n, max_steps, timeout)) for i, n in chunk]
+
+def evaluate_many(program: list[Fraction],
+                  inputs: Iterable[int | engines.Factors],
+                  workers: int | None = None,
+                  engine: str = "macro",
+                  chunksize: int = 64,
+                  ordered: bool = True,
+                  timeout: float | None = None,
+                  max_steps: int | None = None,
+                  compiled: engines.Compiled | None = None) -> Iterator[Result]:
+    """
+    Runs one program over many inputs on a pool of processes (one per core by default).
+
+    The program is sent to every worker once, where it is compiled once for all the inputs.
+    Inputs are read lazily and sent by chunks, a bounded number of them being in flight,
+    so that inputs may be a generator over a huge range.
+    Results come in the order of the inputs, or as soon as they are ready if ordered is False
+    (use Result.index to match them).
+    Each input is given at most timeout seconds and max_steps steps.
+    The compiled program can be given when it is already known (see cache.py).
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers == 1:
+        evaluate = prepare(program, engine, compiled)
+        for i, n in enumerate(inputs):
+            yield Result(i, *evaluate(n, max_steps, timeout))
+        return
+
+    numbered = enumerate(inputs)
+    with ProcessPoolExecutor(workers, initializer=initialize, initargs=(program, engine, compiled)) as pool:
+        pending = set()
+        ready = {}
+        expected = 0
+        exhausted = False
+
+        while True:
+            while not exhausted and len(pending) < 2 * workers:
+                chunk = list(islice(numbered, chunksize))
+                if not chunk:
+                    exhausted = True
+                else:
+                    pending.add(pool.submit(evaluate_chunk, chunk, max_steps, timeout))
+
+            if not pending:
+                return
+
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for result in future.result():
+                    if ordered:
+                        ready[result.index] = result
+                    else:
+                        yield result
+
+            while expected in ready:
+                yield ready.pop(expected)
+                expected += 1
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./batch.py <filename> [-e engine] [-w workers] [-s max_steps] [-t timeout]
+
+    reads one input per line from the standard input (in the 2^x * 3^y format)
+    and prints the outputs in the same order, "?" for the runs which were stopped.
+    """
+
+    if len(sys.argv) >= 2:
+        options = dict(zip(sys.argv[2::2], sys.argv[3::2]))
+        inputs = (pretty.pretty_prime_factors_to_factors(line) for line in sys.stdin if line.strip())
+        program, compiled = cache.load(sys.argv[1])
+
+        results = evaluate_many(
+            program,
+            inputs,
+            compiled=compiled,
+            workers=int(options["-w"]) if "-w" in options else None,
+            engine=options.get("-e", "macro"),
+            max_steps=int(options["-s"]) if "-s" in options else None,
+            timeout=float(options["-t"]) if "-t" in options else None
+        )
+
+        for result in results:
+            if not result.halted:
+                print("?")
+            else:
+                print(pretty.factors_to_pretty_prime_factors(result.output))
+    else:
+        print("Retry with the filename of the program as an argument.")
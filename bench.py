@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+from dataclasses import dataclass, asdict
+from typing import Callable, Iterable
+from datetime import datetime, timezone
+from time import perf_counter
+from fractran import Fraction
+import fractran
+import engines
+import tracemalloc
+import platform
+import json
+import gc
+import os
+import sys
+
+# the input of every program of programs/ at scale n, in the layout of tests.py
+INPUTS: dict[str, Callable[[int], int]] = {
+    "accumulate": lambda n: 2**n * 3**n * 5,
+    "accumulate_and_destroy": lambda n: 2**n * 3**n * 5,
+    "add": lambda n: 3**n * 5**n * 7,
+    "clear": lambda n: 2**n * 3,
+    "collatz": lambda n: 2**n * 5,
+    "copy": lambda n: 3**n * 5,
+    "decrement": lambda n: 2**n * 3,
+    "euclidian_division": lambda n: 2**(4 * n) * 3**(n + 1) * 11,
+    "factorial": lambda n: 2**n * 3,
+    "fibonacci": lambda n: 2**n * 5,
+    "goto": lambda n: 2,
+    "increment_1": lambda n: 2**n * 3,
+    "increment_2": lambda n: 2**n * 3,
+    "increment_5": lambda n: 2**n * 3,
+    "multiply": lambda n: 2**n * 3**n * 7,
+    "multiply_on": lambda n: 2**n * 3**n * 5,
+    "sqrt": lambda n: 2**n * 5,
+    "sum": lambda n: 2**n * 5,
+}
+
+@dataclass
+class Measure:
+    """
+    One engine over the inputs of one program at the scales 1..inputs.
+    seconds is the best of the repeats, peak_bytes the most memory taken by one run (from tracemalloc)
+    and collections the collections of the youngest generation of gc during the runs, which the interpreter
+    triggers every few hundreds of objects allocated and still alive: the allocation pressure of the engine.
+    """
+    program: str
+    engine: str
+    inputs: int
+    steps: int
+    seconds: float
+    peak_bytes: int
+    collections: int
+
+    @property
+    def steps_per_second(self) -> float:
+        return self.steps / self.seconds if self.seconds > 0 else float("inf")
+
+def count_steps(program: list[Fraction], n: int) -> int:
+    compiled = engines.compile_program(program)
+    registers, _ = engines.to_registers(compiled, n)
+    return engines.run(compiled, registers)
+
+def measure(program: list[Fraction],
+            name: str,
+            engine: str,
+            inputs: list[int],
+            repeat: int = 3,
+            budget: float | None = None) -> Measure:
+    """
+    Runs engine (a name of engines.ENGINES) over the inputs, in order, each one repeat times.
+    Once an input took more than budget seconds the larger ones are left out (see Measure.inputs).
+    """
+    evaluate = engines.ENGINES[engine]
+    steps = seconds = 0
+    peak = collections = 0
+    done = 0
+
+    for n in inputs:
+        best = float("inf")
+        for _ in range(repeat):
+            start = perf_counter()
+            evaluate(program, n)
+            best = min(best, perf_counter() - start)
+
+        before = gc.get_stats()[0]["collections"]
+        tracemalloc.start()
+        evaluate(program, n)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        collections += gc.get_stats()[0]["collections"] - before
+
+        steps += count_steps(program, n)
+        seconds += best
+        done += 1
+        if budget is not None and best > budget:
+            break
+
+    return Measure(name, engine, done, steps, seconds, peak, collections)
+
+def run_bench(programs: Iterable[str] | None = None,
+              names: Iterable[str] | None = None,
+              scale: int = 8,
+              repeat: int = 3,
+              budget: float | None = 1.0,
+              directory: str = "programs") -> list[Measure]:
+    """Every engine of names (all of them by default) over every program of INPUTS at the scales 1..scale"""
+    measures = []
+    for name in INPUTS if programs is None else programs:
+        program = fractran.program_from_file(os.path.join(directory, name))
+        inputs = [INPUTS[name](n) for n in range(1, scale + 1)]
+        for engine in engines.ENGINES if names is None else names:
+            measures.append(measure(program, name, engine, inputs, repeat, budget))
+    return measures
+
+def save(filename: str, measures: list[Measure], **meta):
+    meta |= {
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+    }
+    with open(filename, "w", encoding="utf-8") as file:
+        json.dump({"meta": meta, "measures": [asdict(m) for m in measures]}, file, indent=1)
+
+def load(filename: str) -> list[Measure]:
+    with open(filename, "r", encoding="utf-8") as file:
+        return [Measure(**m) for m in json.load(file)["measures"]]
+
+def compare(baseline: list[Measure], current: list[Measure], threshold: float = 0.1) -> list[str]:
+    """
+    The regressions of current against baseline: the pairs of a program and an engine
+    which lost more than threshold (a fraction) of their steps per second, or took that much more memory.
+    Pairs which did not run the same inputs both times are not compared.
+    """
+    before = {(m.program, m.engine): m for m in baseline}
+    regressions = []
+
+    for new in current:
+        old = before.get((new.program, new.engine))
+        if old is None or old.inputs != new.inputs:
+            continue
+        if new.steps_per_second < old.steps_per_second * (1 - threshold):
+            slower = old.steps_per_second / new.steps_per_second
+            regressions.append(f"{new.program} [{new.engine}]: {slower:.2f}x slower")
+        if new.peak_bytes > old.peak_bytes * (1 + threshold):
+            heavier = new.peak_bytes / max(old.peak_bytes, 1)
+            regressions.append(f"{new.program} [{new.engine}]: {heavier:.2f}x more memory")
+
+    return regressions
+
+def report(measures: list[Measure]) -> list[str]:
+    lines = [f"{'program':<24}{'engine':<12}{'inputs':>7}{'steps':>12}{'ms':>10}{'steps/s':>12}{'peak KiB':>10}{'gc':>6}"]
+    for m in measures:
+        lines.append(f"{m.program:<24}{m.engine:<12}{m.inputs:>7}{m.steps:>12}{1000 * m.seconds:>10.1f}"
+                     f"{m.steps_per_second:>12.3g}{m.peak_bytes / 1024:>10.1f}{m.collections:>6}")
+    return lines
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    1) ./bench.py [-o results.json] [-n scale] [-r repeat] [-p prog1,prog2] [-e engine1,engine2] [-b baseline.json] [-t threshold]
+                                  <- runs every engine (or the ones given) over every program of programs/
+                                     (or the ones given) on the inputs of INPUTS at the scales 1..scale (8 by default),
+                                     prints a table and writes the results as JSON;
+                                     with a baseline, prints the regressions beyond threshold (0.1 by default)
+                                     and exits with 1 if there are any
+    2) ./bench.py compare <baseline.json> <results.json> [-t threshold]
+                                  <- same comparison between two saved results
+    """
+
+    arguments = sys.argv[1:]
+    compare_only = arguments[:1] == ["compare"]
+    if compare_only and len(arguments) < 3:
+        print("Retry with the baseline and the results files as arguments.")
+        sys.exit(2)
+
+    options = dict(zip(arguments[3::2], arguments[4::2]) if compare_only else zip(arguments[::2], arguments[1::2]))
+    threshold = float(options.get("-t", 0.1))
+
+    if compare_only:
+        baseline, measures = load(arguments[1]), load(arguments[2])
+    else:
+        baseline = load(options["-b"]) if "-b" in options else None
+        scale, repeat = int(options.get("-n", 8)), int(options.get("-r", 3))
+        measures = run_bench(
+            programs=options["-p"].split(",") if "-p" in options else None,
+            names=options["-e"].split(",") if "-e" in options else None,
+            scale=scale,
+            repeat=repeat,
+        )
+        for line in report(measures):
+            print(line)
+        if "-o" in options:
+            save(options["-o"], measures, scale=scale, repeat=repeat)
+
+    if baseline is not None:
+        regressions = compare(baseline, measures, threshold)
+        for line in regressions:
+            print(line)
+        print(f"{len(regressions)} regressions beyond {threshold:.0%}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,101 @@
+from typing import Iterable, Iterator
+from math import gcd, prod
+from fractran import Fraction
+import primes
+
+type Factors = dict[int, int]
+
+MAGIC = b"FRBIN01\n"
+
+def varint(value: int, output: bytearray):
+    while value >= 0x80:
+        output.append(value & 0x7f | 0x80)
+        value >>= 7
+    output.append(value)
+
+def varints(data: bytes, position: int = 0) -> Iterator[int]:
+    """
+    The varints of data from position on. Asking for one more than the data holds raises a ValueError
+    (rather than StopIteration, which the generators reading a file would turn into a RuntimeError).
+    """
+    value = shift = 0
+    for byte in memoryview(data)[position:]:
+        if byte < 0x80:
+            yield value | byte << shift
+            value = shift = 0
+        else:
+            value |= (byte & 0x7f) << shift
+            shift += 7
+    raise ValueError("truncated data, the varints stop short")
+
+def encode_program(program: Iterable[Fraction]) -> bytearray:
+    """
+    Encodes program in the binary format: the primes it uses (increasing, as varint differences)
+    followed by the fractions, each of them being its numerator and its denominator
+    as a number of (prime index, exponent) pairs and the pairs, all varints.
+    The fractions are reduced, which does not change what the program does.
+    """
+    factored = []
+    for num, den in program:
+        g = gcd(num, den)
+        factored.append((primes.factorize(num // g), primes.factorize(den // g)))
+
+    table = sorted({p for num, den in factored for p in num.keys() | den.keys()})
+    index = {p: i for i, p in enumerate(table)}
+
+    output = bytearray(MAGIC)
+    varint(len(table), output)
+    previous = 0
+    for p in table:
+        varint(p - previous, output)
+        previous = p
+
+    varint(len(factored), output)
+    for num, den in factored:
+        for factors in (num, den):
+            varint(len(factors), output)
+            for p, e in factors.items():
+                varint(index[p], output)
+                varint(e, output)
+
+    return output
+
+def write_program(filename: str, program: Iterable[Fraction]):
+    with open(filename, "wb") as file:
+        file.write(encode_program(program))
+
+def decode_factors(data: bytes) -> Iterator[tuple[Factors, Factors]]:
+    """The fractions of an encoded program as the exponents of their numerator and denominator, one at a time"""
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError("not a binary fractran program")
+
+    values = varints(data, len(MAGIC))
+    take = values.__next__
+
+    table = []
+    p = 0
+    for _ in range(take()):
+        p += take()
+        table.append(p)
+
+    for _ in range(take()):
+        num = {table[take()]: take() for _ in range(take())}
+        den = {table[take()]: take() for _ in range(take())}
+        yield num, den
+
+def read_factors(filename: str) -> Iterator[tuple[Factors, Factors]]:
+    with open(filename, "rb") as file:
+        data = file.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{filename} is not a binary fractran program")
+    return decode_factors(data)
+
+def decode_program(data: bytes) -> list[Fraction]:
+    return [
+        (prod(p**e for p, e in num.items()), prod(p**e for p, e in den.items()))
+        for num, den in decode_factors(data)
+    ]
+
+def read_program(filename: str) -> list[Fraction]:
+    with open(filename, "rb") as file:
+        return decode_program(file.read())
@@ -0,0 +1,127 @@
+from array import array
+from hashlib import sha256
+from fractran import Fraction
+import fractran
+import engines
+import mmap
+import os
+
+# bumped whenever the layout below (or the way engines compiles programs) changes
+VERSION = 2
+MAGIC = b"FRCOMP01"
+DIRECTORY = os.environ.get("FRACTRAN_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "fractran"))
+
+NONE = -3
+
+def encode(program: list[Fraction], compiled: engines.Compiled) -> array:
+    """
+    Flattens a program and its compiled form into one array of int64, every list being preceded by its length.
+    Raises OverflowError when some integer does not fit, such programs are simply not cached.
+    """
+    values = [len(program)]
+    for num, den in program:
+        values += [num, den]
+
+    values.append(len(compiled.basis))
+    values += compiled.basis
+
+    for guard, delta in compiled.fractions:
+        for pairs in (guard, delta):
+            values.append(len(pairs))
+            for i, a in pairs:
+                values += [i, a]
+
+    dispatch = compiled.dispatch
+    values.append(len(dispatch.states))
+    values += sorted(dispatch.states)
+
+    values.append(len(dispatch.table))
+    for state, entries in dispatch.table.items():
+        values += [state, len(entries)]
+        for j, _, _, move in entries:
+            values += [j, NONE if move is None else move]
+
+    values.append(NONE if dispatch.earlier is None else len(dispatch.earlier))
+    for earlier in dispatch.earlier or []:
+        values.append(len(earlier))
+        values += earlier
+
+    return array("q", values)
+
+def decode(values: list[int]) -> tuple[list[Fraction], engines.Compiled]:
+    position = 0
+
+    def take(count: int) -> list[int]:
+        nonlocal position
+        position += count
+        return values[position - count:position]
+
+    def pairs() -> tuple[tuple[int, int], ...]:
+        flat = take(2 * take(1)[0])
+        return tuple(zip(flat[::2], flat[1::2]))
+
+    flat = take(2 * take(1)[0])
+    program = list(zip(flat[::2], flat[1::2]))
+
+    basis = take(take(1)[0])
+    fractions = [(pairs(), pairs()) for _ in program]
+
+    states = set(take(take(1)[0]))
+    table = {}
+    for _ in range(take(1)[0]):
+        state, count = take(2)
+        flat = take(2 * count)
+        table[state] = [
+            (j, *fractions[j], None if move == NONE else move)
+            for j, move in zip(flat[::2], flat[1::2])
+        ]
+    count = take(1)[0]
+    earlier = None if count == NONE else [take(take(1)[0]) for _ in range(count)]
+
+    if position != len(values):
+        raise ValueError("truncated or corrupted compiled program")
+
+    index = {p: i for i, p in enumerate(basis)}
+    return program, engines.Compiled(basis, index, fractions, engines.Dispatch(states, table, earlier))
+
+def path_of(source: bytes) -> str:
+    digest = sha256(source + f"\0{VERSION}".encode()).hexdigest()
+    return os.path.join(DIRECTORY, f"{digest}.bin")
+
+def load(filename: str) -> tuple[list[Fraction], engines.Compiled]:
+    """
+    Reads and compiles the program in filename, or maps its compiled form from the cache directory
+    when this exact content was already compiled (the cache files are named after a hash of the source,
+    so an edited program simply gets a new entry).
+    The cache is skipped silently when the directory cannot be written or the program has huge integers.
+    """
+    with open(filename, "rb") as file:
+        source = file.read()
+    path = path_of(source)
+
+    try:
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        with mapped:
+            if mapped[:8] == MAGIC:
+                with memoryview(mapped) as view, view[8:].cast("q") as values:
+                    return decode(values.tolist())
+    except (OSError, ValueError, IndexError, TypeError):
+        # TypeError: a length which is not a whole number of values (a truncated file)
+        pass
+
+    program = fractran.program_from_file(filename)
+    compiled = engines.compile_program(program)
+
+    try:
+        values = encode(program, compiled)
+        os.makedirs(DIRECTORY, exist_ok=True)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(MAGIC)
+            file.write(values.tobytes())
+        os.replace(temporary, path)
+    except (OSError, OverflowError):
+        pass
+
+    return program, compiled
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+from dataclasses import dataclass
+from time import monotonic
+from fractran import Fraction
+import engines
+import binary
+import pretty
+import cache
+import os
+import sys
+
+MAGIC = b"FRCKPT01"
+
+@dataclass
+class Run:
+    """
+    Where a run of program is: the current value (as {prime: exponent}) after steps steps,
+    and whether it halted there. Runs which did not halt can be advanced further, saved and resumed.
+    The control state of the program is held by its registers, so nothing else is needed to go on.
+    """
+    program: list[Fraction]
+    factors: engines.Factors
+    steps: int = 0
+    halted: bool = False
+
+def start(program: list[Fraction], n: int | engines.Factors) -> Run:
+    return Run(program, n if isinstance(n, dict) else pretty.int_to_factors(n))
+
+def advance(run: Run,
+            engine: str = "macro",
+            max_steps: int | None = None,
+            max_seconds: float | None = None,
+            checkpoint: str | None = None,
+            every: float = 60.0,
+            compiled: engines.Compiled | None = None,
+            runner: engines.Runner | None = None) -> Run:
+    """
+    Runs for at most max_steps more steps and max_seconds seconds (forever by default), with one of engines.RUNNERS,
+    and returns where the run is then. With a checkpoint filename, the run is saved there every every seconds
+    and when it stops, so that resume can pick it up after the process died.
+    The callers advancing a run by many slices can give the runner (with its compiled program) of engines.runner_for,
+    made once for all of them.
+    """
+    if runner is None:
+        compiled, runner = engines.runner_for(run.program, engine, compiled)
+    registers, cofactor = engines.factors_to_registers(compiled, run.factors)
+    deadline = None if max_seconds is None else monotonic() + max_seconds
+    steps = run.steps
+
+    while True:
+        limit = None if max_steps is None else run.steps + max_steps - steps
+        stop = deadline
+        if checkpoint is not None:
+            stop = monotonic() + every if deadline is None else min(deadline, monotonic() + every)
+        steps += runner(registers, max_steps=limit, deadline=stop)
+
+        current = Run(run.program, engines.registers_to_factors(compiled, registers, cofactor), steps,
+                      engines.halted(compiled, registers))
+        if checkpoint is not None:
+            save(current, checkpoint)
+        if current.halted or steps - run.steps == max_steps or (deadline is not None and monotonic() >= deadline):
+            return current
+
+def save(run: Run, filename: str):
+    """
+    Writes run to filename (atomically, an interrupted save leaves the previous checkpoint):
+    the program in the format of binary.py followed by the step count, the halting flag and the exponents, as varints.
+    """
+    program = binary.encode_program(run.program)
+    output = bytearray(MAGIC)
+    binary.varint(len(program), output)
+    output += program
+    binary.varint(run.steps, output)
+    binary.varint(run.halted, output)
+    binary.varint(len(run.factors), output)
+    for p, e in run.factors.items():
+        binary.varint(p, output)
+        binary.varint(e, output)
+
+    temporary = f"{filename}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(output)
+    os.replace(temporary, filename)
+
+def load(filename: str) -> Run:
+    with open(filename, "rb") as file:
+        data = file.read()
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{filename} is not a checkpoint")
+
+    size = next(binary.varints(data, len(MAGIC)))
+    header = bytearray()
+    binary.varint(size, header)
+    position = len(MAGIC) + len(header)
+    program = binary.decode_program(data[position:position + size])
+
+    values = binary.varints(data, position + size)
+    steps, halted = next(values), bool(next(values))
+    factors = {next(values): next(values) for _ in range(next(values))}
+    return Run(program, factors, steps, halted)
+
+def resume(filename: str, **options) -> Run:
+    """Goes on with the run saved in filename, still checkpointing it there (the options are the ones of advance)"""
+    return advance(load(filename), checkpoint=filename, **options)
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./checkpoint.py <filename> <checkpoint> [-e engine] [-s max_steps] [-t max_seconds] [-c every]
+
+    runs the program on the input read from the standard input (in the 2^x * 3^y format),
+    saving the run into the checkpoint file every minute (or every "every" seconds).
+    When the checkpoint file already exists, the run saved there goes on instead (and no input is read),
+    hence running the same command again after a crash, or after reaching max_steps or max_seconds,
+    picks the run up where it was.
+    """
+
+    if len(sys.argv) >= 3:
+        filename, path = sys.argv[1], sys.argv[2]
+        options = dict(zip(sys.argv[3::2], sys.argv[4::2]))
+        program, compiled = cache.load(filename)
+
+        if os.path.exists(path):
+            run = load(path)
+        else:
+            print("Input:")
+            run = start(program, pretty.pretty_prime_factors_to_factors(input()))
+
+        run = advance(
+            run,
+            engine=options.get("-e", "macro"),
+            max_steps=int(options["-s"]) if "-s" in options else None,
+            max_seconds=float(options["-t"]) if "-t" in options else None,
+            checkpoint=path,
+            every=float(options.get("-c", 60)),
+            compiled=compiled if run.program == program else None,
+        )
+
+        if run.halted:
+            print(pretty.factors_to_pretty_prime_factors(run.factors))
+        else:
+            print(f"Stopped after {run.steps} steps, run the same command again to go on.")
+    else:
+        print("Retry with the filename of the program and the filename of the checkpoint as arguments.")
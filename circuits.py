@@ -1,20 +1,69 @@
 #!/usr/bin/env python3
 
+from contextlib import contextmanager
+from contextvars import ContextVar
+from heapq import heappush, heappop
+from threading import Lock
+from typing import Iterable, Iterator
 from fractran import Fraction
+import fractran
 import primes
+import optimizer
 import sys
 
-HEAD = 0
-
 type Prime = int
 type State = Prime
 type Var = Prime
 
+class Allocator:
+    """
+    Hands out the primes of one build: always the smallest free ones, starting from the first-th prime,
+    so that building the same circuit twice gives the same program (whatever else was built in between).
+    The primes given back by release are handed out again first, the reserved ones never.
+    """
+
+    def __init__(self, first: int = 0, reserved: Iterable[Prime] = ()):
+        self.head = first
+        self.reserved = set(reserved)
+        self.released: list[Prime] = []
+        self.lock = Lock()
+
+    def uniques(self, amount: int) -> list[Prime]:
+        with self.lock:
+            output = []
+            while len(output) < amount:
+                if self.released:
+                    output.append(heappop(self.released))
+                    continue
+                p = primes.PRIMES[self.head]
+                self.head += 1
+                if p not in self.reserved:
+                    output.append(p)
+            return output
+
+    def release(self, *given: Prime):
+        with self.lock:
+            for p in given:
+                heappush(self.released, p)
+
+ALLOCATOR: ContextVar[Allocator] = ContextVar("allocator")
+
+@contextmanager
+def allocating(allocator: Allocator | None = None) -> Iterator[Allocator]:
+    """Builds with allocator (a new one by default) within the block, in this thread or task only"""
+    allocator = Allocator() if allocator is None else allocator
+    token = ALLOCATOR.set(allocator)
+    try:
+        yield allocator
+    finally:
+        ALLOCATOR.reset(token)
+
 def uniques(amount: int) -> list[Prime]:
-    global HEAD
-    output = primes.PRIMES[HEAD:HEAD+amount]
-    HEAD += amount
-    return output
+    try:
+        allocator = ALLOCATOR.get()
+    except LookupError:
+        raise RuntimeError("circuits are built within allocating(), see make_sum for instance") from None
+    return allocator.uniques(amount)
 
 def unique() -> Prime:
     return uniques(1)[0]
@@ -361,25 +410,30 @@ def automata_factorial(begin: State,
 
     return [ f for fs in automata for f in fs ]
 
-def make_sum():
-    i, o, A, B = uniques(4)
-    return automata_sum(A, B, i, o) + destroy(B)
+def make_sum() -> list[Fraction]:
+    with allocating():
+        i, o, A, B = uniques(4)
+        return automata_sum(A, B, i, o) + destroy(B)
 
-def make_fibonacci():
-    n, o, A, B = uniques(4)
-    return automata_fibonacci(A, B, n, o) + destroy(B)
+def make_fibonacci() -> list[Fraction]:
+    with allocating():
+        n, o, A, B = uniques(4)
+        return automata_fibonacci(A, B, n, o) + destroy(B)
 
-def make_collatz():
-    n, o, A, B = uniques(4)
-    return automata_collatz(A, B, n, o) + destroy(B)
+def make_collatz() -> list[Fraction]:
+    with allocating():
+        n, o, A, B = uniques(4)
+        return automata_collatz(A, B, n, o) + destroy(B)
 
-def make_sqrt():
-    n, o, A, B = uniques(4)
-    return automata_sqrt(A, B, n, o) + destroy(B)
+def make_sqrt() -> list[Fraction]:
+    with allocating():
+        n, o, A, B = uniques(4)
+        return automata_sqrt(A, B, n, o) + destroy(B)
 
-def make_factorial():
-    n, A, B = uniques(3)
-    return automata_factorial(A, B, n) + destroy(B)
+def make_factorial() -> list[Fraction]:
+    with allocating():
+        n, A, B = uniques(3)
+        return automata_factorial(A, B, n) + destroy(B)
 
 if __name__ == "__main__":
     """
@@ -387,15 +441,18 @@ if __name__ == "__main__":
 
     1) change the behaviour of the code below according to you
        (what program do you want as your output?)
-    2) run "./circuits.py <output_filename>"
+    2) run "./circuits.py <output_filename> [-O]"
+       (the program is written in the binary format of binary.py when the filename ends with .bin,
+       and goes through optimizer.py first with -O, keeping the primes of its input and output)
     """
 
-    if len(sys.argv) == 2:
+    if len(sys.argv) in (2, 3):
         outfile = sys.argv[1]
         program = make_factorial()
 
-        with open(outfile, "w", encoding="utf-8") as file:
-            for num, den in program:
-                file.write(f"{num} / {den}\n")
+        if sys.argv[2:] == ["-O"]:
+            program = optimizer.optimize(program, [2, 3], [2**n * 3 for n in range(1, 6)])
+
+        fractran.program_to_file(outfile, program)
     else:
         print("Retry with a filename as argument (= the output). This file will be overwritten!")
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Iterable
+from math import prod
+from fractran import Fraction
+import fractran
+import circuits
+import optimizer
+import primes
+import sys
+
+HALT = "halt"
+
+# the instructions: the combinator of circuits.py, how many registers it takes and how many states it may go to
+OPERATIONS: dict[str, tuple[Callable[..., list[Fraction]], int, int]] = {
+    "goto": (circuits.goto, 0, 1),
+    "inc": (circuits.increment_times, 1, 1),
+    "dec": (circuits.decrement, 1, 1),
+    "clear": (circuits.clear, 1, 1),
+    "branch": (circuits.branch, 1, 2),
+    "branch_dec": (circuits.branch_then_decrement, 1, 2),
+    "branch_gt": (circuits.branch_gt, 2, 2),
+    "copy": (circuits.copy, 2, 1),
+    "add": (circuits.add, 3, 1),
+    "accumulate": (circuits.accumulate, 2, 1),
+    "move": (circuits.accumulate_and_destroy, 2, 1),
+    "multiply": (circuits.multiply, 3, 1),
+    "multiply_on": (circuits.multiply_on, 2, 1),
+    "divide": (circuits.euclidian_division, 4, 1),
+}
+
+@dataclass
+class Statement:
+    """label: operation registers -> targets (inc takes an optional count after its register)"""
+    label: str
+    operation: str
+    registers: list[str]
+    targets: list[str]
+    times: int = 1
+
+@dataclass
+class Circuit:
+    """
+    A program of the register-machine language: the statements run from the first one, until one goes to halt.
+    The registers of the interface (the input and output) come first, the other ones are temporaries,
+    emptied once the program halted.
+    """
+    registers: list[str] = field(default_factory=list)
+    statements: list[Statement] = field(default_factory=list)
+
+    def names(self) -> list[str]:
+        """
+        Every name of the circuit in the order of their primes:
+        the interface, the first state, halt, the other states and the temporaries as they appear,
+        which is how the make_* functions of circuits.py allocate theirs.
+        """
+        names = list(self.registers)
+        labels = [statement.label for statement in self.statements]
+        for name in labels[:1] + [HALT] + labels[1:]:
+            if name not in names:
+                names.append(name)
+        for statement in self.statements:
+            for name in statement.registers:
+                if name not in names:
+                    names.append(name)
+        return names
+
+def parse(lines: Iterable[str]) -> Circuit:
+    """
+    Reads a circuit, one statement per line, for instance:
+
+        registers n o
+        A: clear o -> B
+        B: branch_dec n -> C, halt
+        C: inc o 2 -> B
+
+    Blank lines are skipped and anything after a # is a comment. Raises ValueError on the first mistake.
+    """
+    circuit = Circuit()
+    seen = set()
+
+    for number, line in enumerate(lines, 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+
+        def fail(reason: str):
+            raise ValueError(f"line {number}: {reason}")
+
+        words = line.split()
+        if words[0] == "registers":
+            if circuit.registers or circuit.statements:
+                fail("the registers come once, before the statements")
+            circuit.registers = words[1:]
+            continue
+
+        head, arrow, tail = line.partition("->")
+        label, colon, body = head.partition(":")
+        words = body.split()
+        if not colon or not arrow or not words:
+            fail(f"{line!r} is not of the form 'label: operation registers -> targets'")
+        label = label.strip()
+        operation, registers = words[0], words[1:]
+        targets = [target.strip() for target in tail.split(",")]
+
+        if operation not in OPERATIONS:
+            fail(f"unknown operation {operation!r}")
+        _, arity, outcomes = OPERATIONS[operation]
+        times = 1
+        if operation == "inc" and len(registers) == 2 and registers[1].isdigit():
+            times = int(registers.pop())
+        if len(registers) != arity or len(targets) != outcomes:
+            fail(f"{operation} takes {arity} registers and {outcomes} targets")
+        if label in seen or label == HALT:
+            fail(f"the label {label!r} is already taken")
+        seen.add(label)
+        circuit.statements.append(Statement(label, operation, registers, targets, times))
+
+    if not circuit.statements:
+        raise ValueError("a circuit needs at least one statement")
+    for statement in circuit.statements:
+        for target in statement.targets:
+            if target not in seen and target != HALT:
+                raise ValueError(f"{statement.label}: unknown target {target!r}")
+        for name in statement.registers:
+            if name in seen or name == HALT:
+                raise ValueError(f"{statement.label}: {name!r} is a state, not a register")
+
+    return circuit
+
+def expand(statement: Statement, primes_of: dict[str, int], first: int) -> tuple[list[Fraction], int]:
+    """
+    The fractions of one statement, its own temporaries being the primes from the first-th one,
+    and how many of them it took. The statements are expanded independently (in a pool when asked),
+    link numbers their temporaries one after the other.
+    """
+    combinator, _, _ = OPERATIONS[statement.operation]
+    arguments = [primes_of[name] for name in [statement.label, *statement.targets, *statement.registers]]
+    if statement.operation == "inc":
+        arguments.append(statement.times)
+
+    with circuits.allocating(circuits.Allocator(first)) as allocator:
+        fractions = combinator(*arguments)
+    return fractions, allocator.head - first
+
+def link(expanded: list[tuple[list[Fraction], int]], first: int) -> list[Fraction]:
+    """Renames the temporaries of each statement to the next free primes, in the order of the statements"""
+    local = primes.PRIMES[first:first + max((count for _, count in expanded), default=0)]
+    program = []
+    offset = 0
+
+    for fractions, count in expanded:
+        if offset == 0:
+            program += fractions
+        else:
+            mapping = {local[i]: primes.PRIMES[first + offset + i] for i in range(count)}
+
+            def rename(n: int) -> int:
+                return prod(mapping.get(p, p)**e for p, e in primes.factorize(n).items())
+
+            program += [(rename(num), rename(den)) for num, den in fractions]
+        offset += count
+
+    return program
+
+def compile_circuit(circuit: Circuit, workers: int | None = None) -> list[Fraction]:
+    """
+    Turns a circuit into fractions with the smallest primes: the names get the first ones (see Circuit.names),
+    then the temporaries of the statements in their order. The statements are expanded in a process pool
+    when workers is given, which gives the very same program.
+    """
+    names = circuit.names()
+    primes_of = dict(zip(names, primes.PRIMES[:len(names)]))
+    first = len(names)
+
+    jobs = [(statement, primes_of, first) for statement in circuit.statements]
+    if workers is None:
+        expanded = [expand(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            expanded = list(pool.map(expand, *zip(*jobs)))
+
+    used = {name for statement in circuit.statements for name in statement.registers}
+    temporaries = [name for name in names if name in used and name not in circuit.registers]
+    drains = [fraction for name in temporaries for fraction in circuits.destroy(primes_of[name])]
+    return link(expanded, first) + drains + circuits.destroy(primes_of[HALT])
+
+def compile_file(filename: str, workers: int | None = None) -> tuple[Circuit, list[Fraction]]:
+    with open(filename, "r", encoding="utf-8") as file:
+        circuit = parse(file)
+    return circuit, compile_circuit(circuit, workers)
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./compiler.py <source> <output_filename> [-O] [-j workers]
+
+    compiles a circuit of the register-machine language (see parse, and sources/ for examples)
+    into a program, written in the binary format of binary.py when the output filename ends with .bin.
+    With -O the program goes through optimizer.py, keeping the registers of the interface and the first state.
+    """
+
+    if len(sys.argv) >= 3:
+        options = sys.argv[3:]
+        workers = int(options[options.index("-j") + 1]) if "-j" in options else None
+        circuit, program = compile_file(sys.argv[1], workers)
+
+        if "-O" in options:
+            program = optimizer.optimize(program, primes.PRIMES[:len(circuit.registers) + 1])
+
+        fractran.program_to_file(sys.argv[2], program)
+        print(f"{len(circuit.statements)} statements -> {len(program)} fractions")
+    else:
+        print("Retry with the filename of the source and the output filename as arguments.")
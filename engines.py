@@ -0,0 +1,852 @@
+from typing import Callable, Iterable
+from dataclasses import dataclass
+from array import array
+from collections import OrderedDict
+from functools import lru_cache, partial
+from math import gcd, prod
+from time import monotonic
+from fractran import Fraction
+import fractran
+import binary
+import primes
+
+type Register = int
+type Factors = dict[int, int]
+type Guard = tuple[tuple[Register, int], ...]
+type Delta = tuple[tuple[Register, int], ...]
+
+NO_STATE = -1
+ANY_STATE = -2
+
+type Entry = tuple[int, Guard, Delta, Register | None]
+
+@dataclass
+class Dispatch:
+    """
+    Which fractions may fire in which state.
+
+    The circuits build programs where every fraction needs exactly one state (begin, E1, A0, ...)
+    which is a register holding a single token, apart from stateless fractions like the drains of destroy.
+    When a single state holds the token all the other states are empty, so the only candidates are
+    the fractions of that state and the stateless ones, which table gives in the order of the program
+    along with the state each of them moves the token to (None for the stateless ones).
+    table[NO_STATE] lists the stateless fractions, for when no state holds the token,
+    and table[ANY_STATE] lists every fraction, for the configurations that do not follow the convention.
+    earlier[f] lists the fractions which could have been tried before f (None when that is all of them).
+    """
+    states: set[Register]
+    table: dict[Register, list[Entry]]
+    earlier: list[list[int]] | None
+
+    def current(self, registers: list[int]) -> Register:
+        """The state holding the token, NO_STATE if there is none and ANY_STATE if the convention does not hold"""
+        tokens = [s for s in self.states if registers[s] != 0]
+        if not tokens:
+            return NO_STATE
+        if len(tokens) == 1 and registers[tokens[0]] == 1:
+            return tokens[0]
+        return ANY_STATE
+
+    def after(self, state: Register, net: dict[Register, int]) -> Register:
+        """The state holding the token once the registers moved by net"""
+        if state == ANY_STATE:
+            return state
+        for i, d in net.items():
+            if d > 0 and i in self.states:
+                return i
+        if net.get(state, 0) < 0:
+            return NO_STATE
+        return state
+
+@dataclass
+class Compiled:
+    """
+    A fractran program turned once and for all into a register machine.
+
+    Every prime occurring in the program gets a dense register index (its position in basis).
+    Each fraction becomes a guard, the (register, amount) pairs its denominator requires,
+    and a delta, the (register, change) pairs applied to the registers when it fires.
+    Fractions are reduced first so that the guards agree with the integer semantics.
+    """
+    basis: list[int]
+    index: dict[int, Register]
+    fractions: list[tuple[Guard, Delta]]
+    dispatch: Dispatch | None = None
+
+def compile_program(program: Iterable[Fraction]) -> Compiled:
+    """Maps the primes of the program to registers and precomputes the guard and delta of every fraction"""
+    def factored():
+        for num, den in program:
+            g = gcd(num, den)
+            yield primes.factorize(num // g), primes.factorize(den // g)
+
+    return compile_factors(factored())
+
+def compile_factors(fractions: Iterable[tuple[Factors, Factors]]) -> Compiled:
+    """
+    Same as compile_program for fractions given by the exponents of their (coprime) numerator and denominator,
+    consumed one at a time so that a huge program never has to be held as integers.
+    """
+    compiled = Compiled([], {}, [])
+
+    def register(p: int) -> Register:
+        if p not in compiled.index:
+            compiled.index[p] = len(compiled.basis)
+            compiled.basis.append(p)
+        return compiled.index[p]
+
+    for c_num, c_den in fractions:
+        guard = tuple((register(p), a) for p, a in sorted(c_den.items()))
+        delta = tuple(
+            (register(p), c_num.get(p, 0) - c_den.get(p, 0))
+            for p in sorted(c_num.keys() | c_den.keys())
+        )
+        compiled.fractions.append((guard, delta))
+
+    compiled.dispatch = index_states(compiled)
+    return compiled
+
+def compile_file(filename: str) -> Compiled:
+    """Compiles a program file (text or binary) as it is read"""
+    with open(filename, "rb") as file:
+        header = file.read(len(binary.MAGIC))
+    if header == binary.MAGIC:
+        return compile_factors(binary.read_factors(filename))
+
+    with open(filename, "r", encoding="utf-8") as file:
+        return compile_program(fractran.read_fractions(file))
+
+def control_states(compiled: Compiled) -> set[Register]:
+    """
+    Finds the registers which behave like the states of circuits.py.
+    The candidates are the registers making up a whole denominator on their own (a goto, a fallback),
+    then the ones breaking the convention are discarded until none is left:
+    a state is needed and produced at most once, a fraction consumes at most one state,
+    produces at most one, and never produces one without consuming one.
+    """
+    fractions = compiled.fractions
+    states = {
+        guard[0][0] for guard, delta in fractions
+        if len(guard) == 1 and guard[0][1] == 1 and any(d > 0 for _, d in delta)
+    }
+
+    while True:
+        wrong = set()
+        for guard, delta in fractions:
+            numerator = dict(guard)
+            for i, d in delta:
+                numerator[i] = numerator.get(i, 0) + d
+
+            consumed = [i for i, a in guard if i in states]
+            produced = [i for i, e in numerator.items() if e > 0 and i in states]
+
+            wrong.update(i for i, a in guard if i in states and a != 1)
+            wrong.update(i for i in produced if numerator[i] != 1)
+            if len(consumed) > 1:
+                wrong.update(consumed)
+            if len(produced) > 1 or (produced and not consumed):
+                wrong.update(produced)
+
+        if not wrong:
+            return states
+        states -= wrong
+
+# how many entries per fraction (on average) the dispatch tables may take
+DISPATCH_BUDGET = 32
+
+def index_states(compiled: Compiled) -> Dispatch:
+    fractions = compiled.fractions
+    states = control_states(compiled)
+    table = {NO_STATE: [], ANY_STATE: []}
+    for s in states:
+        table[s] = []
+
+    # a state is closed once one of its fractions needs nothing but the state (a goto, a fallback):
+    # that one always fires, so the fractions after it can never be tried in this state,
+    # which keeps the stateless fractions (the drains of destroy, usually at the end) out of its table
+    sources = [next((i for i, _ in guard if i in states), None) for guard, _ in fractions]
+    closings = {}
+    for j, (guard, _) in enumerate(fractions):
+        if sources[j] is not None and guard == ((sources[j], 1),):
+            closings.setdefault(sources[j], j)
+
+    # every stateless fraction still goes to the states open at its position (including the states coming later),
+    # which grows quadratically in the long compositions of automata ending with their drains:
+    # past the budget the states are ignored and every step scans the whole program
+    cost, seen, closed = 0, 0, 0
+    positions = sorted(closings.values())
+    for j, source in enumerate(sources):
+        while closed < len(positions) and positions[closed] < j:
+            closed += 1
+        if source is None:
+            cost += len(states) - closed + seen
+            seen += 1
+    if cost > DISPATCH_BUDGET * len(fractions) + (1 << 12):
+        entries = [(j, guard, delta, None) for j, (guard, delta) in enumerate(fractions)]
+        return Dispatch(set(), {NO_STATE: entries, ANY_STATE: entries}, None)
+
+    opened = {s: entries for s, entries in table.items() if s != ANY_STATE}
+    pending = {s: [] for s in states}
+    stateless = []
+    earlier = []
+
+    for j, (guard, delta) in enumerate(fractions):
+        source = sources[j]
+        table[ANY_STATE].append((j, guard, delta, None))
+
+        if source is None:
+            for entries in opened.values():
+                entries.append((j, guard, delta, None))
+            earlier.append(sorted(stateless + [g for fs in pending.values() for g in fs]))
+            stateless.append(j)
+        else:
+            target = next((i for i, d in delta if d > 0 and i in states), None)
+            if target is None:
+                target = source if all(i != source for i, _ in delta) else NO_STATE
+            if source in opened:
+                table[source].append((j, guard, delta, target))
+                pending[source].append(j)
+            earlier.append([g for g, *_ in table[source] if g < j])
+
+            if closings.get(source) == j:
+                del opened[source], pending[source]
+
+    return Dispatch(states, table, earlier)
+
+def to_registers(compiled: Compiled, n: int) -> tuple[list[int], int]:
+    """
+    Splits n over the basis of the program.
+    Returns the registers along with the cofactor made of the primes the program never mentions,
+    which no fraction can ever change.
+    """
+    registers = [0] * len(compiled.basis)
+    for i, p in enumerate(compiled.basis):
+        registers[i], n = primes.valuation(n, p)
+    return registers, n
+
+def from_registers(compiled: Compiled, registers: list[int], cofactor: int = 1) -> int:
+    output = cofactor
+    for p, e in zip(compiled.basis, registers):
+        output *= p**e
+    return output
+
+def factors_to_registers(compiled: Compiled, factors: Factors) -> tuple[list[int], Factors]:
+    """
+    Same as to_registers for an input given by its exponents ({prime: exponent}),
+    the cofactor being kept as exponents too: no integer is ever built.
+    """
+    registers = [0] * len(compiled.basis)
+    cofactor = {}
+    for p, e in factors.items():
+        if p in compiled.index:
+            registers[compiled.index[p]] += e
+        elif e != 0:
+            cofactor[p] = e
+    return registers, cofactor
+
+def registers_to_factors(compiled: Compiled, registers: list[int], cofactor: Factors = {}) -> Factors:
+    factors = dict(cofactor)
+    for p, e in zip(compiled.basis, registers):
+        if e != 0:
+            factors[p] = e
+    return dict(sorted(factors.items()))
+
+SLICE = 1 << 16
+
+def run(compiled: Compiled,
+        registers: list[int],
+        max_steps: int | None = None,
+        deadline: float | None = None) -> int:
+    """
+    Runs the fetch-test-apply loop directly on the registers (which are modified in place)
+    until no fraction applies. Returns the number of steps taken.
+    Only the candidates of the current state are tried (see Dispatch).
+
+    The run also stops after max_steps steps, or once time.monotonic() went past deadline
+    (checked every SLICE steps), use halted to tell these apart from a real ending.
+    """
+    table = compiled.dispatch.table
+    state = compiled.dispatch.current(registers)
+    steps = 0
+
+    while True:
+        stop = max_steps
+        if deadline is not None:
+            stop = steps + SLICE if max_steps is None else min(max_steps, steps + SLICE)
+        limit = -1 if stop is None else stop
+
+        while steps != limit:
+            for _, guard, delta, move in table[state]:
+                for i, a in guard:
+                    if registers[i] < a:
+                        break
+                else:
+                    for i, d in delta:
+                        registers[i] += d
+                    if move is not None:
+                        state = move
+                    break
+            else:
+                return steps
+            steps += 1
+
+        if steps == max_steps or monotonic() >= deadline:
+            return steps
+
+def halted(compiled: Compiled, registers: list[int]) -> bool:
+    """Whether no fraction applies anymore"""
+    state = compiled.dispatch.current(registers)
+    return not any(
+        all(registers[i] >= a for i, a in guard)
+        for _, guard, _, _ in compiled.dispatch.table[state]
+    )
+
+# the native registers are checked every CHECK_EVERY steps, and moved to Python integers
+# once they could overflow an int64 before the next check
+CHECK_EVERY = 1 << 10
+INT64_MAX = (1 << 63) - 1
+
+def run_native(compiled: Compiled,
+               registers: list[int],
+               max_steps: int | None = None,
+               deadline: float | None = None) -> int:
+    """
+    Same as run, with the registers held in a preallocated array('q') of native integers
+    as long as they fit: the steps only read and write machine words of the buffer.
+    Every CHECK_EVERY steps the largest register is compared with the most the fractions can add until the next check,
+    and when it gets too close the run goes on with run on Python integers (exactly where it was),
+    so that an exponent growing past 64 bits never overflows.
+    The registers (modified in place) are written back when the run stops.
+
+    It is not one of RUNNERS: in CPython every read of the buffer boxes an int, which makes it slower than run
+    (and much slower than run_jit), it stays as the reference of that overflow rule (see lockstep.py).
+    """
+    growth = max((d for _, delta in compiled.fractions for _, d in delta if d > 0), default=0)
+    bound = INT64_MAX - CHECK_EVERY * growth
+    if max(registers, default=0) > bound:
+        return run(compiled, registers, max_steps, deadline)
+
+    native = array("q", registers)
+    table = compiled.dispatch.table
+    state = compiled.dispatch.current(registers)
+    steps = 0
+
+    while True:
+        stop = steps + CHECK_EVERY if max_steps is None else min(max_steps, steps + CHECK_EVERY)
+
+        while steps != stop:
+            for _, guard, delta, move in table[state]:
+                for i, a in guard:
+                    if native[i] < a:
+                        break
+                else:
+                    for i, d in delta:
+                        native[i] += d
+                    if move is not None:
+                        state = move
+                    break
+            else:
+                registers[:] = native.tolist()
+                return steps
+            steps += 1
+
+        registers[:] = native.tolist()
+        if steps == max_steps or (deadline is not None and monotonic() >= deadline):
+            return steps
+        if max(native, default=0) > bound:
+            budget = None if max_steps is None else max_steps - steps
+            return steps + run(compiled, registers, budget, deadline)
+
+def run_jit(compiled: Compiled,
+            registers: list[int],
+            max_steps: int | None = None,
+            deadline: float | None = None) -> int:
+    """Same as run, with a Python function generated for this very program (see jit.py)"""
+    return jit_runner(compiled)(registers, max_steps, deadline)
+
+def jit_runner(compiled: Compiled) -> Callable[..., int]:
+    import jit
+    return jit.runner(compiled)
+
+def evaluate_jit(program: list[Fraction], n: int) -> int:
+    """Same as evaluate_compiled, running the function generated for the program (see jit.py)"""
+    compiled = compile_program(program)
+    registers, cofactor = to_registers(compiled, n)
+    run_jit(compiled, registers)
+    return from_registers(compiled, registers, cofactor)
+
+def evaluate_compiled(program: list[Fraction], n: int) -> int:
+    """
+    Interpreter working on a compiled version of the program.
+    Like evaluate2 it keeps registers instead of the integer itself,
+    but they are stored in a flat list indexed by precomputed positions,
+    so a step costs a few list accesses instead of hashing primes into Counters.
+    """
+    compiled = compile_program(program)
+    registers, cofactor = to_registers(compiled, n)
+    run(compiled, registers)
+    return from_registers(compiled, registers, cofactor)
+
+@dataclass(eq=False)
+class Cycle:
+    """
+    A loop of the program: the positions it goes through during one turn and its net effect.
+
+    A position is (fraction, 1, offset) when a single fraction fires
+    and (inner cycle, turns, offset) when an inner loop is applied in bulk,
+    offset being how much the registers moved since the beginning of the turn.
+    The turns of the inner cycles only depend on the registers of context,
+    which the cycle leaves unchanged, hence a turn is always the same translation of the registers.
+    """
+    positions: list[tuple["int | Cycle", int, dict[Register, int]]]
+    net: dict[Register, int]
+    steps: int
+    context: tuple[Register, ...] = ()
+
+def find_cycles(compiled: Compiled) -> list[list[Cycle]]:
+    """
+    Statically finds, for every fraction, the loops starting with it which may fire many times in a row:
+    the fraction alone (like the (1, x) drain of circuits.destroy)
+    and the pairs whose second fraction may be enabled by the first one, on top of what the first one needed
+    (like (dst * E, src * begin), (begin, E) in circuits.accumulate_and_destroy).
+    The second fraction of a pair must be tried in the states the first one leads to,
+    a stateless fraction past the closing of a state never firing there.
+    """
+    fractions = compiled.fractions
+    tried = {s: {entry[0] for entry in entries} for s, entries in compiled.dispatch.table.items() if s != ANY_STATE}
+    leads = [[] for _ in fractions]
+    for s, entries in compiled.dispatch.table.items():
+        if s != ANY_STATE:
+            for j, _, _, move in entries:
+                leads[j].append(s if move is None else move)
+
+    by_register = {}
+    unguarded = []
+    for b, (guard, _) in enumerate(fractions):
+        if guard:
+            by_register.setdefault(guard[0][0], []).append(b)
+        else:
+            unguarded.append(b)
+
+    cycles = []
+    for j, (guard, delta) in enumerate(fractions):
+        found = []
+        if delta:
+            found.append(Cycle([(j, 1, {})], dict(delta), 1))
+
+        after = dict(guard)
+        for i, d in delta:
+            after[i] = after.get(i, 0) + d
+
+        needed = dict(guard)
+        candidates = sorted(set(unguarded + [
+            b for i, v in after.items() if v > 0 or i in needed for b in by_register.get(i, [])
+        ]))
+        for b in candidates:
+            if b == j or any(after.get(i, 0) < a and i not in needed for i, a in fractions[b][0]):
+                continue
+            if any(b not in tried[s] for s in leads[j]):
+                continue
+            net = dict(delta)
+            for i, d in fractions[b][1]:
+                net[i] = net.get(i, 0) + d
+            net = {i: d for i, d in net.items() if d != 0}
+            if net:
+                found.append(Cycle([(j, 1, {}), (b, 1, dict(delta))], net, 2))
+
+        cycles.append(found)
+
+    return cycles
+
+type Dependencies = set[frozenset[Register]]
+
+def repeats(compiled: Compiled,
+            cycle: Cycle,
+            registers: list[int],
+            most: int | None = None,
+            indexed: bool = False) -> tuple[int, Dependencies]:
+    """
+    Number of turns the cycle is guaranteed to make from the registers,
+    knowing that its first position is the one happening right now.
+
+    After t turns every register has moved linearly (by t times the net effect),
+    so each single fraction of the cycle stays valid as long as it still applies
+    and every fraction written before it is still blocked:
+    both give simple bounds on t, the minimum of which is the answer.
+    When nothing bounds the cycle (a loop that never ends) 0 is returned unless most is given.
+
+    Also returns what this number depends on, as sets of registers at least one of which
+    must keep its value for the answer to stay the same.
+
+    When indexed is set, a single state is known to hold the token
+    and only the candidates of Dispatch.earlier need to be blocked.
+    """
+    fractions = compiled.fractions
+    earlier = compiled.dispatch.earlier if indexed else None
+    net = cycle.net
+    k = most
+    dependencies = {frozenset((i,)) for i in cycle.context}
+
+    for f, _, offset in cycle.positions:
+        if isinstance(f, Cycle):
+            continue
+        for i, a in fractions[f][0]:
+            dependencies.add(frozenset((i,)))
+            c = registers[i] + offset.get(i, 0)
+            if c < a:
+                return 0, dependencies
+            d = net.get(i, 0)
+            if d < 0:
+                t = (c - a) // -d + 1
+                if k is None or t < k:
+                    k = t
+
+    if k is not None and k * cycle.steps < 2:
+        return k, dependencies
+
+    for f, _, offset in cycle.positions:
+        if isinstance(f, Cycle):
+            continue
+        for g in (range(f) if earlier is None else earlier[f]):
+            limit = 0
+            forever = []
+            for i, a in fractions[g][0]:
+                c = registers[i] + offset.get(i, 0)
+                if c < a:
+                    d = net.get(i, 0)
+                    if d <= 0:
+                        forever.append(i)
+                    else:
+                        limit = max(limit, -((c - a) // d))
+            if forever:
+                dependencies.add(frozenset(forever))
+                continue
+            dependencies.update(frozenset((i,)) for i, _ in fractions[g][0])
+            if limit == 0:
+                return 0, dependencies
+            if k is None or limit < k:
+                k = limit
+
+    return (0 if k is None else k), dependencies
+
+def run_accelerated(compiled: Compiled,
+                    registers: list[int],
+                    cycles: list[list[Cycle]] | None = None,
+                    max_steps: int | None = None,
+                    deadline: float | None = None) -> int:
+    """
+    Same as run, but whenever the applying fraction starts a cycle
+    all the turns the cycle is guaranteed to make are applied at once.
+    Returns the number of steps (of the plain interpreter) taken,
+    a cycle is never applied past max_steps so that the run stops exactly there.
+    """
+    dispatch = compiled.dispatch
+    if cycles is None:
+        cycles = find_cycles(compiled)
+    state = dispatch.current(registers)
+    indexed = state != ANY_STATE
+    steps = 0
+    ticks = 0
+
+    while steps != max_steps:
+        ticks += 1
+        if ticks == 1024:
+            ticks = 0
+            if deadline is not None and monotonic() >= deadline:
+                return steps
+
+        for j, guard, delta, move in dispatch.table[state]:
+            for i, a in guard:
+                if registers[i] < a:
+                    break
+            else:
+                break
+        else:
+            return steps
+
+        for cycle in cycles[j]:
+            most = None if max_steps is None else (max_steps - steps) // cycle.steps
+            k, _ = repeats(compiled, cycle, registers, most, indexed)
+            if k * cycle.steps >= 2:
+                for i, d in cycle.net.items():
+                    registers[i] += k * d
+                state = dispatch.after(state, cycle.net)
+                steps += k * cycle.steps
+                break
+        else:
+            for i, d in delta:
+                registers[i] += d
+            if move is not None:
+                state = move
+            steps += 1
+
+    return steps
+
+def evaluate_accelerated(program: list[Fraction], n: int) -> int:
+    """
+    Interpreter on the compiled program which applies the small loops of the program in bulk.
+    The generated circuits move registers one unit at a time (copy, clear, accumulate, ...),
+    here such a loop costs a handful of operations whatever the value of the registers,
+    so the running time follows the control flow of the program rather than the size of its registers.
+    """
+    compiled = compile_program(program)
+    registers, cofactor = to_registers(compiled, n)
+    run_accelerated(compiled, registers)
+    return from_registers(compiled, registers, cofactor)
+
+type Step = tuple[int, Cycle | None, int, Dependencies | None]
+
+class Macro:
+    """
+    Macro-step engine: on top of the small cycles of run_accelerated,
+    it learns the bigger loops of a program while running them and remembers them.
+
+    Every macro-step (a single fraction or a cycle applied in bulk) is written down on a trail.
+    When the same fraction starts a macro-step again, the trail since its previous occurrence
+    is one turn of a loop, entered and left through that fraction.
+    If the inner loops run in bulk during the turn do not depend on anything the turn changes,
+    the turn is a translation of the registers and it becomes a Cycle,
+    valid on the domain given by the linear bounds of repeats.
+    These summaries are kept in a LRU cache keyed on the registers their inner loops depend on,
+    so that running the same loop again (e.g. the copy inside a multiply) costs a lookup and a vector update.
+    Since a summarized loop is written on the trail as a single macro-step,
+    nested loops get summarized level after level.
+    """
+
+    def __init__(self, compiled: Compiled, maxsize: int = 4096, trail: int = 256):
+        self.compiled = compiled
+        self.cycles = find_cycles(compiled)
+        self.maxsize = maxsize
+        self.trail = trail
+        self.cache: OrderedDict[tuple, Cycle] = OrderedDict()
+        self.contexts: dict[int, set[tuple[Register, ...]]] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, j: int, registers: list[int], indexed: bool) -> Cycle | None:
+        for context in self.contexts.get((indexed, j), ()):
+            key = (indexed, j, context, tuple(registers[i] for i in context))
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return self.cache[key]
+        return None
+
+    def store(self, j: int, cycle: Cycle, registers: list[int], indexed: bool):
+        key = (indexed, j, cycle.context, tuple(registers[i] for i in cycle.context))
+        self.contexts.setdefault((indexed, j), set()).add(cycle.context)
+        self.cache[key] = cycle
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    def learn(self, turn: list[Step]) -> Cycle | None:
+        """Summarizes one turn of a loop, if the turn is a translation of the registers"""
+        fractions = self.compiled.fractions
+        positions = []
+        offset = {}
+        steps = 0
+
+        for f, cycle, turns, _ in turn:
+            if cycle is None:
+                positions.append((f, 1, dict(offset)))
+                for i, d in fractions[f][1]:
+                    offset[i] = offset.get(i, 0) + d
+                steps += 1
+            else:
+                positions.append((cycle, turns, dict(offset)))
+                for i, d in cycle.net.items():
+                    offset[i] = offset.get(i, 0) + turns * d
+                steps += turns * cycle.steps
+
+        net = {i: d for i, d in offset.items() if d != 0}
+        if not net:
+            return None
+
+        context = set()
+        for _, cycle, _, dependencies in turn:
+            if cycle is None:
+                continue
+            for alternatives in dependencies:
+                stable = [i for i in alternatives if i not in net]
+                if not stable:
+                    return None
+                context.add(min(stable))
+
+        return Cycle(positions, net, steps, tuple(sorted(context)))
+
+    def run(self,
+            registers: list[int],
+            max_steps: int | None = None,
+            deadline: float | None = None) -> int:
+        """
+        Runs the program on the registers (modified in place), returns the number of steps taken.
+        max_steps and deadline work as in run_accelerated.
+        """
+        compiled = self.compiled
+        dispatch = compiled.dispatch
+        trail: list[Step] = []
+        seen: dict[int, int] = {}
+        state = dispatch.current(registers)
+        indexed = state != ANY_STATE
+        learning = True
+        steps = 0
+        ticks = 0
+
+        def most(cycle: Cycle) -> int | None:
+            return None if max_steps is None else (max_steps - steps) // cycle.steps
+
+        while steps != max_steps:
+            ticks += 1
+            if ticks == 1024:
+                ticks = 0
+                if deadline is not None and monotonic() >= deadline:
+                    return steps
+
+            for j, guard, delta, move in dispatch.table[state]:
+                for i, a in guard:
+                    if registers[i] < a:
+                        break
+                else:
+                    break
+            else:
+                return steps
+
+            if learning and j in seen:
+                s = seen[j]
+                cycle = self.learn(trail[s:])
+                if cycle is not None:
+                    self.misses += 1
+                    self.store(j, cycle, registers, indexed)
+                    k, _ = repeats(compiled, cycle, registers, most(cycle), indexed)
+                    if k >= 1 and k == most(cycle):
+                        learning = False
+                    if k >= 1:
+                        start = registers[:]
+                        for i, d in cycle.net.items():
+                            start[i] -= d
+                            registers[i] += k * d
+                        state = dispatch.after(state, cycle.net)
+                        steps += k * cycle.steps
+
+                        total, dependencies = repeats(compiled, cycle, start, indexed=indexed)
+                        for f in [f for f, t in seen.items() if t >= s]:
+                            del seen[f]
+                        if total == k + 1:
+                            del trail[s:]
+                            trail.append((j, cycle, total, dependencies))
+                            seen[j] = s
+                        else:
+                            trail.clear()
+                        continue
+
+            step = None
+            cycle = self.lookup(j, registers, indexed)
+            if cycle is not None:
+                k, dependencies = repeats(compiled, cycle, registers, most(cycle), indexed)
+                if k >= 1:
+                    self.hits += 1
+                    step = (j, cycle, k, dependencies)
+
+            if step is None:
+                for cycle in self.cycles[j]:
+                    k, dependencies = repeats(compiled, cycle, registers, most(cycle), indexed)
+                    if k * cycle.steps >= 2:
+                        step = (j, cycle, k, dependencies)
+                        break
+
+            if step is not None and step[2] == most(step[1]):
+                learning = False
+
+            if step is None:
+                for i, d in delta:
+                    registers[i] += d
+                if move is not None:
+                    state = move
+                steps += 1
+                step = (j, None, 1, None)
+            else:
+                _, cycle, k, _ = step
+                for i, d in cycle.net.items():
+                    registers[i] += k * d
+                state = dispatch.after(state, cycle.net)
+                steps += k * cycle.steps
+
+            if len(trail) >= self.trail or not learning:
+                trail.clear()
+                seen.clear()
+            seen[j] = len(trail)
+            trail.append(step)
+
+        return steps
+
+@lru_cache(maxsize=16)
+def macro_engine(program: tuple[Fraction, ...]) -> Macro:
+    """The macro engine of a program, shared between the runs so that they share what was learned"""
+    return Macro(compile_program(program))
+
+def evaluate_macro(program: list[Fraction], n: int) -> int:
+    """
+    Interpreter summarizing the loops of the program as it runs them (see Macro).
+    The sub-automata of circuits.py are reused many times (a copy inside a multiply inside a multiply_on ...),
+    once a loop has been summarized each of its later runs costs one lookup,
+    and the loops whose turns always do the same thing (like the outer loop of a multiply)
+    are applied in bulk as a whole.
+    """
+    engine = macro_engine(tuple(program))
+    registers, cofactor = to_registers(engine.compiled, n)
+    engine.run(registers)
+    return from_registers(engine.compiled, registers, cofactor)
+
+type Runner = Callable[..., int]
+
+# engines working on compiled programs: each entry prepares a compiled program once and returns
+# a function running it on registers, with the max_steps and deadline options of run
+RUNNERS = {
+    "compiled": lambda compiled: partial(run, compiled),
+    "jit": jit_runner,
+    "accelerated": lambda compiled: partial(run_accelerated, compiled, cycles=find_cycles(compiled)),
+    "macro": lambda compiled: Macro(compiled).run,
+}
+
+# every interpreter by name, all of them taking a program and an integer and returning the output
+ENGINES = {
+    "evaluate": fractran.evaluate,
+    "evaluate2": fractran.evaluate2,
+    "compiled": evaluate_compiled,
+    "jit": evaluate_jit,
+    "accelerated": evaluate_accelerated,
+    "macro": evaluate_macro,
+}
+
+def runner_for(program: list[Fraction],
+               engine: str = "macro",
+               compiled: Compiled | None = None) -> tuple[Compiled, Runner]:
+    """
+    The compiled program and a runner of RUNNERS for it,
+    the macro engine being shared with the other runs of the same program (see macro_engine).
+    """
+    if compiled is None and engine == "macro":
+        macro = macro_engine(tuple(program))
+        return macro.compiled, macro.run
+    compiled = compile_program(program) if compiled is None else compiled
+    return compiled, RUNNERS[engine](compiled)
+
+def evaluate_factors(program: list[Fraction],
+                     factors: Factors,
+                     engine: str = "macro",
+                     compiled: Compiled | None = None) -> Factors:
+    """
+    Evaluates program on the input whose exponents are given ({prime: exponent})
+    and returns the exponents of the output, so that huge inputs like 2^1000000
+    never have to be built (nor factorized back) as integers.
+    Only the engines of RUNNERS work that way, the others get the integer.
+    The compiled program can be given when it is already known (see cache.py).
+    """
+    if engine not in RUNNERS:
+        output = ENGINES[engine](program, prod(p**e for p, e in factors.items()))
+        return primes.factorize(output, fractran.basis(program))
+
+    compiled, runner = runner_for(program, engine, compiled)
+    registers, cofactor = factors_to_registers(compiled, factors)
+    runner(registers)
+    return registers_to_factors(compiled, registers, cofactor)
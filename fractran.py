@@ -1,36 +1,104 @@
 #!/usr/bin/env python3
 
-from typing import Callable
+from typing import Callable, Iterable, Iterator
 from collections import Counter
+from time import monotonic
+from functools import lru_cache
+from math import gcd, inf
 import primes
 import pretty
 import sys
 
 type Fraction = tuple[int, int]
 
+@lru_cache(maxsize=64)
+def prepare(program: tuple[Fraction, ...]) -> tuple[list[tuple[int, int, tuple, tuple, bool]], set[int]]:
+    """
+    The fractions of program as evaluate tries them: reduced, with the primes (and exponents) of their denominators
+    and how a step moves the valuations at these primes. Kept for the last programs, as runs are often short.
+
+    Only the primes found cheaply are tracked (see primes.trial_division, the primes of the numerators being tried first):
+    a denominator left with a cofactor (a product of large primes, which pollard_rho could take ages to split)
+    is flagged, evaluate then tests the whole denominator as the plain rule does.
+    """
+    def cheap(n: int, basis: Iterable[int]) -> tuple[dict[int, int], int]:
+        factors, rest = primes.trial_division(n, basis)
+        if rest > 1 and primes.is_prime(rest):
+            factors[rest] = factors.get(rest, 0) + 1
+            rest = 1
+        return factors, rest
+
+    reduced = [(num // gcd(num, den), den // gcd(num, den)) for num, den in program]
+    basis = {p for num, _ in reduced for p in cheap(num, ())[0]}
+    splits = [cheap(den, basis) for _, den in reduced]
+    tracked = {p for factors, _ in splits for p in factors}
+
+    fractions = []
+    for (num, den), (factors, rest) in zip(reduced, splits):
+        # a tracked prime may still divide the cofactor, the denominator of another fraction giving it away
+        for p in tracked if rest > 1 else ():
+            e, rest = primes.valuation(rest, p)
+            if e:
+                factors[p] = factors.get(p, 0) + e
+        guard = tuple(sorted(factors.items()))
+        changes = Counter(primes.trial_division(num, tracked)[0])
+        changes.subtract(factors)
+        delta = tuple((p, d) for p, d in changes.items() if p in tracked)
+        fractions.append((num, den, guard, delta, rest == 1))
+    return fractions, tracked
+
 def evaluate(program: list[Fraction],
              n: int,
-             action: Callable[[int], None] = lambda _ : ()) -> int:
+             action: Callable[[int], None] = lambda _ : (),
+             max_steps: int | None = None,
+             max_seconds: float | None = None) -> int:
     """
     Default interpreter for a fractran program.
-    It "simulates" it without any clever trick, simply by following the rules.
+    It "simulates" it by following the rules, n being the integer itself all along.
+
+    Whether num / den applies only depends on n being divisible by den / gcd(num, den),
+    that is on the valuations of n at the primes of the reduced denominators: these few small integers are kept
+    up to date after every step (a step moves them by fixed amounts), so that the fractions which do not apply
+    cost a couple of comparisons and only the one which does touches n, with a single division and multiplication
+    by small integers instead of a multiplication and a division of n per fraction tried
+    (the denominators with large prime factors are still divided as a whole, see prepare).
 
     The action parameter (by default the function doing nothing) is an arbitrary function
     which can (for instance) be used to debug a fractran program.
+
+    The run stops after max_steps steps or max_seconds seconds (checked every 1024 steps),
+    returning the integer reached at that point instead of the output (see checkpoint.py to go on from there).
     """
+    deadline = None if max_seconds is None else monotonic() + max_seconds
+    steps = 0
+
+    fractions, tracked = prepare(tuple(program))
+    valuations = {p: primes.valuation(n, p)[0] if n else inf for p in tracked}
 
     while True:
         action(n)
-        for num, den in program:
-            if (num * n) % den == 0:
-                n = (num * n) // den
+        if steps == max_steps or (deadline is not None and steps % 1024 == 0 and monotonic() >= deadline):
+            return n
+        for num, den, guard, delta, whole in fractions:
+            for p, e in guard:
+                if valuations[p] < e:
+                    break
+            else:
+                if not whole and n % den != 0:
+                    continue
+                n = n // den * num
+                for p, d in delta:
+                    valuations[p] += d
                 break
         else:
             return n
+        steps += 1
 
 def evaluate2(program: list[Fraction],
               n: int,
-              action: Callable[[Counter], None] = lambda _ : ()) -> int:
+              action: Callable[[Counter], None] = lambda _ : (),
+              max_steps: int | None = None,
+              max_seconds: float | None = None) -> int:
     """
     Another interpreter for a fractran program.
     It views the input n as well as the fractions as their decomposition in prime factors
@@ -41,16 +109,23 @@ def evaluate2(program: list[Fraction],
     However, this becomes way faster than the other version whenever the programs are trickier,
     and when n becomes very large ; because at that point the "O(1) arithmetic operations"
     proposition becomes false.
+
+    It stops after max_steps steps or max_seconds seconds, like evaluate.
     """
+    deadline = None if max_seconds is None else monotonic() + max_seconds
+    steps = 0
 
-    registers = Counter(primes.prime_factors(n))
+    # reduced first, for the registers to follow the integer (6/3 applies to any n)
     counters = [
-        (Counter(primes.prime_factors(num)), Counter(primes.prime_factors(den)))
+        (Counter(primes.factorize(num // gcd(num, den))), Counter(primes.factorize(den // gcd(num, den))))
         for num, den in program
     ]
+    registers = Counter(primes.factorize(n, {p for c_num, c_den in counters for p in c_num | c_den}))
 
     while True:
         action(registers)
+        if steps == max_steps or (deadline is not None and steps % 1024 == 0 and monotonic() >= deadline):
+            break
         for c_num, c_den in counters:
 
             for k_den in c_den:
@@ -65,21 +140,58 @@ def evaluate2(program: list[Fraction],
 
                 break
         else:
-            output = 1
-            for key in registers:
-                output *= (key**registers[key])
-            return output
+            break
+        steps += 1
+
+    output = 1
+    for key in registers:
+        output *= (key**registers[key])
+    return output
+
+def basis(program: list[Fraction]) -> list[int]:
+    """The primes occurring in the fractions of program"""
+    return sorted({p for num, den in program for p in primes.factorize(num * den)})
+
+def read_fractions(lines: Iterable[str]) -> Iterator[Fraction]:
+    """
+    Parses the fractions one line at a time, so that a huge program can be consumed as it is read.
+    Blank lines are skipped and anything after a # is a comment.
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.split("#", 1)[0].strip()
+        if not line:
+            continue
+        try:
+            num, den = map(int, line.split("/"))
+        except ValueError:
+            raise ValueError(f"line {number}: {line!r} is not a fraction") from None
+        yield num, den
 
 def program_from_file(filename: str) -> list[Fraction]:
-    """Reads a fractran file (which contains only fractions of integers) and returns the fractions"""
-    program = []
+    """
+    Reads a fractran file (which contains only fractions of integers, see read_fractions) and returns the fractions.
+    The binary files of binary.py are read as well.
+    """
+    import binary
+    with open(filename, "rb") as file:
+        header = file.read(len(binary.MAGIC))
+
+    if header == binary.MAGIC:
+        return binary.read_program(filename)
 
     with open(filename, "r", encoding="utf-8") as file:
-            for line in file:
-                num, den = map(int, line.replace(" ", "").split("/"))
-                program.append((num, den))
-    
-    return program
+        return list(read_fractions(file))
+
+def program_to_file(filename: str, program: Iterable[Fraction]):
+    """Writes the fractions one per line, or in the binary format of binary.py when filename ends with .bin"""
+    if filename.endswith(".bin"):
+        import binary
+        binary.write_program(filename, program)
+        return
+
+    with open(filename, "w", encoding="utf-8") as file:
+        for num, den in program:
+            file.write(f"{num} / {den}\n")
 
 if __name__ == "__main__":
     """
@@ -87,13 +199,24 @@ if __name__ == "__main__":
 
     1) ./fractran.py <filename>        <- uses the main interpreter
     2) ./fractran.py <filename> -E     <- uses the secondary interpreter
-    3) ./fractran.py <filename> -D     <- uses the debug mode (main interpreter unless -E is written before -D)
+    3) ./fractran.py <filename> -D     <- uses the debug mode, printing the last steps of the run once it is over
+                                          (see tracing.py, -S 100 only keeps one step out of 100)
+    4) ./fractran.py <filename> -T <tracefile>
+                                       <- same but writes the trace to a file, to be read by ./tracing.py <tracefile>
+    5) ./fractran.py <filename> -e macro
+                                       <- uses one of the compiled engines (compiled, jit, accelerated, macro),
+                                          the input and the output being kept as exponents: 2^1000000 is fine
+    6) ./fractran.py <filename> -P     <- prints a profile of the run after its output
+                                          (steps, hits of each fraction, steps and time spent in each state)
     
-    Other arguments can be writter after -D to name some prime integers
+    The modes using the compiled engines (-e, -P, -D, -T) keep the compiled programs in ~/.cache/fractran
+    (or in the directory given by the FRACTRAN_CACHE environment variable), see cache.py.
+
+    Other arguments can be writter after -D (or -P) to name some prime integers
     which can be useful if you "know" a fractran program and would like to debug it.
 
     For instance,
-    4) ./fractran.py <filename> -D a=2 b=3 c=5
+    7) ./fractran.py <filename> -D a=2 b=3 c=5
     activates the debug mode and in the debug prints
     you can see the variables "2" renamed to "a" instead of "v2" (and so on).
     """
@@ -102,22 +225,53 @@ if __name__ == "__main__":
         filename = sys.argv[1]
 
         print("Input:")
-        n = pretty.pretty_prime_factors_to_int(input())
+        text = input()
 
-        debug = ("-D" in sys.argv)
+        if "-e" in sys.argv:
+            import cache, engines
+            engine = sys.argv[sys.argv.index("-e")+1]
+            factors = pretty.pretty_prime_factors_to_factors(text)
+            program, compiled = cache.load(filename)
+            output = engines.evaluate_factors(program, factors, engine, compiled)
+            print(pretty.factors_to_pretty_prime_factors(output))
+            sys.exit()
 
-        if debug:
-            names = {}
-            for i in range(sys.argv.index("-D")+1, len(sys.argv)):
-                a, b = sys.argv[i].split("=")
-                names[int(b)] = a
+        n = pretty.pretty_prime_factors_to_int(text)
 
-            action = lambda n : print(pretty.int_to_pretty_registers(n, names, True))
-        else:
-            action = lambda _ : ()
+        names = {}
+        for option in ("-D", "-P"):
+            if option in sys.argv:
+                for argument in sys.argv[sys.argv.index(option)+1:]:
+                    if "=" in argument:
+                        a, b = argument.split("=")
+                        names[int(b)] = a
+
+        if "-P" in sys.argv:
+            import cache, profiler
+            program, compiled = cache.load(filename)
+            output, profile = profiler.profile(program, n, compiled=compiled)
+            print(1 if output == 1 else pretty.int_to_pretty_prime_factors(output, basis(program)))
+            print()
+            print(profile.report(program, names))
+            sys.exit()
+
+        if "-D" in sys.argv or "-T" in sys.argv:
+            import cache, tracing
+            every = int(sys.argv[sys.argv.index("-S")+1]) if "-S" in sys.argv else 1
+            program, compiled = cache.load(filename)
+            output, trace = tracing.record(program, n, every=every, compiled=compiled)
+
+            if "-T" in sys.argv:
+                trace.save(sys.argv[sys.argv.index("-T")+1])
+            else:
+                for line in trace.describe(names):
+                    print(line)
+
+            print(1 if output == 1 else pretty.int_to_pretty_prime_factors(output))
+            sys.exit()
 
         if "-O" not in sys.argv:
-            output = evaluate(program_from_file(filename), n, action)
+            output = evaluate(program_from_file(filename), n)
         else:
             output = evaluate2(program_from_file(filename), n)
 
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Callable, Iterator
+from math import prod
+from fractran import Fraction
+import compiler
+import engines
+import lockstep
+import batch
+import pretty
+import primes
+import random
+import os
+import sys
+
+# what one engine did with a case: the output (as exponents), the steps taken and whether it halted
+type Outcome = tuple[engines.Factors, int, bool]
+
+@dataclass
+class Case:
+    program: list[Fraction]
+    n: int
+
+@dataclass
+class Disagreement:
+    """A case on which the engines did not all do the same, once shrunk (see shrink), and what each one did"""
+    seed: str
+    case: Case
+    outcomes: dict[str, Outcome]
+
+    def describe(self) -> list[str]:
+        lines = [f"seed {self.seed}: input {pretty.int_to_pretty_prime_factors(self.case.n) or 1}"]
+        lines += [f"    {num} / {den}" for num, den in self.case.program]
+        for engine, (output, steps, halted) in self.outcomes.items():
+            state = "halted" if halted else "stopped"
+            lines.append(f"  {engine}: {pretty.factors_to_pretty_prime_factors(output) or 1} ({state} after {steps} steps)")
+        return lines
+
+def random_program(rng: random.Random, size: int = 6, width: int = 4, exponent: int = 3) -> list[Fraction]:
+    """Fractions over the first width primes, with exponents up to exponent, not necessarily reduced"""
+    basis = primes.PRIMES[:width]
+
+    def random_int() -> int:
+        return prod(p**rng.randint(0, exponent) for p in basis if rng.random() < 0.5)
+
+    return [(random_int(), random_int()) for _ in range(rng.randint(1, size))]
+
+def random_circuit(rng: random.Random, size: int = 5, width: int = 4) -> compiler.Circuit:
+    """Statements of the register-machine language of compiler.py, with random operations, registers and targets"""
+    registers = [f"r{i}" for i in range(width)]
+    labels = [f"L{i}" for i in range(rng.randint(1, size))]
+    circuit = compiler.Circuit(registers[:rng.randint(1, width)])
+
+    for label in labels:
+        operation = rng.choice(list(compiler.OPERATIONS))
+        _, arity, outcomes = compiler.OPERATIONS[operation]
+        targets = [rng.choice(labels + [compiler.HALT]) for _ in range(outcomes)]
+        circuit.statements.append(compiler.Statement(
+            label, operation, rng.sample(registers, arity), targets, rng.randint(1, 3)
+        ))
+
+    return circuit
+
+def random_case(rng: random.Random, exponent: int = 6) -> Case:
+    """A random program or a random circuit (half of the time each), with a random input over its primes"""
+    if rng.random() < 0.5:
+        program = random_program(rng)
+        basis = primes.PRIMES[:5]
+    else:
+        circuit = random_circuit(rng)
+        program = compiler.compile_circuit(circuit)
+        # the interface registers and the first state, as for the programs of circuits.py
+        basis = primes.PRIMES[:len(circuit.registers)]
+        return Case(program, prod(p**rng.randint(0, exponent) for p in basis) * primes.PRIMES[len(circuit.registers)])
+
+    return Case(program, prod(p**rng.randint(0, exponent) for p in basis))
+
+def run_lockstep(case: Case, max_steps: int) -> tuple[int, int, bool]:
+    """The case run by lockstep.run_lockstep, as the only row of its matrix"""
+    compiled = engines.compile_program(case.program)
+    registers, cofactor = engines.to_registers(compiled, case.n)
+    [steps] = lockstep.run_lockstep(compiled, [registers], max_steps)
+    return engines.from_registers(compiled, registers, cofactor), steps, engines.halted(compiled, registers)
+
+def default_names() -> list[str]:
+    """Every engine of engines.ENGINES, and the lockstep one of lockstep.py when numpy is there"""
+    return list(engines.ENGINES) + (["lockstep"] if lockstep.np is not None else [])
+
+def outcomes(case: Case, names: list[str], max_steps: int) -> dict[str, Outcome]:
+    result = {}
+    for engine in names:
+        if engine == "lockstep":
+            output, steps, halted = run_lockstep(case, max_steps)
+        else:
+            output, steps, halted = batch.prepare(case.program, engine)(case.n, max_steps, None)
+        result[engine] = pretty.int_to_factors(output), steps, halted
+    return result
+
+def agree(found: dict[str, Outcome]) -> bool:
+    return len(set((tuple(sorted(o.items())), s, h) for o, s, h in found.values())) == 1
+
+def smaller(case: Case) -> Iterator[Case]:
+    """The cases one step simpler than case: a fraction less, a smaller exponent in the input or in a fraction"""
+    program, n = case.program, case.n
+
+    for i in range(len(program)):
+        yield Case(program[:i] + program[i+1:], n)
+
+    for p in pretty.int_to_factors(n):
+        yield Case(program, n // p)
+
+    for i, (num, den) in enumerate(program):
+        for p in primes.factorize(num):
+            yield Case(program[:i] + [(num // p, den)] + program[i+1:], n)
+        for p in primes.factorize(den):
+            yield Case(program[:i] + [(num, den // p)] + program[i+1:], n)
+
+def shrink(case: Case, fails: Callable[[Case], bool]) -> Case:
+    """Greedily simplifies case (see smaller) as long as it still fails"""
+    progress = True
+    while progress:
+        progress = False
+        for candidate in smaller(case):
+            if fails(candidate):
+                case = candidate
+                progress = True
+                break
+    return case
+
+def check(seed: str, names: list[str], max_steps: int) -> Disagreement | None:
+    """Runs the case of seed on every engine of names, shrinking it when they disagree"""
+    case = random_case(random.Random(seed))
+    if agree(outcomes(case, names, max_steps)):
+        return None
+
+    case = shrink(case, lambda candidate: not agree(outcomes(candidate, names, max_steps)))
+    return Disagreement(seed, case, outcomes(case, names, max_steps))
+
+def check_chunk(seeds: list[str], names: list[str], max_steps: int) -> list[Disagreement]:
+    return [found for seed in seeds if (found := check(seed, names, max_steps)) is not None]
+
+def fuzz(cases: int,
+         seed: int = 0,
+         names: list[str] | None = None,
+         max_steps: int = 2000,
+         workers: int | None = None,
+         chunksize: int = 256) -> Iterator[Disagreement]:
+    """
+    Cross-checks the engines (the ones of default_names by default) on cases random cases,
+    each one stopped after max_steps steps: they must agree on the output, the steps and halting.
+    The cases are numbered from seed so that any of them can be replayed (see check),
+    and are checked by chunks on a pool of processes (one per core by default).
+    Yields the disagreements, shrunk, as they are found.
+    """
+    names = default_names() if names is None else names
+    chunks = [[f"{seed}:{i}" for i in range(start, min(start + chunksize, cases))] for start in range(0, cases, chunksize)]
+
+    if workers == 1:
+        for chunk in chunks:
+            yield from check_chunk(chunk, names, max_steps)
+        return
+
+    with ProcessPoolExecutor(workers or os.cpu_count()) as pool:
+        for found in pool.map(check_chunk, chunks, [names] * len(chunks), [max_steps] * len(chunks)):
+            yield from found
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./fuzz.py [-c cases] [-s seed] [-m max_steps] [-w workers] [-e engine1,engine2]
+
+    cross-checks the engines on random programs and random circuits (10000 cases from seed 0 by default),
+    printing every disagreement once shrunk and exiting with 1 if there was any.
+    """
+
+    options = dict(zip(sys.argv[1::2], sys.argv[2::2]))
+    found = 0
+
+    for disagreement in fuzz(
+        int(options.get("-c", 10000)),
+        seed=int(options.get("-s", 0)),
+        names=options["-e"].split(",") if "-e" in options else None,
+        max_steps=int(options.get("-m", 2000)),
+        workers=int(options["-w"]) if "-w" in options else None,
+    ):
+        found += 1
+        for line in disagreement.describe():
+            print(line)
+
+    print(f"{found} disagreements")
+    sys.exit(1 if found else 0)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from hashlib import sha256
+from time import monotonic
+import engines
+import cache
+import sys
+
+# programs with more fractions than this are run by engines.run: the generated chains would get too deep to compile
+MAX_FRACTIONS = 5000
+
+# the compiled functions by hash of the compiled program, the least recently used going first past MAX_RUNNERS
+MAX_RUNNERS = 64
+RUNNERS: OrderedDict[str, engines.Runner] = OrderedDict()
+
+def key(compiled: engines.Compiled) -> str:
+    return sha256(repr((compiled.basis, compiled.fractions)).encode()).hexdigest()
+
+def source(compiled: engines.Compiled) -> str:
+    """
+    The Python source of a function run(registers, max_steps=None, deadline=None) doing what engines.run does
+    on this very program: the registers are local variables (r0, r1, ...) and the state (see engines.Dispatch)
+    is found by a few comparisons, after which one if/elif chain tries the fractions of the state,
+    with the guards and the deltas written as constants.
+
+    The states are not kept in registers while running, as the state variable says which one holds the token:
+    they are written back when the run stops. The configurations which do not follow the convention
+    (engines.ANY_STATE) are left to engines.run.
+    """
+    dispatch = compiled.dispatch
+    states = dispatch.states
+    data = [i for i in range(len(compiled.basis)) if i not in states]
+
+    def chain(state: int, indent: str) -> list[str]:
+        lines = []
+        for k, (_, guard, delta, move) in enumerate(dispatch.table[state]):
+            tests = [f"r{i} >= {a}" if a > 1 else f"r{i}" for i, a in guard if i not in states]
+            if tests:
+                lines.append(f"{indent}{'if' if k == 0 else 'elif'} {' and '.join(tests)}:")
+            else:
+                lines.append(f"{indent}{'if True' if k == 0 else 'else'}:")
+            body = [f"r{i} {'+' if d > 0 else '-'}= {abs(d)}" for i, d in delta if i not in states and d != 0]
+            if move is not None and move != state:
+                body.append(f"state = {move}")
+            lines += [f"{indent}    {line}" for line in body or ["pass"]]
+            if not tests:
+                return lines
+        if lines:
+            lines.append(f"{indent}else:")
+        lines.append(f"{indent}{'    ' if lines else ''}break")
+        return lines
+
+    def tree(keys: list[int], indent: str) -> list[str]:
+        if len(keys) == 1:
+            return chain(keys[0], indent)
+        middle = len(keys) // 2
+        return [
+            f"{indent}if state < {keys[middle]}:",
+            *tree(keys[:middle], indent + "    "),
+            f"{indent}else:",
+            *tree(keys[middle:], indent + "    "),
+        ]
+
+    unpack = f"    {', '.join(f'r{i}' for i in data)}, = {', '.join(f'registers[{i}]' for i in data)},"
+    lines = [
+        "def run(registers, max_steps=None, deadline=None):",
+        "    state = current(registers)",
+        "    if state == ANY_STATE:",
+        "        return fallback(registers, max_steps, deadline)",
+        unpack if data else "    pass",
+        "    steps = 0",
+        "    while True:",
+        "        stop = max_steps",
+        "        if deadline is not None:",
+        f"            stop = steps + {engines.SLICE} if max_steps is None else min(max_steps, steps + {engines.SLICE})",
+        "        limit = -1 if stop is None else stop",
+        "        while steps != limit:",
+        *tree(sorted(s for s in dispatch.table if s != engines.ANY_STATE), "            "),
+        "            steps += 1",
+        "        else:",
+        "            if steps != max_steps and monotonic() < deadline:",
+        "                continue",
+        "        break",
+        *[f"    registers[{i}] = r{i}" for i in data],
+        *[f"    registers[{s}] = int(state == {s})" for s in sorted(states)],
+        "    return steps",
+    ]
+    return "\n".join(lines) + "\n"
+
+def runner(compiled: engines.Compiled) -> engines.Runner:
+    """
+    The function generated for compiled (see source), compiled once per program and kept by hash
+    (for the last MAX_RUNNERS programs), or engines.run for the huge programs.
+    """
+    if len(compiled.fractions) > MAX_FRACTIONS:
+        return lambda registers, max_steps=None, deadline=None: engines.run(compiled, registers, max_steps, deadline)
+
+    digest = key(compiled)
+    if digest in RUNNERS:
+        RUNNERS.move_to_end(digest)
+    else:
+        namespace = {
+            "current": compiled.dispatch.current,
+            "ANY_STATE": engines.ANY_STATE,
+            "monotonic": monotonic,
+            "fallback": lambda registers, max_steps, deadline: engines.run(compiled, registers, max_steps, deadline),
+        }
+        exec(compile(source(compiled), f"<jit {digest[:12]}>", "exec"), namespace)
+        RUNNERS[digest] = namespace["run"]
+        if len(RUNNERS) > MAX_RUNNERS:
+            RUNNERS.popitem(last=False)
+    return RUNNERS[digest]
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./jit.py <filename>
+
+    prints the Python function generated for the program (see source), to run it use ./fractran.py <filename> -e jit
+    """
+
+    if len(sys.argv) >= 2:
+        _, compiled = cache.load(sys.argv[1])
+        print(source(compiled), end="")
+    else:
+        print("Retry with the filename of the program as an argument.")
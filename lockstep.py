@@ -0,0 +1,114 @@
+from fractran import Fraction
+import engines
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# the rows are checked every CHECK_EVERY steps, and moved to the arbitrary precision engine
+# once they could overflow an int64 before the next check (as in engines.run_native)
+CHECK_EVERY = 1024
+
+def run_lockstep(compiled: engines.Compiled,
+                 rows: list[list[int]],
+                 max_steps: int | None = None) -> list[int]:
+    """
+    Runs K independent inputs of the same program together, their registers (modified in place)
+    being kept as a K x R matrix of int64 exponents.
+
+    At each step every guard of the program is checked for all the rows with a few vectorized comparisons,
+    the first applicable fraction of each row is found with an argmax over the resulting boolean matrix,
+    and the deltas of these fractions are added to the rows with one fancy-indexed addition.
+    Rows which halt leave the matrix. Rows whose exponents get close to the int64 limit
+    (given the most the fractions can add until the next check) are finished by engines.run with Python integers,
+    as are all the rows of a program whose guards or deltas do not fit an int64.
+    Returns the number of steps of each row.
+    """
+    if np is None:
+        raise ImportError("the lockstep interpreter needs numpy")
+
+    fractions = compiled.fractions
+    width = len(compiled.basis)
+
+    if any(abs(x) > engines.INT64_MAX for guard, delta in fractions for _, x in guard + delta):
+        return [engines.run(compiled, row, max_steps) for row in rows]
+    growth = max((d for _, delta in fractions for _, d in delta if d > 0), default=0)
+    bound = engines.INT64_MAX - CHECK_EVERY * growth
+
+    columns, amounts, starts, guarded = [], [], [], []
+    deltas = np.zeros((len(fractions), width), dtype=np.int64)
+    for f, (guard, delta) in enumerate(fractions):
+        if guard:
+            guarded.append(f)
+            starts.append(len(columns))
+            for i, a in guard:
+                columns.append(i)
+                amounts.append(a)
+        for i, d in delta:
+            deltas[f, i] = d
+    columns = np.array(columns, dtype=np.intp)
+    amounts = np.array(amounts, dtype=np.int64)
+    starts = np.array(starts, dtype=np.intp)
+    guarded = np.array(guarded, dtype=np.intp)
+
+    steps = [0] * len(rows)
+    small = [k for k, row in enumerate(rows) if max(row, default=0) <= bound]
+    large = [k for k, row in enumerate(rows) if max(row, default=0) > bound]
+
+    ids = np.array(small, dtype=np.intp)
+    matrix = np.array([rows[k] for k in small], dtype=np.int64).reshape(len(small), width)
+    done = 0
+
+    while len(ids) > 0 and done != max_steps:
+        applicable = np.ones((len(ids), len(fractions)), dtype=bool)
+        if len(guarded) > 0:
+            satisfied = matrix[:, columns] >= amounts
+            applicable[:, guarded] = np.logical_and.reduceat(satisfied, starts, axis=1)
+
+        first = applicable.argmax(axis=1)
+        running = applicable[np.arange(len(ids)), first]
+
+        if not running.all():
+            for k, row in zip(ids[~running], matrix[~running]):
+                rows[k][:] = row.tolist()
+                steps[k] = done
+            ids, matrix, first = ids[running], matrix[running], first[running]
+
+        matrix += deltas[first]
+        done += 1
+
+        if done % CHECK_EVERY == 0:
+            overflowing = (matrix > bound).any(axis=1)
+            if overflowing.any():
+                for k, row in zip(ids[overflowing], matrix[overflowing]):
+                    rows[k][:] = row.tolist()
+                    steps[k] = done
+                    large.append(int(k))
+                ids, matrix = ids[~overflowing], matrix[~overflowing]
+
+    for k, row in zip(ids, matrix):
+        rows[k][:] = row.tolist()
+        steps[k] = done
+
+    for k in large:
+        budget = None if max_steps is None else max_steps - steps[k]
+        steps[k] += engines.run(compiled, rows[k], budget)
+
+    return steps
+
+def evaluate_lockstep(program: list[Fraction],
+                      inputs: list[int],
+                      max_steps: int | None = None) -> list[int]:
+    """
+    Evaluates one program over many inputs at once (see run_lockstep),
+    which is much faster than a loop over the inputs when sweeping a whole grid of them.
+    """
+    compiled = engines.compile_program(program)
+    split = [engines.to_registers(compiled, n) for n in inputs]
+    rows = [registers for registers, _ in split]
+    run_lockstep(compiled, rows, max_steps)
+    return [
+        engines.from_registers(compiled, registers, cofactor)
+        for registers, (_, cofactor) in zip(rows, split)
+    ]
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from functools import lru_cache
+from hashlib import sha256
+from fractran import Fraction
+import analysis
+import engines
+import pretty
+import cache
+import json
+import os
+import sys
+
+# the registers of a configuration of a program (its input, or where a run went through), over its basis
+type Key = tuple[int, ...]
+
+# configurations recorded at most by a run, the later ones being thinned out (see run_through)
+MAX_RECORDED = 1 << 10
+# configurations looked up at most by a run, which then goes on with its engine (see Memo)
+MAX_LOOKUPS = 1 << 14
+
+@dataclass
+class Entry:
+    """Where the run from a configuration halts (its registers) and after how many steps"""
+    output: Key
+    steps: int
+
+    def size(self, key: Key) -> int:
+        """A rough count of the bytes taken by the entry and its key (the exponents being small integers)"""
+        return 200 + 36 * (len(key) + len(self.output))
+
+class ResultCache:
+    """
+    The results of complete runs by program (its hash, see digest) and configuration,
+    in memory up to max_entries entries and max_bytes bytes, the least recently used ones going first,
+    and also in a directory (one JSON file per result) when one is given, for the other processes and the next runs.
+    """
+
+    def __init__(self, max_entries: int = 1 << 16, max_bytes: int = 64 << 20, directory: str | None = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries: OrderedDict[tuple[str, Key], Entry] = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+
+    def path_of(self, program: str, key: Key) -> str:
+        return os.path.join(self.directory, program, sha256(repr(key).encode()).hexdigest() + ".json")
+
+    def get(self, program: str, key: Key, internal: bool = False) -> Entry | None:
+        """The internal lookups (the ones of run_through, on the way) only count when they find something"""
+        entry = self.entries.get((program, key))
+        if entry is not None:
+            self.entries.move_to_end((program, key))
+        elif self.directory is not None:
+            entry = self.read(program, key)
+            if entry is not None:
+                self.remember(program, key, entry)
+
+        if entry is None:
+            self.misses += not internal
+        else:
+            self.hits += 1
+        return entry
+
+    def put(self, program: str, key: Key, entry: Entry, cold: bool = False):
+        """
+        Stores a result. The cold ones (the configurations met on the way, which may never be asked for)
+        are the first to be evicted, unless they are looked up in the meantime.
+        """
+        if (program, key) in self.entries:
+            return
+        self.remember(program, key, entry, cold)
+        if self.directory is not None:
+            self.write(program, key, entry)
+
+    def remember(self, program: str, key: Key, entry: Entry, cold: bool = False):
+        size = entry.size(key)
+        if size > self.max_bytes:
+            return
+        self.entries[(program, key)] = entry
+        self.bytes += size
+        if cold:
+            self.entries.move_to_end((program, key), last=False)
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            (_, oldest), evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size(oldest)
+
+    def read(self, program: str, key: Key) -> Entry | None:
+        try:
+            with open(self.path_of(program, key), "r", encoding="utf-8") as file:
+                stored = json.load(file)
+        except (OSError, ValueError):
+            return None
+        # the files are named after a hash of the key, which is checked
+        if tuple(stored["registers"]) != key:
+            return None
+        return Entry(tuple(stored["output"]), stored["steps"])
+
+    def write(self, program: str, key: Key, entry: Entry):
+        """Skipped silently when the directory cannot be written, as in cache.py"""
+        path = self.path_of(program, key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "w", encoding="utf-8") as file:
+                json.dump({"registers": list(key), "output": list(entry.output), "steps": entry.steps}, file)
+            os.replace(temporary, path)
+        except OSError:
+            pass
+
+def digest(program: list[Fraction]) -> str:
+    return sha256(repr(list(program)).encode()).hexdigest()
+
+def boundaries(compiled: engines.Compiled) -> set[engines.Register]:
+    """
+    The states entered from another component of the graph of the states (see analysis.py):
+    the beginnings of the sub-automata of circuits.py, crossed a few times per run,
+    where the configurations are recorded and looked up.
+    """
+    result = analysis.analyze([], compiled)
+    component = {s: k for k, c in enumerate(result.components) for s in c}
+    return {
+        compiled.index[t.target] for t in result.transitions
+        if not t.dead and t.source is not None and t.target is not None and component[t.source] != component[t.target]
+    }
+
+def run_through(compiled: engines.Compiled,
+                registers: list[int],
+                crossings: set[engines.Register],
+                lookup,
+                max_lookups: int = MAX_LOOKUPS) -> tuple[int, Entry | None, list[tuple[Key, int]]]:
+    """
+    Same as engines.run, looking the configuration up every time the token moves to a state of crossings.
+    Returns the steps taken, the entry found (None when the run halted by itself or after max_lookups lookups)
+    and the configurations it went through with the steps taken to reach them, to be stored once the end is known.
+    Past MAX_RECORDED configurations, every other one is dropped and the next ones are recorded half as often.
+    """
+    dispatch = compiled.dispatch
+    table = {
+        state: [(guard, delta, move, move is not None and move != state and move in crossings)
+                for _, guard, delta, move in entries]
+        for state, entries in dispatch.table.items()
+    }
+    state = dispatch.current(registers)
+    steps = 0
+    recorded = []
+    stride, crossed = 1, 0
+
+    while True:
+        for guard, delta, move, crossing in table[state]:
+            for i, a in guard:
+                if registers[i] < a:
+                    break
+            else:
+                for i, d in delta:
+                    registers[i] += d
+                if move is not None:
+                    state = move
+                break
+        else:
+            return steps, None, recorded
+        steps += 1
+
+        if crossing:
+            key = tuple(registers)
+            entry = lookup(key)
+            if entry is not None:
+                return steps, entry, recorded
+            crossed += 1
+            if crossed == max_lookups:
+                return steps, None, recorded
+            if crossed % stride == 0:
+                recorded.append((key, steps))
+                if len(recorded) > MAX_RECORDED:
+                    recorded = recorded[1::2]
+                    stride *= 2
+
+class Memo:
+    """
+    Evaluates programs through a ResultCache: a run starting from a configuration whose result is known takes no step.
+    With intermediate, the runs also look up (and store) the configurations met at the boundaries of the states
+    (see boundaries), so that a new input going through a configuration reached by an earlier run stops there.
+    This takes the plain loop of run_through, much slower than the macro engine on the large inputs:
+    past MAX_LOOKUPS lookups the run goes on with engine, one of engines.RUNNERS, as all the runs do otherwise.
+    Only complete runs are stored, so the results are the ones of the engines, steps included.
+    """
+
+    def __init__(self, results: ResultCache | None = None, engine: str = "macro", intermediate: bool = False):
+        self.results = ResultCache() if results is None else results
+        self.engine = engine
+        self.intermediate = intermediate
+        self.prepared = lru_cache(maxsize=64)(self.prepare)
+
+    def prepare(self, program: tuple[Fraction, ...]):
+        compiled, runner = engines.runner_for(list(program), self.engine)
+        return digest(program), compiled, runner, boundaries(compiled) if self.intermediate else set()
+
+    def run(self, program: list[Fraction], registers: list[int]) -> int:
+        """Runs program on the registers of its compiled form (modified in place), returning the steps taken"""
+        name, compiled, runner, crossings = self.prepared(tuple(program))
+        start = tuple(registers)
+        entry = self.results.get(name, start)
+
+        if entry is None:
+            if crossings:
+                steps, found, recorded = run_through(
+                    compiled, registers, crossings, lambda key: self.results.get(name, key, internal=True)
+                )
+                if found is None:
+                    steps += runner(registers)
+                output = tuple(registers) if found is None else found.output
+                total = steps if found is None else steps + found.steps
+                for key, reached in recorded:
+                    self.results.put(name, key, Entry(output, total - reached), cold=True)
+            else:
+                total, output = runner(registers), tuple(registers)
+            entry = Entry(output, total)
+            self.results.put(name, start, entry)
+
+        registers[:] = entry.output
+        return entry.steps
+
+    def evaluate(self, program: list[Fraction], n: int) -> tuple[int, int]:
+        """The output of program on n and the steps taken (by the first run which got there)"""
+        compiled = self.prepared(tuple(program))[1]
+        registers, cofactor = engines.to_registers(compiled, n)
+        steps = self.run(program, registers)
+        return engines.from_registers(compiled, registers, cofactor), steps
+
+    def evaluate_factors(self, program: list[Fraction], factors: engines.Factors) -> tuple[engines.Factors, int]:
+        """Same as evaluate with the input and the output given by their exponents"""
+        compiled = self.prepared(tuple(program))[1]
+        registers, cofactor = engines.factors_to_registers(compiled, factors)
+        steps = self.run(program, registers)
+        return engines.registers_to_factors(compiled, registers, cofactor), steps
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./memo.py <filename> [-e engine] [-i] [-d directory]
+
+    reads one input per line from the standard input (in the 2^x * 3^y format) and prints the outputs
+    with their steps, the results being kept in directory (by default results/ in the cache directory of cache.py)
+    so that the inputs already seen (by this run or an earlier one) cost nothing.
+    With -i the configurations met on the way are kept too (see Memo).
+    """
+
+    if len(sys.argv) >= 2:
+        arguments = [argument for argument in sys.argv[2:] if argument != "-i"]
+        options = dict(zip(arguments[::2], arguments[1::2]))
+        directory = options.get("-d", os.path.join(cache.DIRECTORY, "results"))
+        memo = Memo(ResultCache(directory=directory), options.get("-e", "macro"), "-i" in sys.argv)
+        program, _ = cache.load(sys.argv[1])
+
+        for line in sys.stdin:
+            if line.strip():
+                output, steps = memo.evaluate_factors(program, pretty.pretty_prime_factors_to_factors(line))
+                print(f"{pretty.factors_to_pretty_prime_factors(output)} ({steps} steps)")
+        print(f"{memo.results.hits} hits, {memo.results.misses} misses")
+    else:
+        print("Retry with the filename of the program as an argument.")
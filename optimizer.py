@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+from typing import Iterable
+from collections import Counter
+from heapq import heappush, heappop
+from math import gcd, prod
+from fractran import Fraction
+import fractran
+import engines
+import profiler
+import pretty
+import primes
+import sys
+
+type Factored = tuple[engines.Factors, engines.Factors]
+
+def factor(program: Iterable[Fraction]) -> list[Factored]:
+    return [
+        (primes.factorize(num // gcd(num, den)), primes.factorize(den // gcd(num, den)))
+        for num, den in program
+    ]
+
+def unfactor(fractions: list[Factored]) -> list[Fraction]:
+    return [
+        (prod(p**e for p, e in num.items()), prod(p**e for p, e in den.items()))
+        for num, den in fractions
+    ]
+
+def states_of(fractions: list[Factored]) -> set[int]:
+    """The primes behaving like the states of circuits.py (see engines.control_states)"""
+    compiled = engines.compile_factors(fractions)
+    return {compiled.basis[s] for s in compiled.dispatch.states}
+
+def candidates(fractions: list[Factored], states: set[int]) -> dict[int | None, list[int]]:
+    """
+    For each state, the fractions which may fire when it holds the token, in the order they are tried
+    (as engines.index_states, a state is closed by its first fraction needing nothing but the state).
+    None stands for the configurations without state, where only the stateless fractions are tried.
+    """
+    table = {s: [] for s in states}
+    table[None] = []
+    for j, (_, den) in enumerate(fractions):
+        source = next((p for p in den if p in states), None)
+        for s, entries in table.items():
+            if (source is None or source == s) and (s is None or not entries or fractions[entries[-1]][1] != {s: 1}):
+                entries.append(j)
+    return table
+
+def fuse(fractions: list[Factored], keep: set[int]) -> bool:
+    """
+    When the first fraction tried in a state S needs nothing but S (a goto, an increment, ...),
+    every fraction moving to S can do its work directly: (T * x) / S after (S * y) / z becomes (T * x * y) / z,
+    saving a step each time S is entered. The fused fraction must stay reduced, or its guard would change.
+    Returns whether some fraction was fused.
+    """
+    states = states_of(fractions)
+    table = candidates(fractions, states)
+    changed = False
+
+    def endless(s: int) -> bool:
+        """Whether the gotos from s go round forever, in which case fusing them would never end either"""
+        seen = set()
+        while s is not None and s not in seen:
+            seen.add(s)
+            if not table[s] or fractions[table[s][0]][1] != {s: 1}:
+                return False
+            s = next((p for p in fractions[table[s][0]][0] if p in states), None)
+        return s is not None
+
+    for s in sorted(states - keep):
+        if not table[s] or endless(s):
+            continue
+        f = table[s][0]
+        num_f, den_f = fractions[f]
+        if den_f != {s: 1}:
+            continue
+
+        for j, (num, den) in enumerate(fractions):
+            if j == f or s not in num:
+                continue
+            fused = Counter(num)
+            fused[s] -= 1
+            fused.update(num_f)
+            fused = {p: e for p, e in fused.items() if e != 0}
+            if any(p in den for p in fused):
+                continue
+            fractions[j] = (dict(sorted(fused.items())), den)
+            changed = True
+
+    return changed
+
+def unroll(fractions: list[Factored], keep: set[int]) -> bool:
+    """
+    The loops of circuits.py go back to their state A through a goto, (E * x) / (A * y) then A / E,
+    which fuse cannot remove since (A * x) / (A * y) reduces to a fraction without state.
+    A copy A' of the state is made instead, so that the loop goes from A to A' and back:
+    each fraction of A is followed by its copy for A' (the stateless fractions between them stay in the same order),
+    the turns of the loop go to the other state directly and the exits are left alone.
+    Only the turns testing a register (y) through a plain goto (A / E) are unrolled: the turns of the copies
+    are not plain gotos, so a loop is unrolled once (the loops running forever included).
+    Returns whether some state was copied.
+    """
+    states = states_of(fractions)
+    table = candidates(fractions, states)
+
+    def turn(j: int, a: int) -> tuple[int, engines.Factors] | None:
+        num, den = fractions[j]
+        for s in num:
+            if s in states and s not in keep and table[s] and fractions[table[s][0]] == ({a: 1}, {s: 1}):
+                rest = {p: e for p, e in num.items() if p != s}
+                if not any(p in den for p in rest):
+                    return s, rest
+        return None
+
+    for a in sorted(states):
+        turns = {
+            j: t for j in table[a]
+            if a in fractions[j][1] and len(fractions[j][1]) > 1 and (t := turn(j, a)) is not None
+        }
+        if not turns:
+            continue
+        largest = max(p for num, den in fractions for p in num.keys() | den.keys())
+        b = primes.PRIMES[len(primes.PRIMES.below(largest))]
+
+        unrolled = []
+        for j, (num, den) in enumerate(fractions):
+            if a not in den:
+                unrolled.append((num, den))
+                continue
+            copy = dict(den)
+            copy[b] = copy.pop(a)
+            if j in turns:
+                _, rest = turns[j]
+                unrolled.append((dict(sorted((rest | {b: 1}).items())), den))
+                unrolled.append((dict(sorted((rest | {a: 1}).items())), dict(sorted(copy.items()))))
+            else:
+                unrolled.append((num, den))
+                unrolled.append((num, dict(sorted(copy.items()))))
+        fractions[:] = unrolled
+
+        # the positions moved along, the next loops are left to the next call
+        return True
+
+    return False
+
+def prune(fractions: list[Factored], keep: set[int]) -> bool:
+    """
+    Drops the fractions which can never fire:
+    the ones of a state no fraction moves to (apart from the kept states, where the runs start),
+    the ones of a state tried after a fraction of this state which always fires,
+    and the ones testing a temporary empty wherever they are tried (see empty),
+    like the drains of destroy for the temporaries the program always leaves empty.
+    Returns whether some fraction was dropped.
+    """
+    states = states_of(fractions)
+    produced = {p for num, _ in fractions for p in num if p in states}
+    table = candidates(fractions, states)
+    known = empty(fractions, states, keep)
+
+    dead = set()
+    for j, (_, den) in enumerate(fractions):
+        source = next((p for p in den if p in states), None)
+        if source is not None and ((source not in keep and source not in produced) or j not in table[source]):
+            dead.add(j)
+        elif all(any(p in zero for p in den) for s, zero in known.items() if j in table[s]):
+            dead.add(j)
+
+    fractions[:] = [fraction for j, fraction in enumerate(fractions) if j not in dead]
+    return bool(dead)
+
+def empty(fractions: list[Factored], states: set[int], keep: set[int]) -> dict[int | None, set[int]]:
+    """
+    For each state (None standing for the configurations without state), the temporaries known to be empty
+    whenever the token gets there, the runs starting in the kept states with every temporary empty.
+    A fraction is only tried once the ones before it failed, and a guard failing on a single temporary
+    tells that this one is empty: this is how the loops of circuits.py end with their counter at 0.
+    """
+    temporaries = {p for num, den in fractions for p in num.keys() | den.keys()} - states - keep
+    table = candidates(fractions, states)
+    starts = [s for s in states if s in keep] or [None]
+    known = {s: set(temporaries) for s in starts}
+    pending = list(starts)
+
+    while pending:
+        s = pending.pop()
+        zero = set(known[s])
+        for j in table[s]:
+            num, den = fractions[j]
+            guard = {p: e for p, e in den.items() if p != s}
+            if any(p in zero for p in guard):
+                continue
+
+            target = next((p for p in num if p in states), s if s not in den else None)
+            after = zero - num.keys()
+            if target not in known or not known[target] <= after:
+                known[target] = known[target] & after if target in known else after
+                pending.append(target)
+
+            if not guard:
+                break
+            if len(guard) == 1 and list(guard.values()) == [1]:
+                zero.update(guard)
+
+    return known
+
+def schedule(fractions: list[Factored], keep: set[int], weights: list[int] | None = None) -> list[int]:
+    """
+    Orders the fractions so that the ones firing the most come first (the integer engines try them one after the other),
+    by the weights when given and keeping the order of the program otherwise.
+    The fractions of two different states never compete, so only the order of the fractions tried in a same state
+    is kept, a stateless fraction which cannot fire in a state (it tests a temporary empty there) being free to move.
+    Returns the positions of the fractions in their new order.
+    """
+    states = states_of(fractions)
+    table = candidates(fractions, states)
+    known = empty(fractions, states, keep)
+
+    after = [set() for _ in fractions]
+    def before(i: int, j: int):
+        after[i].add(j)
+
+    stateless = table[None]
+    for i, j in zip(stateless, stateless[1:]):
+        before(i, j)
+    for s, entries in table.items():
+        if s is None:
+            continue
+        own = [j for j in entries if s in fractions[j][1]]
+        for i, j in zip(own, own[1:]):
+            before(i, j)
+        zero = known.get(s)
+        if zero is None:
+            continue
+        for g in entries:
+            if s in fractions[g][1] or any(p in zero for p in fractions[g][1]):
+                continue
+            for j in own:
+                before(*sorted((g, j)))
+        # the stateless fractions after the state is closed must stay there
+        for g in stateless:
+            if own and g > own[-1] and g not in entries:
+                before(own[-1], g)
+
+    needs = [0] * len(fractions)
+    for i in range(len(fractions)):
+        for j in after[i]:
+            needs[j] += 1
+    ready = []
+    for j, count in enumerate(needs):
+        if count == 0:
+            heappush(ready, (-(weights[j] if weights else 0), j))
+    order = []
+    while ready:
+        _, i = heappop(ready)
+        order.append(i)
+        for j in after[i]:
+            needs[j] -= 1
+            if needs[j] == 0:
+                heappush(ready, (-(weights[j] if weights else 0), j))
+    return order
+
+def allocate(fractions: list[Factored], keep: set[int], weights: list[int] | None = None) -> list[Factored]:
+    """
+    Gives a prime to every register, the ones of keep (the input and output) staying where they are:
+    the temporaries never holding something in the same state share a prime,
+    and the smallest primes go to the hottest registers. A register is as hot as the fractions mentioning it,
+    weighted by how many times they fire when weights are given.
+    """
+    states = states_of(fractions)
+    table = candidates(fractions, states)
+    known = empty(fractions, states, keep)
+
+    heat = Counter()
+    for j, (num, den) in enumerate(fractions):
+        for p in num.keys() | den.keys():
+            heat[p] += 1 if weights is None else weights[j] + 1
+
+    # two temporaries cannot share a prime when one of them may hold something in a state
+    # where the other one may hold something as well, or is tested (it would see the other one),
+    # nor when a fraction mentions both: it would get reduced and lose its guard, even if it never fires
+    temporaries = set(heat) - states - keep
+    conflicts = {p: set() for p in temporaries}
+    for num, den in fractions:
+        mentioned = (num.keys() | den.keys()) & temporaries
+        for p in mentioned:
+            conflicts[p] |= mentioned
+    for s, zero in known.items():
+        full = temporaries - zero
+        mentioned = {p for j in table[s] for p in fractions[j][0].keys() | fractions[j][1].keys() if p in temporaries}
+        for p in full:
+            conflicts[p] |= full | mentioned
+        for p in mentioned:
+            conflicts[p] |= full
+
+    shared = {}
+    groups = {}
+    for p in sorted(temporaries, key=lambda p: (-heat[p], p)):
+        leader = next((q for q, group in groups.items() if not conflicts[p] & group), p)
+        groups.setdefault(leader, set()).add(p)
+        shared[p] = leader
+
+    merged = Counter()
+    for p in heat:
+        merged[shared.get(p, p)] += heat[p]
+    free = (p for k in range(len(heat) + len(keep)) if (p := primes.PRIMES[k]) not in keep)
+    ranked = sorted((p for p in merged if p not in keep), key=lambda p: (-merged[p], p))
+    names = {p: next(free) for p in ranked} | {p: p for p in keep}
+    names = {p: names[shared.get(p, p)] for p in heat}
+
+    return [
+        (dict(sorted((names[p], e) for p, e in num.items())), dict(sorted((names[p], e) for p, e in den.items())))
+        for num, den in fractions
+    ]
+
+def optimize(program: list[Fraction],
+             keep: Iterable[int],
+             samples: Iterable[int] = (),
+             max_steps: int | None = 1 << 20) -> list[Fraction]:
+    """
+    Rewrites a program built by circuits.py into a shorter one taking fewer steps, with smaller primes.
+    keep lists the primes of the inputs and outputs (the starting state included), which are left untouched.
+
+    The rewritten program gives the same outputs for the inputs following the conventions of circuits.py:
+    a single state holding the token, and the other registers (the temporaries) being empty
+    at the beginning and at the end of the runs.
+    The drains and dead fractions go, but unroll copies the state of every loop to save a step per turn:
+    a program made of many short loops (sqrt) may end up with more fractions, taking far fewer steps.
+    The samples inputs, when given, are run (for at most max_steps steps each) to put the fractions firing the most first
+    and give the smallest primes to the registers they use: the integer engines try the fractions in order
+    and multiply the whole value at every step, so this is where they gain the most.
+    """
+    keep = set(keep)
+    fractions = factor(program)
+
+    while fuse(fractions, keep) | prune(fractions, keep) or unroll(fractions, keep):
+        pass
+
+    weights = None
+    samples = list(samples)
+    if samples:
+        weights = [0] * len(fractions)
+        compiled = engines.compile_factors(fractions)
+        for n in samples:
+            registers, _ = engines.to_registers(compiled, n)
+            hits = profiler.profile_registers(compiled, registers, max_steps).hits
+            weights = [w + h for w, h in zip(weights, hits)]
+
+    order = schedule(fractions, keep, weights)
+    fractions = [fractions[j] for j in order]
+    if weights is not None:
+        weights = [weights[j] for j in order]
+
+    return unfactor(allocate(fractions, keep, weights))
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./optimizer.py <filename> <output_filename> <kept primes> [-s sample ...]
+
+    for instance "./optimizer.py programs/sqrt sqrt.opt 2 3 5 -s 2^10*5 2^20*5" keeps the input n = 2, the output o = 3
+    and the starting state A = 5 of make_sqrt, and ranks the fractions on runs of sqrt(10) and sqrt(20).
+    The program is written in the binary format of binary.py when the output filename ends with .bin.
+    """
+
+    if len(sys.argv) >= 4:
+        arguments = sys.argv[3:]
+        kept = arguments[:arguments.index("-s")] if "-s" in arguments else arguments
+        samples = arguments[len(kept) + 1:]
+
+        program = fractran.program_from_file(sys.argv[1])
+        optimized = optimize(
+            program,
+            map(int, kept),
+            [pretty.factors_to_int(pretty.pretty_prime_factors_to_factors(sample)) for sample in samples],
+        )
+
+        fractran.program_to_file(sys.argv[2], optimized)
+
+        print(f"{len(program)} fractions -> {len(optimized)} fractions")
+    else:
+        print("Retry with the filename of the program, the output filename and the kept primes as arguments.")
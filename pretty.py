@@ -1,6 +1,9 @@
+from typing import Iterable
 import primes
 from collections import Counter
 
+type Factors = dict[int, int]
+
 def pretty_prime_factors_to_int(s: str) -> int:
     s = s.replace(" ", "")
     output = 1
@@ -12,9 +15,43 @@ def pretty_prime_factors_to_int(s: str) -> int:
         output *= a**b
     return output
 
-def int_to_pretty_prime_factors(n: int) -> str:
-    factors = primes.prime_factors(n)
-    counter = Counter(factors)
+def pretty_prime_factors_to_factors(s: str) -> Factors:
+    """
+    Same as pretty_prime_factors_to_int, but keeps the exponents instead of building the integer,
+    hence "2^1000000" costs nothing. Only the bases (which are small) get factorized.
+    Raises ValueError for what is not a positive integer (a base below 1, a negative exponent).
+    """
+    s = s.replace(" ", "")
+    factors = Counter()
+    for factor in s.split("*"):
+        if '^' in factor:
+            a, b = map(int, factor.split("^"))
+        else:
+            a, b = int(factor), 1
+        if a < 1 or b < 0:
+            raise ValueError(f"{factor} is not a positive integer")
+        for p, e in primes.factorize(a).items():
+            factors[p] += e * b
+    return {p: e for p, e in sorted(factors.items()) if e != 0}
+
+def int_to_factors(n: int, basis: Iterable[int] = ()) -> Factors:
+    return primes.factorize(n, basis)
+
+def factors_to_int(factors: Factors) -> int:
+    output = 1
+    for p, e in factors.items():
+        output *= p**e
+    return output
+
+def factors_to_pretty_prime_factors(factors: Factors) -> str:
+    text = " * ".join(
+        f"{p}" if e == 1 else f"{p}^{e}"
+        for p, e in sorted(factors.items()) if e != 0
+    )
+    return text if text else "1"
+
+def int_to_pretty_prime_factors(n: int, basis: Iterable[int] = ()) -> str:
+    counter = primes.factorize(n, basis)
     return " * ".join(map(
         lambda item : f"{item[0]}" if item[1] == 1 else f"{item[0]}^{item[1]}",
         counter.items()
@@ -22,9 +59,14 @@ def int_to_pretty_prime_factors(n: int) -> str:
 
 def int_to_pretty_registers(n: int,
                             names: dict[int, str] = {},
-                            show_states: bool = False) -> str:
-    factors = primes.prime_factors(n)
-    counter = Counter(factors)
+                            show_states: bool = False,
+                            basis: Iterable[int] = ()) -> str:
+    return factors_to_pretty_registers(primes.factorize(n, basis), names, show_states)
+
+def factors_to_pretty_registers(factors: Factors,
+                                names: dict[int, str] = {},
+                                show_states: bool = False) -> str:
+    counter = {k: v for k, v in factors.items() if v != 0}
 
     states = set()
     variables = set()
@@ -55,4 +97,4 @@ def int_to_pretty_registers(n: int,
         variables
     )) + "}}"
 
-    return f"{states_desc} {vars_desc}" if show_states else vars_desc
\ No newline at end of file
+    return f"{states_desc} {vars_desc}" if show_states else vars_desc
@@ -1,33 +1,261 @@
+from collections.abc import Iterable
+from array import array
+from bisect import bisect_right
+from itertools import compress
+from math import gcd, isqrt
+import mmap
+import os
+
 def crible(limit: int) -> list[int]:
-    sieve = [True] * (limit + 1)
-    sieve[0], sieve[1] = False, False
-    for start in range(2, int(limit ** 0.5) + 1):
+    sieve = bytearray([1]) * (limit + 1)
+    sieve[0:2] = bytes(min(2, limit + 1))
+    for start in range(2, isqrt(limit) + 1):
         if sieve[start]:
-            for i in range(start*start, limit + 1, start):
-                sieve[i] = False
-    return [num for num, is_prime in enumerate(sieve) if is_prime]
+            sieve[start*start::start] = bytes(len(range(start*start, limit + 1, start)))
+    return list(compress(range(limit + 1), sieve))
+
+# the primes are sieved by segments of (at least) that many integers, the table doubling each time
+SEGMENT = 1 << 16
+MAGIC = b"PRIMES01"
+
+class PrimeTable:
+    """
+    The primes in increasing order, as a sequence sieved on demand:
+    accessing PRIMES[i] (or a slice) sieves as far as needed, one segment of integers at a time,
+    only keeping the primes already found (as machine integers) and a bytearray for the current segment.
+
+    With a cache file (see use_cache), the primes found in previous runs are memory mapped
+    instead of being sieved again, and the file is rewritten whenever the table grows.
+    """
+
+    def __init__(self):
+        self.limit = 1                  # every prime <= limit is known
+        self.cached = memoryview(b"").cast("Q")
+        self.found = array("Q")
+        self.path = None
+
+    def __len__(self) -> int:
+        return len(self.cached) + len(self.found)
+
+    def __getitem__(self, i: int | slice) -> int | list[int]:
+        if isinstance(i, slice):
+            if i.stop is None or i.stop < 0 or (i.start or 0) < 0:
+                raise IndexError("the prime table is infinite, slices need a non negative end")
+            while len(self) < i.stop:
+                self.grow()
+            return [self[k] for k in range(*i.indices(i.stop))]
+
+        if i < 0:
+            raise IndexError("the prime table is infinite, there is no last prime")
+        while len(self) <= i:
+            self.grow()
+        return self.cached[i] if i < len(self.cached) else self.found[i - len(self.cached)]
+
+    def below(self, n: int) -> list[int]:
+        """The primes p <= n"""
+        while self.limit < n:
+            self.grow()
+        return self[:bisect_right(self, n)]
+
+    def grow(self):
+        low = self.limit + 1
+        high = max(2 * self.limit, SEGMENT)
+
+        if self.limit == 1:
+            self.found.extend(crible(high))
+        else:
+            segment = bytearray([1]) * (high - low + 1)
+            for p in self.below(isqrt(high)):
+                start = max(p * p, (low + p - 1) // p * p)
+                segment[start - low::p] = bytes(len(range(start, high + 1, p)))
+            self.found.extend(compress(range(low, high + 1), segment))
+
+        self.limit = high
+        if self.path is not None:
+            self.save()
+
+    def save(self):
+        temporary = f"{self.path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as file:
+            file.write(MAGIC)
+            file.write(array("Q", [self.limit]).tobytes())
+            file.write(self.cached.tobytes())
+            file.write(self.found.tobytes())
+        os.replace(temporary, self.path)
+
+    def load(self, path: str) -> int:
+        """Maps the table stored at path if it goes further than this one, returns how far it goes"""
+        with open(path, "rb") as file:
+            mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped[:8] != MAGIC:
+            raise ValueError(f"{path} is not a prime table")
+        limit = memoryview(mapped)[8:16].cast("Q")[0]
+        if limit > self.limit:
+            self.cached = memoryview(mapped)[16:].cast("Q")
+            self.found = array("Q")
+            self.limit = limit
+        return limit
+
+TABLE = PrimeTable()
+
+def use_cache(path: str):
+    """
+    Keeps the prime table in the file at path: it is loaded from there (if it exists)
+    and saved there every time it grows.
+    """
+    stored = TABLE.load(path) if os.path.exists(path) else 0
+    TABLE.path = path
+    if TABLE.limit > max(stored, 1):
+        TABLE.save()
+
+if "FRACTRAN_PRIMES" in os.environ:
+    use_cache(os.environ["FRACTRAN_PRIMES"])
+
+def __getattr__(name: str):
+    # PRIMES used to be a list built at import time, it is now the lazy table
+    if name == "PRIMES":
+        return TABLE
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# trial division only goes that far, the larger factors are found by pollard_rho
+TRIAL_LIMIT = 1000
+SMALL_PRIMES = crible(TRIAL_LIMIT)
+
+def valuation(n: int, p: int) -> tuple[int, int]:
+    """
+    Returns (e, n // p^e) with p^e the largest power of p dividing n.
+    The exponent is found by squaring p until it no longer divides n and going back down
+    (a binary search on e), hence O(log e) divisions instead of e of them,
+    which matters a lot for the 2^1000000 kind of inputs.
+    0 being divisible by every power of p, it is given no exponent (0, 0) as prime_factors used to do.
+    """
+    if n == 0:
+        return 0, 0
+    if n % p != 0:
+        return 0, n
+    if n % (p * p) != 0:
+        return 1, n // p
+
+    powers = [p]
+    while n % (powers[-1] * powers[-1]) == 0:
+        powers.append(powers[-1] * powers[-1])
+
+    e = 0
+    for k in reversed(range(len(powers))):
+        if n % powers[k] == 0:
+            n //= powers[k]
+            e += 1 << k
+    return e, n
+
+def is_prime(n: int) -> bool:
+    """Miller-Rabin, deterministic below 3.3 * 10^24 and almost surely right above"""
+    if n < 2:
+        return False
+    for p in SMALL_PRIMES[:13]:
+        if n % p == 0:
+            return n == p
+
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+
+    for a in SMALL_PRIMES[:13]:
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+def pollard_rho(n: int) -> int:
+    """Returns a non trivial divisor of the composite n (Brent's variant)"""
+    if n % 2 == 0:
+        return 2
+    if isqrt(n) ** 2 == n:
+        return isqrt(n)
+
+    for c in range(1, n):
+        y, m = 2, 128
+        g, r, q = 1, 1, 1
+        while g == 1:
+            x = y
+            for _ in range(r):
+                y = (y * y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for _ in range(min(m, r - k)):
+                    y = (y * y + c) % n
+                    q = q * abs(x - y) % n
+                g = gcd(q, n)
+                k += m
+            r *= 2
+
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys * ys + c) % n
+                g = gcd(abs(x - ys), n)
+
+        if g != n:
+            return g
+
+def trial_division(n: int, basis: Iterable[int] = ()) -> tuple[dict[int, int], int]:
+    """
+    The cheap part of factorize: the primes of basis and the small ones, plus what is left when it is a prime.
+    Returns these factors (unsorted) along with the cofactor still to be split, 1 when there is none
+    (it never has a factor below TRIAL_LIMIT, but it may be a prime far beyond).
+    """
+    factors = {}
+
+    for p in basis:
+        e, n = valuation(n, p)
+        if e:
+            factors[p] = e
+
+    for p in SMALL_PRIMES:
+        if p * p > n:
+            if n > 1:
+                factors[n] = factors.get(n, 0) + 1
+            return factors, 1
+        if n % p == 0:
+            e, n = valuation(n, p)
+            factors[p] = factors.get(p, 0) + e
+    return factors, n
+
+def factorize(n: int, basis: Iterable[int] = ()) -> dict[int, int]:
+    """
+    Decomposition of n as {prime: exponent}, sorted by prime.
+
+    The primes of basis (typically the ones occurring in a program) are stripped first,
+    the other small primes by trial division, and whatever is left is split by pollard_rho.
+    Most values met while running a program only have primes of its basis,
+    in which case the exponents are all that is computed.
+    """
+    factors, n = trial_division(n, basis)
+
+    # splits the cofactor down to its distinct primes, the exponents are taken afterwards
+    pending, found = [n], set()
+    while pending:
+        m = pending.pop()
+        if m == 1:
+            continue
+        if is_prime(m):
+            found.add(m)
+        else:
+            d = pollard_rho(m)
+            pending += [d, m // d]
+
+    for p in found:
+        e, n = valuation(n, p)
+        factors[p] = e
 
-PRIMES = crible(100000)
+    return dict(sorted(factors.items()))
 
 def prime_factors(n: int) -> list[int]:
-    # heuristic: since the complete decomposition uses a crible
-    # we first divide many known primes to reduce the size of our input
-    # many programs were meant to only return 3^Q * P or 3^Q hence this often seals the deal
-    factors = []
-    for p in PRIMES:
-        if n < p:
-            break
-        while n % p == 0:
-            n //= p
-            factors.append(p)
-
-    if n > 1:
-        limit = int(n**0.5) + 1
-        primes = crible(limit)
-
-        for p in primes:
-            while n % p == 0:
-                factors.append(p)
-                n //= p
-
-    return factors
\ No newline at end of file
+    return [p for p, e in factorize(n).items() for _ in range(e)]
@@ -0,0 +1,113 @@
+from dataclasses import dataclass, field
+from collections import Counter
+from time import perf_counter
+from fractran import Fraction
+import engines
+
+type State = int | None
+
+@dataclass
+class Profile:
+    """
+    What a run spent its time on.
+
+    hits[j] is how many times the j-th fraction of the program fired.
+    The other fields are keyed by the prime of each state (as found by engines.control_states),
+    None standing for the configurations without a single state holding the token.
+    A loop of circuits.py goes through its first state once per turn,
+    so entries gives the trip counts of the loops, and transitions tells which loop is which.
+    """
+    steps: int = 0
+    seconds: float = 0.0
+    hits: list[int] = field(default_factory=list)
+    state_steps: Counter = field(default_factory=Counter)
+    state_seconds: Counter = field(default_factory=Counter)
+    entries: Counter = field(default_factory=Counter)
+    transitions: Counter = field(default_factory=Counter)
+
+    def report(self, program: list[Fraction], names: dict[int, str] = {}, top: int = 10) -> str:
+        def name(state: State) -> str:
+            if state is None:
+                return "?"
+            return names.get(state, f"E{state}")
+
+        lines = [f"{self.steps} steps in {self.seconds:.3f} s", "", "fractions:"]
+        ranked = sorted(range(len(self.hits)), key=lambda j: -self.hits[j])[:top]
+        for j in ranked:
+            num, den = program[j]
+            lines.append(f"  #{j:<4} {f'{num} / {den}':<24} {self.hits[j]:>12} hits")
+
+        lines += ["", "states:"]
+        for state, steps in self.state_steps.most_common(top):
+            lines.append(
+                f"  {name(state):<8} {steps:>12} steps {self.state_seconds[state]:>9.3f} s "
+                f"{self.entries[state]:>10} entries"
+            )
+
+        lines += ["", "transitions:"]
+        for (source, target), count in self.transitions.most_common(top):
+            lines.append(f"  {name(source):>8} -> {name(target):<8} {count:>10}")
+
+        return "\n".join(lines)
+
+def profile_registers(compiled: engines.Compiled,
+                      registers: list[int],
+                      max_steps: int | None = None) -> Profile:
+    """
+    Same loop as engines.run (the registers are modified in place), but counting as it goes.
+    The counters are plain list and local increments, and the clock is only read when the state changes,
+    so that profiling costs a small factor instead of one Python call per step.
+    """
+    table = compiled.dispatch.table
+    basis = compiled.basis
+    state = compiled.dispatch.current(registers)
+    hits = [0] * len(compiled.fractions)
+    state_steps, state_seconds = Counter(), Counter()
+    entries, transitions = Counter(), Counter()
+
+    def key(state: engines.Register) -> State:
+        return basis[state] if state >= 0 else None
+
+    start = last = perf_counter()
+    entered = 0
+    steps = 0
+    limit = -1 if max_steps is None else max_steps
+    entries[key(state)] += 1
+
+    while steps != limit:
+        for j, guard, delta, move in table[state]:
+            for i, a in guard:
+                if registers[i] < a:
+                    break
+            else:
+                for i, d in delta:
+                    registers[i] += d
+                hits[j] += 1
+                if move is not None and move != state:
+                    now = perf_counter()
+                    source, target = key(state), key(move)
+                    state_steps[source] += steps + 1 - entered
+                    state_seconds[source] += now - last
+                    entries[target] += 1
+                    transitions[source, target] += 1
+                    last, entered, state = now, steps + 1, move
+                break
+        else:
+            break
+        steps += 1
+
+    now = perf_counter()
+    state_steps[key(state)] += steps - entered
+    state_seconds[key(state)] += now - last
+    return Profile(steps, now - start, hits, state_steps, state_seconds, entries, transitions)
+
+def profile(program: list[Fraction],
+            n: int,
+            max_steps: int | None = None,
+            compiled: engines.Compiled | None = None) -> tuple[int, Profile]:
+    """Runs program on n and returns the output (or where the run stopped) along with its profile"""
+    if compiled is None:
+        compiled = engines.compile_program(program)
+    registers, cofactor = engines.to_registers(compiled, n)
+    result = profile_registers(compiled, registers, max_steps)
+    return engines.from_registers(compiled, registers, cofactor), result
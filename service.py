@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+from time import monotonic
+from fractran import Fraction
+from checkpoint import Run
+import checkpoint
+import engines
+import pretty
+import cache
+import asyncio
+import json
+import os
+import sys
+
+# seconds run on the event loop between two yields
+SLICE_SECONDS = 0.01
+# seconds a job may run on the event loop before it is moved to the process pool
+INLINE_SECONDS = 0.1
+# seconds run by a worker of the pool before the job comes back to the event loop
+OFFLOAD_SECONDS = 2.0
+
+def advance_slice(run: Run, engine: str, max_steps: int | None, max_seconds: float) -> Run:
+    """Runs in the workers of the pool, where the macro engine keeps what it learned from one slice to the next"""
+    return checkpoint.advance(run, engine, max_steps=max_steps, max_seconds=max_seconds)
+
+async def evaluate_async(program: list[Fraction],
+                         n: int | engines.Factors,
+                         engine: str = "macro",
+                         max_steps: int | None = None,
+                         pool: ProcessPoolExecutor | None = None,
+                         compiled: engines.Compiled | None = None) -> Run:
+    """
+    Evaluates program on n without blocking the event loop for long:
+    the run goes by slices of SLICE_SECONDS seconds, yielding to the other tasks in between,
+    and once it took INLINE_SECONDS seconds it goes on in the pool (when one is given) by slices of OFFLOAD_SECONDS seconds,
+    so that a few long jobs do not slow down the many short ones.
+    The slices are timed rather than counted in steps, a single step of the macro engine standing for billions of them.
+
+    The run stops after max_steps steps (the returned Run did not halt then).
+    Cancelling the task stops the run at the end of the current slice.
+    """
+    run = checkpoint.start(program, n)
+    # made once, the macro engine keeping what it learned from one slice to the next
+    compiled, runner = engines.runner_for(program, engine, compiled)
+    inline = 0.0
+
+    while not run.halted and (max_steps is None or run.steps < max_steps):
+        budget = None if max_steps is None else max_steps - run.steps
+        if pool is not None and inline >= INLINE_SECONDS:
+            loop = asyncio.get_running_loop()
+            run = await loop.run_in_executor(pool, advance_slice, run, engine, budget, OFFLOAD_SECONDS)
+        else:
+            start = monotonic()
+            run = checkpoint.advance(run, engine, budget, SLICE_SECONDS, compiled=compiled, runner=runner)
+            inline += monotonic() - start
+            await asyncio.sleep(0)
+
+    return run
+
+class Server:
+    """
+    Serves the programs of a directory by name over a local socket, one JSON object per line each way:
+    {"program": "collatz", "input": "2^5 * 3", "max_steps": 1000000, "engine": "macro"}
+    is answered by {"output": "...", "steps": ..., "halted": ...} (or {"error": "..."}).
+    """
+
+    def __init__(self, directory: str = "programs", workers: int | None = None):
+        self.directory = directory
+        self.programs = {}
+        self.pool = ProcessPoolExecutor(workers)
+
+    def program(self, name: str) -> tuple[list[Fraction], engines.Compiled]:
+        if name not in self.programs:
+            if os.path.basename(name) != name or not os.path.isfile(os.path.join(self.directory, name)):
+                raise ValueError(f"unknown program {name!r}")
+            self.programs[name] = cache.load(os.path.join(self.directory, name))
+        return self.programs[name]
+
+    async def answer(self, request) -> dict:
+        try:
+            if not isinstance(request, dict):
+                raise ValueError("the request must be a JSON object")
+            for key in ["program", "input"]:
+                if not isinstance(request[key], str):
+                    raise ValueError(f"{key} must be a string")
+            program, compiled = self.program(request["program"])
+            engine = request.get("engine", "macro")
+            if not isinstance(engine, str) or engine not in engines.RUNNERS:
+                raise ValueError(f"unknown engine {engine!r}")
+            max_steps = request.get("max_steps")
+            if max_steps is not None and (type(max_steps) is not int or max_steps < 0):
+                raise ValueError("max_steps must be a non-negative integer")
+            factors = pretty.pretty_prime_factors_to_factors(request["input"])
+            run = await evaluate_async(program, factors, engine, max_steps, self.pool, compiled)
+        except (KeyError, ValueError) as error:
+            return {"error": str(error)}
+        return {"output": pretty.factors_to_pretty_prime_factors(run.factors), "steps": run.steps, "halted": run.halted}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                try:
+                    request = json.loads(line)
+                except json.JSONDecodeError as error:
+                    response = {"error": str(error)}
+                else:
+                    response = await self.answer(request)
+                writer.write(json.dumps(response).encode() + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./service.py [port] [directory]
+
+    serves the programs of directory (programs/ by default) on 127.0.0.1:port (8765 by default),
+    see Server for the protocol, for instance:
+
+    echo '{"program": "sum", "input": "2^10 * 5"}' | nc 127.0.0.1 8765
+    """
+
+    port = int(sys.argv[1]) if len(sys.argv) >= 2 else 8765
+    directory = sys.argv[2] if len(sys.argv) >= 3 else "programs"
+    asyncio.run(Server(directory).serve(port=port))
@@ -1,116 +1,122 @@
 #!/usr/bin/env python3
 
+from typing import Callable, Iterator
 import fractran
+import engines
+import analysis
+import batch
+import bench
+import binary
+import cache
+import checkpoint
+import circuits
+import compiler
+import fuzz
+import jit
+import lockstep
+import memo
+import optimizer
 import pretty
-from time import time
+import primes
+import profiler
+import service
+import tracing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache, partial
+from time import monotonic, time
+import math
+import asyncio
+import os
+import random
+import tempfile
+import traceback
+import sys
 
 COUNT = 0
+FAILURES: list[str] = []
 
-def test(prog: str, inp: int, expected: int, opt: bool = False):
-    global COUNT
-
-    if not opt:
-        out = fractran.evaluate(fractran.program_from_file(f"programs/{prog}"), inp)
-    else:
-        out = fractran.evaluate2(fractran.program_from_file(f"programs/{prog}"), inp)
+type Engine = Callable[[list[fractran.Fraction], int], int]
+# the inputs of a program along with their expected outputs
+type Grid = Iterator[tuple[int, int]]
 
-    try:
-        assert out == expected
-    except AssertionError:
-        print(f"Test failed on program {prog}")
-        print(f"Input: {pretty.int_to_pretty_registers(inp)}")
-        print(f"Expected outcome: {pretty.int_to_pretty_registers(expected)}")
-        print(f"Received outcome: {pretty.int_to_pretty_registers(out)}")
-        exit(1)
+@lru_cache(maxsize=None)
+def load(prog: str) -> list[fractran.Fraction]:
+    """Each program is read once per process"""
+    return fractran.program_from_file(f"programs/{prog}")
 
-    COUNT += 1
+def check(prog: str, inp: int, expected: int, engine: Engine = fractran.evaluate) -> str | None:
+    """Runs one input, returning what went wrong if it did"""
+    out = engine(load(prog), inp)
 
-def run_tests(opt: bool = False):
+    if out != expected:
+        return "\n".join([
+            f"Test failed on program {prog}",
+            f"Input: {pretty.int_to_pretty_registers(inp)}",
+            f"Expected outcome: {pretty.int_to_pretty_registers(expected)}",
+            f"Received outcome: {pretty.int_to_pretty_registers(out)}",
+        ])
+    return None
 
-    # accumulate:
+def accumulate_grid() -> Grid:
     for dst in range(10):
         for src in range(10):
-            inp = 2**dst * 3**src * 5
-            expected = 2**(dst + src) * 3**src
-            test("accumulate", inp, expected, opt)
+            yield 2**dst * 3**src * 5, 2**(dst + src) * 3**src
 
-    # accumulate_and_destroy:
+def accumulate_and_destroy_grid() -> Grid:
     for dst in range(10):
         for src in range(10):
-            inp = 2**dst * 3**src * 5
-            expected = 2**(dst + src)
-            test("accumulate_and_destroy", inp, expected, opt)
-    
-    # add
+            yield 2**dst * 3**src * 5, 2**(dst + src)
+
+def add_grid() -> Grid:
     for dst in range(5):
         for x in range(10):
             for y in range(10):
-                inp = 2**dst * 3**x * 5**y * 7
-                expected = 2**(x + y) * 3**x * 5**y
-                test("add", inp, expected, opt)
-    
-    # copy
+                yield 2**dst * 3**x * 5**y * 7, 2**(x + y) * 3**x * 5**y
+
+def copy_grid() -> Grid:
     for dst in range(10):
         for src in range(10):
-            inp = 2**dst * 3**src * 5
-            expected = 2**src * 3**src
-            test("copy", inp, expected, opt)
-    
-    # increments
-    for i in [1, 2, 5]:
-        for x in range(10):
-            inp = 2**x * 3
-            expected = 2**(x+i)
-            test(f"increment_{i}", inp, expected, opt)
-    
-    # decrement
+            yield 2**dst * 3**src * 5, 2**src * 3**src
+
+def increment_grid(i: int) -> Grid:
     for x in range(10):
-        inp = 2**x * 3
-        expected = 2**(max(0, x-1))
-        test(f"decrement", inp, expected, opt)
+        yield 2**x * 3, 2**(x+i)
 
-    # goto
-    test("goto", 2**1, 3**1, opt)
+def decrement_grid() -> Grid:
+    for x in range(10):
+        yield 2**x * 3, 2**(max(0, x-1))
+
+def goto_grid() -> Grid:
+    yield 2**1, 3**1
 
-    # clear
+def clear_grid() -> Grid:
     for x in range(20):
-        inp = 2**x * 3
-        expected = 1
-        test("clear", inp, expected, opt)
+        yield 2**x * 3, 1
 
-    # euclidian_division
+def euclidian_division_grid() -> Grid:
     for n in range(20):
         for d in range(1, n):
             for o1 in range(3):
                 for o2 in range(3):
                     inp = 2**n * 3**d * 5**o1 * 7**o2 * 11
-                    exp_q = n // d
-                    exp_r = n % d
-                    expected = 2**n * 3**d * 5**exp_q * 7**exp_r
-                    test("euclidian_division", inp, expected, opt)
-    
-    # multiply
+                    yield inp, 2**n * 3**d * 5**(n // d) * 7**(n % d)
+
+def multiply_grid() -> Grid:
     for x in range(10):
         for y in range(10):
             for o in range(3):
-                inp = 2**x * 3**y * 5**o * 7
-                expected = 2**x * 3**y * 5**(x*y)
-                test("multiply", inp, expected, opt)
-    
-    # multiply_on
+                yield 2**x * 3**y * 5**o * 7, 2**x * 3**y * 5**(x*y)
+
+def multiply_on_grid() -> Grid:
     for x in range(10):
         for y in range(10):
-            inp = 2**x * 3**y * 5
-            expected = 2**(x*y) * 3**y
-            test("multiply_on", inp, expected, opt)
+            yield 2**x * 3**y * 5, 2**(x*y) * 3**y
 
-    # sum
+def sum_grid() -> Grid:
     for i in range(20):
-        inp = 2**i * 5
-        expected = 3**(i * (i + 1) // 2)
-        test("sum", inp, expected, opt)
-    
-    # fibonacci
+        yield 2**i * 5, 3**(i * (i + 1) // 2)
+
+def fibonacci_grid() -> Grid:
 
     def fib(n):
         a = 0
@@ -124,11 +130,9 @@ def run_tests(opt: bool = False):
 
     for n in range(10):
         for o in range(3):
-            inp = 2**n * 3**o * 5
-            expected = 3**fib(n)
-            test("fibonacci", inp, expected, opt)
+            yield 2**n * 3**o * 5, 3**fib(n)
 
-    # collatz
+def collatz_grid() -> Grid:
 
     def collatz(n):
         i = 0
@@ -142,41 +146,868 @@ def run_tests(opt: bool = False):
 
     for n in range(10):
         for o in range(3):
-            inp = 2**n * 3**o * 5
-            expected = 3**collatz(n)
-            test("collatz", inp, expected, opt)
-
-    # sqrt
+            yield 2**n * 3**o * 5, 3**collatz(n)
 
+def sqrt_grid() -> Grid:
     for n in range(20):
         for o in range(3):
-            inp = 2**n * 3**o * 5
-            expected = 2**n * 3**(int(n**0.5))
-            test("sqrt", inp, expected, opt)
+            yield 2**n * 3**o * 5, 2**n * 3**(int(n**0.5))
 
-    # factorial
+def factorial_grid() -> Grid:
+    for n in range(1, 7):
+        yield 2**n * 3, 2**math.factorial(n)
 
-    def factorial(n):
-        out = 1
-        for k in range(2, n+1):
-            out *= k
-        return out
+# one case per program, the slow ones first so that they do not end up last in the pool
+GRIDS: dict[str, Callable[[], Grid]] = {
+    "sqrt": sqrt_grid,
+    "euclidian_division": euclidian_division_grid,
+    "factorial": factorial_grid,
+    "collatz": collatz_grid,
+    "multiply": multiply_grid,
+    "add": add_grid,
+    "fibonacci": fibonacci_grid,
+    "multiply_on": multiply_on_grid,
+    "sum": sum_grid,
+    "accumulate": accumulate_grid,
+    "accumulate_and_destroy": accumulate_and_destroy_grid,
+    "copy": copy_grid,
+    "increment_1": partial(increment_grid, 1),
+    "increment_2": partial(increment_grid, 2),
+    "increment_5": partial(increment_grid, 5),
+    "decrement": decrement_grid,
+    "goto": goto_grid,
+    "clear": clear_grid,
+}
 
-    for n in range(1, 7):
-        inp = 2**n * 3
-        expected = 2**factorial(n)
-        test("factorial", inp, expected, opt)
+def large_multiply_grid() -> Grid:
+    for x, y in [(1000, 1000), (2345, 67)]:
+        yield 2**x * 3**y * 7, 2**x * 3**y * 5**(x*y)
+
+def large_factorial_grid() -> Grid:
+    for n in range(7, 10):
+        yield 2**n * 3, 2**math.factorial(n)
+
+# inputs whose registers are far too large for the step by step interpreters
+LARGE_GRIDS: dict[str, Callable[[], Grid]] = {
+    "factorial": large_factorial_grid,
+    "multiply": large_multiply_grid,
+}
+
+def run_tests(engine: Engine = fractran.evaluate, grids: dict[str, Callable[[], Grid]] = GRIDS):
+    """Every grid on engine, in this process, the failures going to FAILURES"""
+    global COUNT
+
+    for prog, grid in grids.items():
+        for inp, expected in grid():
+            failure = check(prog, inp, expected, engine)
+            if failure is not None:
+                FAILURES.append(failure)
+            COUNT += 1
+
+def run_large_tests(engine: Engine):
+    run_tests(engine, LARGE_GRIDS)
+
+def run_case(prog: str, name: str, large: bool = False) -> tuple[int, list[str], float]:
+    """
+    One program on one engine of ENGINES (or LARGE_ENGINES), by name so that it can be sent to a worker:
+    the number of inputs, the failures and the time taken
+    """
+    engine = dict(LARGE_ENGINES if large else ENGINES)[name]
+    grid = (LARGE_GRIDS if large else GRIDS)[prog]
+    failures = []
+    count = 0
+    start = time()
+
+    for inp, expected in grid():
+        failure = check(prog, inp, expected, engine)
+        if failure is not None:
+            failures.append(failure)
+        count += 1
+
+    return count, failures, time() - start
+
+def run_sharded(workers: int | None = None, verbose: bool = False):
+    """
+    Every program on every engine (and the large inputs), one case per program and engine,
+    spread over a pool of processes (one per core by default, none with a single worker).
+    Prints the time taken per engine and its slowest program (every case with verbose),
+    the failures going to FAILURES.
+    """
+    global COUNT
+
+    shards = [(prog, name, False) for prog in GRIDS for name, _ in ENGINES]
+    shards += [(prog, name, True) for prog in LARGE_GRIDS for name, _ in LARGE_ENGINES]
+
+    workers = workers or os.cpu_count() or 1
+    start = time()
+    if workers == 1:
+        results = [run_case(*shard) for shard in shards]
+    else:
+        with ProcessPoolExecutor(workers) as pool:
+            results = list(pool.map(run_case, *zip(*shards)))
+    wall = int(1000 * (time() - start))
+
+    summary = {}
+    for (prog, name, large), (count, failures, seconds) in zip(shards, results):
+        FAILURES.extend(failures)
+        COUNT += count
+        title = f"{name}, large inputs" if large else name
+        total, failed, elapsed, slowest = summary.get(title, (0, 0, 0, (0, "")))
+        summary[title] = (total + count, failed + len(failures), elapsed + seconds, max(slowest, (seconds, prog)))
+        if verbose:
+            print(f"    [{title}] {prog}: {count} tests in {int(1000 * seconds)} ms")
+
+    for title, (total, failed, elapsed, (seconds, prog)) in summary.items():
+        status = f"{failed} failed!" if failed else "Success!"
+        print(f"[{title}] {status} ({total} tests in {int(1000 * elapsed)} ms, slowest: {prog} in {int(1000 * seconds)} ms)")
+    print(f"[grids] {len(shards)} cases on {workers} workers in {wall} ms")
+
+def run_batch_tests():
+    global COUNT
+
+    program = fractran.program_from_file("programs/sum")
+    inputs = [2**i * 5 for i in range(20)]
+    expected = [3**(i * (i + 1) // 2) for i in range(20)]
+
+    results = list(batch.evaluate_many(program, inputs, workers=2, chunksize=3))
+    assert [r.output for r in results] == expected
+    assert all(r.halted for r in results)
+
+    results = batch.evaluate_many(program, inputs, workers=2, engine="evaluate", ordered=False)
+    assert sorted((r.index, r.output) for r in results) == list(enumerate(expected))
+
+    # stopped runs agree on the partial state
+    for engine in engines.ENGINES:
+        results = batch.evaluate_many(program, inputs, workers=1, engine=engine, max_steps=50)
+        assert [(r.output, r.steps, r.halted) for r in results] == [
+            (r.output, r.steps, r.halted)
+            for r in batch.evaluate_many(program, inputs, workers=1, engine="evaluate", max_steps=50)
+        ]
+
+    COUNT += 3 + len(engines.ENGINES)
+
+def run_profiler_tests():
+    global COUNT
+
+    for prog, n in [("add", 2**3 * 3**4 * 5**5 * 7), ("multiply", 2**6 * 3**7 * 7), ("fibonacci", 2**8 * 5)]:
+        program = fractran.program_from_file(f"programs/{prog}")
+        hits = [0] * len(program)
+
+        def action(current):
+            for j, (num, den) in enumerate(program):
+                if (num * current) % den == 0:
+                    hits[j] += 1
+                    break
+
+        expected = fractran.evaluate(program, n, action)
+        output, profile = profiler.profile(program, n)
+        assert output == expected
+        assert profile.hits == hits
+        assert profile.steps == sum(hits) == sum(profile.state_steps.values())
+        COUNT += 1
+
+def run_tracing_tests():
+    global COUNT
+
+    program = fractran.program_from_file("programs/multiply")
+    n = 2**3 * 3**4 * 7
+    states = []
+    expected = fractran.evaluate(program, n, states.append)
+
+    # the registers before each step are found back from the end of the run
+    output, trace = tracing.record(program, n, size=10)
+    assert output == expected and trace.steps == len(states) - 1
+    assert [step for step, _ in trace.events()] == list(range(trace.steps - 10, trace.steps))
+    lines = list(trace.describe())
+    assert lines[-1].endswith(pretty.int_to_pretty_registers(expected, {}, True))
+    assert lines[0].endswith(pretty.int_to_pretty_registers(states[-11], {}, True))
+
+    _, sampled = tracing.record(program, n, every=7)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "trace")
+        sampled.save(path)
+        loaded = tracing.load(path)
+    assert list(loaded.events()) == list(sampled.events())
+    assert [step for step, _ in loaded.events()] == list(range(0, trace.steps, 7))
+    COUNT += 2
+
+def run_cache_tests():
+    global COUNT
+
+    directory = cache.DIRECTORY
+    with tempfile.TemporaryDirectory() as temporary:
+        cache.DIRECTORY = temporary
+        try:
+            for loaded, prog in enumerate(["add", "multiply", "factorial", "sqrt"], 1):
+                filename = f"programs/{prog}"
+                program = fractran.program_from_file(filename)
+                compiled = engines.compile_program(program)
+                assert cache.load(filename) == (program, compiled)
+                # the second load maps the cache file
+                assert len(os.listdir(cache.DIRECTORY)) == loaded
+                assert cache.load(filename) == (program, compiled)
+                COUNT += 1
+
+            # a truncated or corrupted cache file is compiled again
+            for name in os.listdir(cache.DIRECTORY):
+                path = os.path.join(cache.DIRECTORY, name)
+                with open(path, "rb") as file:
+                    content = file.read()
+                with open(path, "wb") as file:
+                    file.write(content[:-3])
+            for prog in ["add", "multiply", "factorial", "sqrt"]:
+                program = fractran.program_from_file(f"programs/{prog}")
+                assert cache.load(f"programs/{prog}") == (program, engines.compile_program(program))
+                COUNT += 1
+        finally:
+            cache.DIRECTORY = directory
+
+def run_loader_tests():
+    global COUNT
+
+    lines = ["# add two registers", "", "13 / 14   # goto", "  403/21", "7 / 13"]
+    assert list(fractran.read_fractions(lines)) == [(13, 14), (403, 21), (7, 13)]
+    COUNT += 1
+
+    with tempfile.TemporaryDirectory() as directory:
+        for prog in ["add", "multiply", "factorial", "sqrt", "collatz"]:
+            program = fractran.program_from_file(f"programs/{prog}")
+            filename = os.path.join(directory, f"{prog}.bin")
+            binary.write_program(filename, program)
+
+            # the programs of programs/ only have reduced fractions, so they come back as they were
+            assert fractran.program_from_file(filename) == program
+            assert engines.compile_file(filename) == engines.compile_program(program)
+            assert engines.compile_file(f"programs/{prog}") == engines.compile_program(program)
+            COUNT += 1
+
+        # a truncated file is a ValueError, as the other malformed files
+        with open(filename, "rb") as file:
+            content = file.read()
+        for size in [len(binary.MAGIC), len(content) // 2, len(content) - 1]:
+            with open(filename, "wb") as file:
+                file.write(content[:size])
+            for read in [fractran.program_from_file, engines.compile_file]:
+                try:
+                    read(filename)
+                    assert False, size
+                except ValueError as error:
+                    assert "truncated" in str(error)
+                    COUNT += 1
+
+def run_checkpoint_tests():
+    global COUNT
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "checkpoint")
+        for prog, n in [("factorial", 2**5 * 3), ("fibonacci", 2**12 * 5), ("sqrt", 2**50 * 3)]:
+            program = fractran.program_from_file(f"programs/{prog}")
+            expected = fractran.evaluate(program, n)
+
+            # stopping every 1000 steps and going on from the saved run changes nothing
+            run = checkpoint.advance(checkpoint.start(program, n), "compiled", max_steps=1000, checkpoint=path)
+            while not run.halted:
+                assert run.steps % 1000 == 0
+                assert pretty.factors_to_int(run.factors) == fractran.evaluate(program, n, max_steps=run.steps)
+                run = checkpoint.resume(path, engine="compiled", max_steps=1000)
+            assert pretty.factors_to_int(run.factors) == expected
+            assert checkpoint.load(path) == run
+
+            for max_steps in [0, 1, 777]:
+                assert fractran.evaluate2(program, n, max_steps=max_steps) == fractran.evaluate(program, n, max_steps=max_steps)
+            COUNT += 1
+
+        # a checkpoint cut in its program or in its exponents
+        with open(path, "rb") as file:
+            content = file.read()
+        for size in [len(checkpoint.MAGIC) + 1, len(content) // 2, len(content) - 1]:
+            with open(path, "wb") as file:
+                file.write(content[:size])
+            try:
+                checkpoint.load(path)
+                assert False, size
+            except ValueError as error:
+                assert "truncated" in str(error)
+                COUNT += 1
+
+def run_service_tests():
+    global COUNT
+
+    program = fractran.program_from_file("programs/sum")
+
+    async def main():
+        server = service.Server(workers=1)
+        runs = await asyncio.gather(*(service.evaluate_async(program, 2**i * 5) for i in range(20)))
+        assert [pretty.factors_to_int(run.factors) for run in runs] == [3**(i * (i + 1) // 2) for i in range(20)]
+
+        stopped = await service.evaluate_async(program, 2**10 * 5, max_steps=7)
+        assert not stopped.halted and stopped.steps == 7
+        assert pretty.factors_to_int(stopped.factors) == fractran.evaluate(program, 2**10 * 5, max_steps=7)
+
+        assert await server.answer({"program": "sum", "input": "2^3 * 5"}) == {"output": "3^6", "steps": 43, "halted": True}
+        assert "error" in await server.answer({"program": "../tests.py", "input": "2"})
+        # the bulk steps of the macro engine are not cut into slices of a few steps
+        start = monotonic()
+        answer = await server.answer({"program": "factorial", "input": "2^12 * 3"})
+        assert answer["output"] == f"2^{math.factorial(12)}" and answer["halted"]
+        assert monotonic() - start < 1
+        for request in [[1, 2], {"program": "sum", "input": "2", "max_steps": "10"},
+                        {"program": "sum", "input": "2", "max_steps": -1}, {"program": 7, "input": "2"},
+                        {"program": "sum", "input": 2}, {"program": "sum", "input": "2", "engine": []}]:
+            assert "error" in await server.answer(request)
+        server.pool.shutdown()
+
+    # the programs of the server go through cache.load, which must not write to the real cache
+    directory = cache.DIRECTORY
+    with tempfile.TemporaryDirectory() as temporary:
+        cache.DIRECTORY = temporary
+        try:
+            asyncio.run(main())
+        finally:
+            cache.DIRECTORY = directory
+    COUNT += 11
+
+def run_optimizer_tests():
+    global COUNT
+
+    for prog, keep, inputs in [
+        ("sqrt", [2, 3, 5], [2**n * 3**o * 5 for n in range(12) for o in range(3)]),
+        ("collatz", [2, 3, 5], [2**n * 3**o * 5 for n in range(8) for o in range(3)]),
+        ("fibonacci", [2, 3, 5], [2**n * 3**o * 5 for n in range(10) for o in range(3)]),
+        ("factorial", [2, 3], [2**n * 3 for n in range(1, 6)]),
+    ]:
+        program = fractran.program_from_file(f"programs/{prog}")
+        for samples in [[], inputs[::7]]:
+            optimized = optimizer.optimize(program, keep, samples)
+            before, after = engines.compile_program(program), engines.compile_program(optimized)
+            runners = [engines.runner_for(optimized, engine, after)[1] for engine in ["accelerated", "macro"]]
+            steps = [0, 0]
+            for k, n in enumerate(inputs):
+                outputs = []
+                for version, compiled in enumerate((before, after)):
+                    registers, cofactor = engines.to_registers(compiled, n)
+                    steps[version] += engines.run(compiled, registers)
+                    outputs.append(engines.from_registers(compiled, registers, cofactor))
+                assert outputs[0] == outputs[1] == fractran.evaluate(optimized, n)
+                for runner in runners if k % 4 == 0 else []:
+                    registers, cofactor = engines.to_registers(after, n)
+                    runner(registers)
+                    assert engines.from_registers(after, registers, cofactor) == outputs[0]
+                COUNT += 1
+            assert steps[1] < steps[0]
+
+    # the drains of the temporaries left empty go, so that the unrolled loops do not make collatz longer
+    assert len(optimizer.optimize(load("collatz"), [2, 3, 5])) < len(load("collatz"))
+    COUNT += 1
+
+    # L1 divides by r3, which is always 0: once the drains are gone nothing leaves the loop, which fuse must not follow
+    circuit = fuzz.random_circuit(random.Random("o:8"), size=6)
+    program = optimizer.optimize(compiler.compile_circuit(circuit), primes.PRIMES[:len(circuit.registers) + 1])
+    assert len(program) < len(compiler.compile_circuit(circuit))
+    COUNT += 1
+
+    # random circuits of compiler.py, keeping their registers and first state, on inputs following the conventions
+    for i in range(40):
+        rng = random.Random(f"optimizer:{i}")
+        circuit = fuzz.random_circuit(rng, size=6)
+        program = compiler.compile_circuit(circuit)
+        keep = primes.PRIMES[:len(circuit.registers) + 1]
+        before = batch.prepare(program, "compiled")
+        after = batch.prepare(optimizer.optimize(program, keep), "compiled")
+        for _ in range(4):
+            n = math.prod(p**rng.randint(0, 4) for p in keep[:-1]) * keep[-1]
+            output, _, halted = before(n, 20000, None)
+            if halted:
+                assert after(n, 40000, None)[::2] == (output, True)
+                COUNT += 1
+
+def run_cycles_tests():
+    global COUNT
+
+    # A (2) moves to B (3) with x (11), B moves to C (5) with x and z (17), else to D (7), and x drains last:
+    # B being closed by its goto, the drain never follows the first fraction and x is still there for the second one
+    program = [(3 * 11, 2), (5 * 13, 3 * 11 * 17), (7, 3), (1, 11)]
+    compiled = engines.compile_program(program)
+    cycles = engines.find_cycles(compiled)
+    assert [[c.positions[-1][0] for c in found] for found in cycles] == [[0, 2], [1, 3], [2], [3]]
+    COUNT += 1
+
+    for n in [2 * 17, 2 * 11 * 17, 2 * 11**3, 3 * 11**2 * 17]:
+        accelerated, plain = [engines.to_registers(compiled, n)[0] for _ in range(2)]
+        assert engines.run_accelerated(compiled, accelerated, cycles) == engines.run(compiled, plain)
+        assert accelerated == plain
+        assert engines.evaluate_accelerated(program, n) == fractran.evaluate(program, n)
+        COUNT += 1
+
+def run_dispatch_tests():
+    global COUNT
+
+    # the program of run_cycles_tests: A (2) and B (3) are closed by their gotos, so the drain is only tried without a state
+    program = [(3 * 11, 2), (5 * 13, 3 * 11 * 17), (7, 3), (1, 11)]
+    dispatch = engines.compile_program(program).dispatch
+    a, b = sorted(dispatch.states)
+    assert {s: [entry[0] for entry in entries] for s, entries in dispatch.table.items()} == {
+        engines.NO_STATE: [3], engines.ANY_STATE: [0, 1, 2, 3], a: [0], b: [1, 2],
+    }
+    assert dispatch.earlier == [[], [], [1], []]
+    COUNT += 2
+
+    # past the budget (many stateless fractions), the states are ignored and every step scans the whole program
+    program += [(1, p) for p in primes.crible(2000)[7:157]]
+    dispatch = engines.compile_program(program).dispatch
+    assert dispatch.states == set() and dispatch.earlier is None
+    assert dispatch.table[engines.NO_STATE] == dispatch.table[engines.ANY_STATE]
+    assert len(dispatch.table[engines.ANY_STATE]) == len(program)
+    COUNT += 1
+
+    budget = engines.DISPATCH_BUDGET
+    engines.DISPATCH_BUDGET = 1000
+    try:
+        assert engines.compile_program(program).dispatch.earlier is not None
+    finally:
+        engines.DISPATCH_BUDGET = budget
+    COUNT += 1
+
+    for n in [2 * 17, 2 * 11 * 17 * 23**3 * 29, 3 * 11**2 * 17 * 31]:
+        expected = fractran.evaluate(program, n)
+        assert engines.evaluate_compiled(program, n) == engines.evaluate_accelerated(program, n) == expected
+        COUNT += 1
+
+def run_native_tests():
+    global COUNT
+
+    # exponents crossing the int64 limit during the run, and from the start
+    compiled = engines.compile_program([(2, 3)])
+    x, y = compiled.index[2], compiled.index[3]
+    for start, count in [(engines.INT64_MAX - engines.CHECK_EVERY - 10, 5000), (engines.INT64_MAX, 10), (0, 5000)]:
+        registers = [0, 0]
+        registers[x], registers[y] = start, count
+        assert engines.run_native(compiled, registers) == count
+        assert registers[x] == start + count and registers[y] == 0
+        COUNT += 1
+
+    # stopping after max_steps leaves the registers where the other engines leave them
+    compiled = engines.compile_program(fractran.program_from_file("programs/collatz"))
+    for max_steps in [1, 1000, 5000]:
+        native, plain = [engines.to_registers(compiled, 2**9 * 5)[0] for _ in range(2)]
+        assert engines.run_native(compiled, native, max_steps) == engines.run(compiled, plain, max_steps)
+        assert native == plain
+        COUNT += 1
+
+    # not an engine of the grids (see run_native), a few of them still go through it
+    for prog in ["collatz", "multiply", "euclidian_division"]:
+        compiled = engines.compile_program(load(prog))
+        for inp, expected in GRIDS[prog]():
+            registers, cofactor = engines.to_registers(compiled, inp)
+            engines.run_native(compiled, registers)
+            assert engines.from_registers(compiled, registers, cofactor) == expected
+            COUNT += 1
+
+def run_jit_tests():
+    global COUNT
+
+    # stopping after max_steps (or at a deadline) leaves the registers where run leaves them
+    compiled = engines.compile_program(load("collatz"))
+    for max_steps in [0, 1, 1000, 5000, None]:
+        generated, plain = [engines.to_registers(compiled, 2**9 * 5)[0] for _ in range(2)]
+        assert engines.run_jit(compiled, generated, max_steps) == engines.run(compiled, plain, max_steps)
+        assert generated == plain
+        COUNT += 1
+    generated, plain = [engines.to_registers(compiled, 2**9 * 5)[0] for _ in range(2)]
+    assert engines.run_jit(compiled, generated, deadline=monotonic() + 10) == engines.run(compiled, plain)
+    assert generated == plain
+    COUNT += 1
+
+    # the function is generated once per program
+    assert jit.runner(compiled) is jit.runner(engines.compile_program(load("collatz")))
+    COUNT += 1
+
+    # for the last MAX_RUNNERS programs only
+    for k in range(jit.MAX_RUNNERS + 10):
+        jit.runner(engines.compile_program([(3, 2), (k + 5, 7)]))
+    assert len(jit.RUNNERS) == jit.MAX_RUNNERS
+    assert jit.key(compiled) not in jit.RUNNERS
+    COUNT += 2
+
+    # two tokens in the states of add: the generated code leaves it to run
+    compiled = engines.compile_program(load("add"))
+    generated, plain = [engines.to_registers(compiled, 2 * 3**4 * 5**2 * 7 * 17)[0] for _ in range(2)]
+    assert compiled.dispatch.current(generated) == engines.ANY_STATE
+    assert engines.run_jit(compiled, generated) == engines.run(compiled, plain) and generated == plain
+    COUNT += 1
+
+    # a single data register, and no state at all
+    for program, n, expected in [([(3, 2)], 2**5, 3**5), ([(1, 2)], 2**7 * 3, 3), ([(4, 6)], 2 * 3**4, 2**5)]:
+        assert engines.evaluate_jit(program, n) == expected
+        COUNT += 1
+
+def run_compiler_tests():
+    global COUNT
+
+    # builds are reproducible, whatever was built before and in the other threads
+    for make, prog in [(circuits.make_sqrt, "sqrt"), (circuits.make_collatz, "collatz")]:
+        with ThreadPoolExecutor(4) as pool:
+            builds = list(pool.map(lambda _: make(), range(8)))
+        assert all(build == fractran.program_from_file(f"programs/{prog}") for build in builds)
+        COUNT += 1
+
+    allocator = circuits.Allocator(reserved=[3])
+    assert allocator.uniques(3) == [2, 5, 7]
+    allocator.release(5)
+    assert allocator.uniques(2) == [5, 11]
+    try:
+        circuits.unique()
+        assert False
+    except RuntimeError:
+        pass
+    COUNT += 2
+
+    def collatz(n):
+        i = 0
+        while n > 1:
+            i += 1
+            n = n // 2 if n % 2 == 0 else 3 * n + 1
+        return i
+
+    for prog, expected in [("sqrt", lambda n: 2**n * 3**math.isqrt(n)), ("collatz", lambda n: 3**collatz(n))]:
+        circuit, program = compiler.compile_file(f"sources/{prog}.rm")
+        assert compiler.compile_file(f"sources/{prog}.rm", workers=2)[1] == program
+        assert len(program) == len(fractran.program_from_file(f"programs/{prog}"))
+        for n in range(12):
+            assert engines.evaluate_compiled(program, 2**n * 3 * 5) == expected(n)
+            COUNT += 1
+
+    for source in ["A: inc -> halt", "A: jump x -> halt", "A: inc x -> B", "A: inc x -> halt\nA: dec x -> halt",
+                   "A: branch x -> halt", "A: copy A x -> halt", "A inc x -> halt"]:
+        try:
+            compiler.parse(source.splitlines())
+            assert False, source
+        except ValueError:
+            COUNT += 1
+
+def run_lockstep_tests():
+    global COUNT
+
+    grids = {
+        "add": [2**dst * 3**x * 5**y * 7 for dst in range(5) for x in range(10) for y in range(10)],
+        "euclidian_division": [2**n * 3**d * 11 for n in range(20) for d in range(1, n)],
+        "fibonacci": [2**n * 3**o * 5 for n in range(10) for o in range(3)],
+    }
+
+    for prog, inputs in grids.items():
+        program = fractran.program_from_file(f"programs/{prog}")
+        assert lockstep.evaluate_lockstep(program, inputs) == [fractran.evaluate(program, n) for n in inputs]
+        COUNT += len(inputs)
+
+    # large deltas, rows close to the int64 limit and deltas past it: the results of run_native
+    for fractions, rows in [
+        ([({2: 2**60}, {3: 1})], [[20, 0], [3, 5]]),
+        ([({2: 1}, {3: 1})], [[3, engines.INT64_MAX], [2000, engines.INT64_MAX - 2000], [5, 0]]),
+        ([({2: 2**70}, {3: 1})], [[3, 0], [0, 2]]),
+    ]:
+        compiled = engines.compile_factors(fractions)
+        native = [list(row) for row in rows]
+        assert lockstep.run_lockstep(compiled, rows) == [engines.run_native(compiled, row) for row in native]
+        assert rows == native
+        COUNT += len(rows)
+
+def run_bench_tests():
+    global COUNT
+
+    measures = bench.run_bench(["sum", "fibonacci"], ["evaluate", "compiled"], scale=3, repeat=1)
+    assert [(m.program, m.engine, m.inputs) for m in measures] == [
+        ("sum", "evaluate", 3), ("sum", "compiled", 3), ("fibonacci", "evaluate", 3), ("fibonacci", "compiled", 3)
+    ]
+    assert measures[0].steps == measures[1].steps == sum(bench.count_steps(
+        fractran.program_from_file("programs/sum"), 2**n * 5) for n in range(1, 4))
+    COUNT += 2
+
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "bench.json")
+        bench.save(filename, measures, scale=3)
+        assert bench.load(filename) == measures
+    COUNT += 1
+
+    slower = [bench.Measure(**(vars(m) | {"seconds": 2 * m.seconds})) for m in measures]
+    assert bench.compare(measures, measures) == []
+    assert len(bench.compare(measures, slower, threshold=0.2)) == len(measures)
+    assert bench.compare(slower, measures) == []
+    assert bench.compare(measures, [bench.Measure(**(vars(slower[0]) | {"inputs": 2}))]) == []
+    COUNT += 4
+
+def run_fuzz_tests():
+    global COUNT
+
+    # the engines agree on random programs and circuits
+    assert list(fuzz.fuzz(60, seed=1, workers=1)) == []
+    COUNT += 60
+
+    # a broken engine is caught, and shrunk to a one-fraction program
+    engines.ENGINES["broken"] = lambda program, n, action=lambda _: (): fractran.evaluate(program[:1], n, action)
+    try:
+        found = list(fuzz.fuzz(3, seed=1, names=["evaluate", "broken"], workers=1))
+    finally:
+        del engines.ENGINES["broken"]
+    assert found and all(len(d.case.program) == 2 for d in found)
+    COUNT += 1
+
+    # unreduced fractions: 6/3 applies to any integer
+    assert fuzz.agree(fuzz.outcomes(fuzz.Case([(6, 3)], 5), fuzz.default_names(), 10))
+    COUNT += 1
+
+    # the lockstep engine is cross-checked too when numpy is there
+    assert ("lockstep" in fuzz.default_names()) == (lockstep.np is not None)
+    COUNT += 1
+
+def run_analysis_tests():
+    global COUNT
+
+    # A (7) moves 2 to 3 going round with C (13), then goes to B (11) which goes back to A while 5 lasts
+    program = [(3 * 13, 2 * 7), (7, 13), (11, 7), (7, 5 * 11), (17, 11)]
+    result = analysis.analyze(program)
+    assert result.states == [7, 11, 13] and result.registers == [2, 3, 5, 17]
+    assert result.components == [[7, 11, 13]] and result.loops() == [[7, 11, 13]]
+    assert [(t.source, t.target) for t in result.transitions] == [(7, 13), (13, 7), (7, 11), (11, 7), (11, None)]
+    assert result.touched([7, 11, 13]) == {2, 3, 5, 17}
+    COUNT += 4
+
+    for prog in GRIDS:
+        program = load(prog)
+        result = analysis.analysis_of(tuple(program))
+        compiled = engines.compile_program(program)
+        assert set(result.states) == {compiled.basis[s] for s in engines.control_states(compiled)}
+        assert sorted(s for c in result.components for s in c) == result.states
+
+        # the components come in topological order, and every state is reached from a start
+        position = {s: k for k, c in enumerate(result.components) for s in c}
+        reached, frontier = set(), list(result.entries())
+        while frontier:
+            state = frontier.pop()
+            if state not in reached:
+                reached.add(state)
+                frontier += [t for t in result.successors(state) if t is not None]
+                assert all(position[t] >= position[state] for t in result.successors(state) if t is not None)
+        assert reached == set(result.states)
+
+        dot = analysis.to_dot(result)
+        assert dot.startswith("digraph") and dot.count("->") == sum(
+            1 for t in result.transitions if t.source is not None and not t.dead
+        )
+        COUNT += 1
+
+def run_memo_tests():
+    global COUNT
+
+    program = load("sqrt")
+    compiled = engines.compile_program(program)
+    memoized = memo.Memo()
+    for n in range(20):
+        registers, cofactor = engines.to_registers(compiled, 2**n * 5)
+        steps = engines.run(compiled, registers)
+        expected = engines.from_registers(compiled, registers, cofactor), steps
+        assert memoized.evaluate(program, 2**n * 5) == expected
+        assert memoized.evaluate(program, 2**n * 5) == expected
+        COUNT += 1
+    assert memoized.results.hits == 20 and memoized.results.misses == 20
+
+    # the primes the program never mentions are not part of the key
+    assert memoized.evaluate(program, 2**4 * 5 * 1009) == (2**4 * 3**2 * 1009, memoized.evaluate(program, 2**4 * 5)[1])
+    assert memoized.evaluate_factors(program, {2: 4, 5: 1}) == ({2: 4, 3: 2}, memoized.evaluate(program, 2**4 * 5)[1])
+    assert memoized.results.misses == 20
+    COUNT += 2
+
+    # the least recently used results go first, by count and by size
+    results = memo.ResultCache(max_entries=2)
+    for k in range(3):
+        results.put("p", (k,), memo.Entry((k,), k))
+        results.get("p", (0,))
+    assert list(results.entries) == [("p", (2,)), ("p", (0,))]
+    results = memo.ResultCache(max_bytes=3 * memo.Entry((0,), 0).size((0,)))
+    for k in range(5):
+        results.put("p", (k,), memo.Entry((k,), k))
+    results.put("p", (9,), memo.Entry((9,), 9), cold=True)
+    assert list(results.entries) == [("p", (2,)), ("p", (3,)), ("p", (4,))]
+    COUNT += 2
+
+    # the results on disk are found by the next processes, the corrupted files are ignored
+    with tempfile.TemporaryDirectory() as directory:
+        first = memo.Memo(memo.ResultCache(directory=directory), engine="compiled")
+        outputs = [first.evaluate(program, 2**n * 5) for n in range(5)]
+        second = memo.Memo(memo.ResultCache(directory=directory), engine="compiled")
+        assert [second.evaluate(program, 2**n * 5) for n in range(5)] == outputs
+        assert second.results.hits == 5 and second.results.misses == 0
+
+        key = tuple(engines.to_registers(compiled, 2**3 * 5)[0])
+        with open(second.results.path_of(memo.digest(program), key), "w") as file:
+            file.write("{")
+        third = memo.Memo(memo.ResultCache(directory=directory), engine="compiled")
+        assert third.evaluate(program, 2**3 * 5) == outputs[3] and third.results.misses == 1
+    COUNT += 2
+
+    # the runs stop at the configurations met by the earlier runs, with the same outputs and steps
+    program = load("collatz")
+    compiled = engines.compile_program(program)
+    memoized = memo.Memo(intermediate=True)
+    for n in range(1, 20):
+        registers, cofactor = engines.to_registers(compiled, 2**n * 5)
+        steps = engines.run(compiled, registers)
+        assert memoized.evaluate(program, 2**n * 5) == (engines.from_registers(compiled, registers, cofactor), steps)
+        COUNT += 1
+    assert memoized.results.hits > 0
+    # only the inputs count as misses, not the configurations looked up on the way
+    assert memoized.results.misses == 19
+    COUNT += 1
+
+    # the long runs stop looking up and are finished by the engine
+    registers, cofactor = engines.to_registers(compiled, 2**300 * 5)
+    steps = engines.run(compiled, registers)
+    lookups = []
+    def lookup(key):
+        lookups.append(key)
+    start = engines.to_registers(compiled, 2**300 * 5)[0]
+    taken, found, _ = memo.run_through(compiled, start, memo.boundaries(compiled), lookup, max_lookups=10)
+    assert found is None and len(lookups) == 10 and taken < steps
+    assert memoized.evaluate(program, 2**300 * 5) == (engines.from_registers(compiled, registers, cofactor), steps)
+    COUNT += 2
+
+def run_primes_tests():
+    global COUNT
+
+    table = primes.PrimeTable()
+    expected = primes.crible(300000)
+    assert table[:len(expected)] == expected
+    assert table.below(1000) == primes.SMALL_PRIMES
+    # past the 100000 of the old eager table
+    assert primes.PRIMES[9592] == 100003
+    COUNT += 3
+
+    for n in [1, 2**64 * 3, 1000003 * 999983, (2**31 - 1)**3 * 10007, 2**89 - 1]:
+        factors = primes.factorize(n, [3])
+        assert math.prod(p**e for p, e in factors.items()) == n
+        assert all(primes.is_prime(p) for p in factors)
+        COUNT += 1
+
+    # 0 used to make valuation loop forever
+    assert primes.valuation(0, 3) == (0, 0)
+    assert primes.factorize(0, [2, 3]) == {}
+    program = fractran.program_from_file("programs/add")
+    assert fractran.evaluate2(program, 0) == 1
+    compiled = engines.compile_program(program)
+    assert engines.to_registers(compiled, 0) == ([0] * len(compiled.basis), 0)
+    COUNT += 4
+
+    # evaluate leaves the denominators too hard to factor whole instead of running pollard_rho on them
+    hard = (2**61 - 1) * (2**89 - 1)
+    assert primes.trial_division(hard * 2**3 * 997, [3]) == ({2: 3, 997: 1}, hard)
+    assert fractran.evaluate([(2, hard)], hard * 3) == 6 and fractran.evaluate([(2, hard)], 3) == 3
+    assert fractran.evaluate([(2, hard * 5), (7, 5)], hard * 5**2 * 3) == 2 * 3 * 7
+    COUNT += 3
+
+def run_factors_tests():
+    global COUNT
+
+    assert pretty.pretty_prime_factors_to_factors("2^3 * 6 * 7^0") == {2: 4, 3: 1}
+    assert pretty.factors_to_pretty_prime_factors({3: 2, 2: 1}) == "2 * 3^2"
+    assert pretty.factors_to_pretty_prime_factors({}) == "1"
+    COUNT += 3
+
+    for text in ["2^-3 * 5", "0", "-6 * 7", "0^2"]:
+        try:
+            pretty.pretty_prime_factors_to_factors(text)
+        except ValueError:
+            COUNT += 1
+        else:
+            assert False, text
+
+    program = fractran.program_from_file("programs/add")
+    for name in engines.ENGINES:
+        for dst, x, y in [(0, 0, 0), (3, 4, 5), (1, 9, 0)]:
+            factors = {2: dst, 3: x, 5: y, 7: 1, 101: 2}
+            expected = fractran.evaluate(program, pretty.factors_to_int(factors))
+            output = engines.evaluate_factors(program, factors, name)
+            assert pretty.factors_to_int(output) == expected
+            COUNT += 1
+
+    # the input is never built as an integer
+    output = engines.evaluate_factors(program, {2: 3, 3: 10**6, 5: 10**6, 7: 1, 101: 2})
+    assert output == {2: 2 * 10**6, 3: 10**6, 5: 10**6, 101: 2}
+    COUNT += 1
+
+ENGINES = [
+    ("V1", fractran.evaluate),
+    ("V2", fractran.evaluate2),
+    ("compiled", engines.evaluate_compiled),
+    ("jit", engines.evaluate_jit),
+    ("accelerated", engines.evaluate_accelerated),
+    ("macro", engines.evaluate_macro),
+]
+
+LARGE_ENGINES = [
+    ("macro", engines.evaluate_macro),
+]
+
+def run_section(name: str, tests: Callable[[], None]):
+    """
+    Runs one section of tests (a run_*_tests function), the first assertion failing in it
+    (or any exception) going to FAILURES instead of stopping the other sections.
+    """
+    global COUNT
+
+    COUNT = 0
+    start = time()
+    try:
+        tests()
+    except Exception:
+        FAILURES.append(f"[{name}] failed after {COUNT} tests:\n{traceback.format_exc()}")
+        print(f"[{name}] Failed! ({COUNT} tests passed before)")
+        return
+    time_taken = int(1000 * (time() - start))
+
+    print(f"[{name}] Success! ({COUNT} tests in {time_taken} ms)")
+
+# the sections run after the grids, the lockstep one only when numpy is there
+SECTIONS: list[tuple[str, Callable[[], None]]] = [
+    ("optimizer", run_optimizer_tests),
+    ("cycles", run_cycles_tests),
+    ("dispatch", run_dispatch_tests),
+    ("native, overflow", run_native_tests),
+    ("jit", run_jit_tests),
+    ("compiler", run_compiler_tests),
+    ("lockstep", run_lockstep_tests),
+    ("profiler", run_profiler_tests),
+    ("tracing", run_tracing_tests),
+    ("service", run_service_tests),
+    ("checkpoint", run_checkpoint_tests),
+    ("loader", run_loader_tests),
+    ("cache", run_cache_tests),
+    ("bench", run_bench_tests),
+    ("fuzz", run_fuzz_tests),
+    ("analysis", run_analysis_tests),
+    ("memo", run_memo_tests),
+    ("primes", run_primes_tests),
+    ("factors", run_factors_tests),
+    ("batch", run_batch_tests),
+]
 
 if __name__ == "__main__":
-    start_1 = time()
-    run_tests()
-    time_taken_1 = int(1000 * (time() - start_1))
-    tests_done = COUNT
-
-    print(f"[V1] Success! ({tests_done} tests in {time_taken_1} ms)")
-    
-    start_2 = time()
-    run_tests(True)
-    time_taken_2 = int(1000 * (time() - start_2))
-
-    print(f"[V2] Success! ({tests_done} tests in {time_taken_2} ms)")
+    """
+    How to run the tests:
+
+    ./tests.py [-j workers] [-v]
+
+    the grids of every program on every engine are sharded over workers processes (one per core by default),
+    -v prints the time of every case. The failures are all printed at the end.
+    """
+
+    workers = int(sys.argv[sys.argv.index("-j")+1]) if "-j" in sys.argv else None
+    run_sharded(workers, "-v" in sys.argv)
+
+    for name, tests in SECTIONS:
+        if name != "lockstep" or lockstep.np is not None:
+            run_section(name, tests)
+
+    for failure in FAILURES:
+        print()
+        print(failure)
+    if FAILURES:
+        sys.exit(1)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+from typing import Iterator
+from dataclasses import dataclass
+from array import array
+from fractran import Fraction
+import engines
+import pretty
+import json
+import sys
+
+MAGIC = b"FRTRACE1\n"
+
+@dataclass
+class Trace:
+    """
+    The last size events of a run (or one event every every steps), each event being
+    the step at which it happened and the index of the fraction which fired.
+    The registers are only kept once, at the end of the run (final, as {prime: exponent}):
+    when every step was recorded the earlier ones are found back by undoing the fractions.
+    """
+    program: list[Fraction]
+    every: int
+    steps: int
+    recorded: int
+    step_buffer: array
+    fraction_buffer: array
+    final: dict[int, int]
+
+    def events(self) -> Iterator[tuple[int, int]]:
+        """The (step, fraction) events still in the buffer, oldest first"""
+        size = len(self.step_buffer)
+        first = max(0, self.recorded - size)
+        for k in range(first, self.recorded):
+            yield self.step_buffer[k % size], self.fraction_buffer[k % size]
+
+    def describe(self, names: dict[int, str] = {}) -> Iterator[str]:
+        """One line per event, with the registers before it whenever they can be found back"""
+        events = list(self.events())
+        if self.every != 1:
+            for step, j in events:
+                num, den = self.program[j]
+                yield f"{step:>10}  #{j:<4} {num} / {den}"
+            return
+
+        compiled = engines.compile_program(self.program)
+        registers, cofactor = engines.factors_to_registers(compiled, self.final)
+        befores = []
+        for step, j in reversed(events):
+            _, delta = compiled.fractions[j]
+            for i, d in delta:
+                registers[i] -= d
+            befores.append(engines.registers_to_factors(compiled, registers, cofactor))
+
+        for (step, j), factors in zip(events, reversed(befores)):
+            num, den = self.program[j]
+            description = pretty.factors_to_pretty_registers(factors, names, True)
+            yield f"{step:>10}  #{j:<4} {f'{num} / {den}':<24} {description}"
+        yield f"{self.steps:>10}  end   {'':<24} {pretty.factors_to_pretty_registers(self.final, names, True)}"
+
+    def save(self, path: str):
+        header = {
+            "program": self.program,
+            "every": self.every,
+            "steps": self.steps,
+            "recorded": self.recorded,
+            "size": len(self.step_buffer),
+            "final": list(self.final.items()),
+        }
+        with open(path, "wb") as file:
+            file.write(MAGIC)
+            file.write(json.dumps(header).encode() + b"\n")
+            file.write(self.step_buffer.tobytes())
+            file.write(self.fraction_buffer.tobytes())
+
+def load(path: str) -> Trace:
+    with open(path, "rb") as file:
+        if file.readline() != MAGIC:
+            raise ValueError(f"{path} is not a fractran trace")
+        header = json.loads(file.readline())
+        step_buffer, fraction_buffer = array("Q"), array("I")
+        step_buffer.fromfile(file, header["size"])
+        fraction_buffer.fromfile(file, header["size"])
+
+    return Trace(
+        [tuple(fraction) for fraction in header["program"]],
+        header["every"],
+        header["steps"],
+        header["recorded"],
+        step_buffer,
+        fraction_buffer,
+        dict(header["final"]),
+    )
+
+def record(program: list[Fraction],
+           n: int,
+           size: int = 1 << 16,
+           every: int = 1,
+           max_steps: int | None = None,
+           compiled: engines.Compiled | None = None) -> tuple[int, Trace]:
+    """
+    Runs program on n like engines.run does, writing every every-th step into a ring buffer
+    of size events, so that the memory stays bounded however long the run.
+    Returns the output (or where the run stopped) along with the trace.
+    """
+    if compiled is None:
+        compiled = engines.compile_program(program)
+    registers, cofactor = engines.to_registers(compiled, n)
+    table = compiled.dispatch.table
+    state = compiled.dispatch.current(registers)
+
+    step_buffer = array("Q", bytes(8 * size))
+    fraction_buffer = array("I", bytes(4 * size))
+    recorded = 0
+    countdown = 1
+    steps = 0
+    limit = -1 if max_steps is None else max_steps
+
+    while steps != limit:
+        for j, guard, delta, move in table[state]:
+            for i, a in guard:
+                if registers[i] < a:
+                    break
+            else:
+                for i, d in delta:
+                    registers[i] += d
+                if move is not None:
+                    state = move
+                countdown -= 1
+                if countdown == 0:
+                    countdown = every
+                    position = recorded % size
+                    step_buffer[position] = steps
+                    fraction_buffer[position] = j
+                    recorded += 1
+                break
+        else:
+            break
+        steps += 1
+
+    final = engines.registers_to_factors(compiled, registers, pretty.int_to_factors(cofactor))
+    output = engines.from_registers(compiled, registers, cofactor)
+    return output, Trace(program, every, steps, recorded, step_buffer, fraction_buffer, final)
+
+if __name__ == "__main__":
+    """
+    How to run this program:
+
+    ./tracing.py <tracefile> [a=2 b=3 ...]
+
+    prints a trace written by ./fractran.py <filename> -T <tracefile>,
+    the primes being renamed as in the debug mode of fractran.py.
+    """
+
+    if len(sys.argv) >= 2:
+        names = {}
+        for argument in sys.argv[2:]:
+            a, b = argument.split("=")
+            names[int(b)] = a
+
+        for line in load(sys.argv[1]).describe(names):
+            print(line)
+    else:
+        print("Retry with the filename of the trace as an argument.")